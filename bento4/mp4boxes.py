@@ -0,0 +1,762 @@
+#Copyright (c) 2022, Michael McFadden & Radio Free Asia
+#GNU GENERAL PUBLIC LICENSE Version 2
+#See file LICENCE or visit https://github.com/flipmcf/CasterPak/blob/master/LICENSE
+"""
+Native reader for the 'moov' box of an mp4 file.
+
+This reads the track headers and sample tables straight out of the file,
+without running mp4info or mp4dump, and gives random access to individual samples
+(file offset, size, decode time, composition offset, sync flag).
+
+ReadMp4Info() and ReadMp4Tree() return the parts of the 'mp4info --format json' and
+'mp4dump --format json' output that mp4hls and mp4dash use, so those don't have to run a subprocess
+(and mp4dump doesn't have to parse the whole file) for every input.
+
+Mp4FileMap maps a whole file into memory, indexes its top level boxes and descends into them on demand.
+"""
+import io
+import sys
+import struct
+import itertools
+from array import array
+from bisect import bisect_left, bisect_right
+
+from .mp4utils import MapFile, ScanAtoms, WalkAtoms
+
+import logging
+logger = logging.getLogger(__name__)
+
+# boxes that contain nothing but other boxes
+CONTAINER_BOXES = {'moov', 'trak', 'edts', 'mdia', 'minf', 'dinf', 'stbl', 'mvex', 'udta', 'moof', 'traf', 'mfra',
+                   'sinf', 'schi'}
+
+# sample entries have a fixed size header before their child boxes (avcC, esds, ...)
+VISUAL_SAMPLE_ENTRIES = {'avc1', 'avc3', 'hvc1', 'hev1', 'dvav', 'dva1', 'dvhe', 'dvh1', 'mp4v', 'encv'}
+AUDIO_SAMPLE_ENTRIES = {'mp4a', 'ac-3', 'ec-3', 'ac-4', '.mp3', 'Opus', 'fLaC', 'enca'}
+VISUAL_SAMPLE_ENTRY_SIZE = 78
+AUDIO_SAMPLE_ENTRY_SIZE = 28
+
+HANDLER_TYPES = {
+    'vide': 'video',
+    'soun': 'audio',
+    'text': 'subtitles',
+    'sbtl': 'subtitles',
+    'subt': 'subtitles',
+}
+
+
+class Mp4Box:
+    """ a box inside an in-memory buffer.  Children are parsed on first access. """
+
+    def __init__(self, type, data, position, size, header_size):
+        self.type        = type
+        self.data        = data
+        self.position    = position
+        self.size        = size
+        self.header_size = header_size
+        self._children   = None
+
+    @property
+    def payload_start(self):
+        return self.position + self.header_size
+
+    @property
+    def end(self):
+        return self.position + self.size
+
+    @property
+    def payload(self):
+        return self.data[self.payload_start:self.end]
+
+    @property
+    def children(self):
+        if self._children is None:
+            start = self.payload_start
+            if self.type == 'stsd':
+                # full box header + entry count
+                start += 8
+            elif self.type in VISUAL_SAMPLE_ENTRIES:
+                start = self.position + 8 + VISUAL_SAMPLE_ENTRY_SIZE
+            elif self.type in AUDIO_SAMPLE_ENTRIES:
+                start = self.position + 8 + AUDIO_SAMPLE_ENTRY_SIZE
+            elif self.type not in CONTAINER_BOXES:
+                self._children = []
+                return self._children
+            self._children = list(ParseBoxes(self.data, start, self.end))
+        return self._children
+
+    def child(self, type):
+        for box in self.children:
+            if box.type == type:
+                return box
+        return None
+
+    def find(self, path):
+        """ find a descendant by a '/' separated path of box types, eg: 'mdia/minf/stbl' """
+        box = self
+        for type in path.split('/'):
+            box = box.child(type)
+            if box is None:
+                return None
+        return box
+
+    def find_all(self, type):
+        return [box for box in self.children if box.type == type]
+
+    def __repr__(self):
+        return 'BOX: ' + self.type + ',' + str(self.size) + '@' + str(self.position)
+
+
+def ParseBoxes(data, start, end):
+    """ yield the sibling boxes found between start and end of data """
+    position = start
+    while position + 8 <= end:
+        size, type = struct.unpack_from('>I4s', data, position)
+        header_size = 8
+        if size == 1:
+            size = struct.unpack_from('>Q', data, position + 8)[0]
+            header_size = 16
+        elif size == 0:
+            # box extends to the end of its container
+            size = end - position
+        if size < header_size or position + size > end:
+            logger.debug(f'truncated or invalid box at {position}')
+            return
+        yield Mp4Box(type.decode('latin-1'), data, position, size, header_size)
+        position += size
+
+
+def _BigEndianArray(typecode, data, offset, count):
+    values = array(typecode)
+    values.frombytes(data[offset:offset + count * values.itemsize])
+    if sys.byteorder == 'little':
+        values.byteswap()
+    return values
+
+
+class Mp4SampleTable:
+    """ random access to the samples described by an 'stbl' box """
+
+    def __init__(self, stbl):
+        # sample sizes
+        stsz = stbl.child('stsz')
+        if stsz is None:
+            raise NotImplementedError('compact sample sizes (stz2) are not supported')
+        uniform_size, self.sample_count = struct.unpack_from('>II', stbl.data, stsz.payload_start + 4)
+        if uniform_size:
+            self.sizes = None
+            self.uniform_size = uniform_size
+        else:
+            self.sizes = _BigEndianArray('I', stbl.data, stsz.payload_start + 12, self.sample_count)
+            self.uniform_size = 0
+
+        # chunk offsets
+        stco = stbl.child('stco')
+        if stco is not None:
+            count = struct.unpack_from('>I', stbl.data, stco.payload_start + 4)[0]
+            self.chunk_offsets = _BigEndianArray('I', stbl.data, stco.payload_start + 8, count)
+        else:
+            co64 = stbl.child('co64')
+            count = struct.unpack_from('>I', stbl.data, co64.payload_start + 4)[0]
+            self.chunk_offsets = _BigEndianArray('Q', stbl.data, co64.payload_start + 8, count)
+
+        # sample to chunk: runs of chunks that hold the same number of samples
+        stsc = stbl.child('stsc')
+        count = struct.unpack_from('>I', stbl.data, stsc.payload_start + 4)[0]
+        self.stsc_first_chunk = []
+        self.stsc_samples_per_chunk = []
+        self.stsc_first_sample = []
+        first_sample = 0
+        for i in range(count):
+            first_chunk, samples_per_chunk, _ = struct.unpack_from('>III', stbl.data, stsc.payload_start + 8 + 12*i)
+            if i:
+                first_sample += (first_chunk - self.stsc_first_chunk[-1]) * self.stsc_samples_per_chunk[-1]
+            self.stsc_first_chunk.append(first_chunk)
+            self.stsc_samples_per_chunk.append(samples_per_chunk)
+            self.stsc_first_sample.append(first_sample)
+
+        # decode times: runs of samples with the same duration
+        stts = stbl.child('stts')
+        count = struct.unpack_from('>I', stbl.data, stts.payload_start + 4)[0]
+        entries = _BigEndianArray('I', stbl.data, stts.payload_start + 8, count * 2)
+        self.stts_first_sample = array('q')
+        self.stts_first_dts = array('q')
+        self.stts_delta = array('q')
+        sample = 0
+        dts = 0
+        for i in range(count):
+            self.stts_first_sample.append(sample)
+            self.stts_first_dts.append(dts)
+            self.stts_delta.append(entries[2*i + 1])
+            sample += entries[2*i]
+            dts += entries[2*i] * entries[2*i + 1]
+        self.total_duration = dts
+
+        # composition offsets (optional)
+        ctts = stbl.child('ctts')
+        self.ctts_first_sample = None
+        if ctts is not None:
+            version = stbl.data[ctts.payload_start]
+            count = struct.unpack_from('>I', stbl.data, ctts.payload_start + 4)[0]
+            entries = _BigEndianArray('I', stbl.data, ctts.payload_start + 8, count * 2)
+            self.ctts_first_sample = array('q')
+            self.ctts_offset = array('q')
+            sample = 0
+            for i in range(count):
+                offset = entries[2*i + 1]
+                if version == 1 and offset >= 0x80000000:
+                    offset -= 0x100000000
+                self.ctts_first_sample.append(sample)
+                self.ctts_offset.append(offset)
+                sample += entries[2*i]
+
+        # sync samples (optional - if missing, every sample is a sync sample)
+        stss = stbl.child('stss')
+        self.sync_samples = None
+        if stss is not None:
+            count = struct.unpack_from('>I', stbl.data, stss.payload_start + 4)[0]
+            # stss numbers samples from 1, we number them from 0
+            self.sync_samples = array('q', (n - 1 for n in _BigEndianArray('I', stbl.data, stss.payload_start + 8, count)))
+
+    def size(self, sample):
+        if self.sizes is None:
+            return self.uniform_size
+        return self.sizes[sample]
+
+    def sizes_of(self, first, end):
+        """ :return: the sizes of samples [first, end), straight from the 'stsz' table """
+        if self.sizes is None:
+            return itertools.repeat(self.uniform_size, max(0, end - first))
+        return self.sizes[first:end]
+
+    def sync_samples_in(self, first, end):
+        """ :return: the sync samples in [first, end) """
+        if self.sync_samples is None:
+            return range(first, end)
+        return self.sync_samples[bisect_left(self.sync_samples, first):bisect_left(self.sync_samples, end)]
+
+    def dts(self, sample):
+        run = bisect_right(self.stts_first_sample, sample) - 1
+        return self.stts_first_dts[run] + (sample - self.stts_first_sample[run]) * self.stts_delta[run]
+
+    def duration(self, sample):
+        run = bisect_right(self.stts_first_sample, sample) - 1
+        return self.stts_delta[run]
+
+    def cts_offset(self, sample):
+        if self.ctts_first_sample is None:
+            return 0
+        run = bisect_right(self.ctts_first_sample, sample) - 1
+        if run < 0:
+            return 0
+        return self.ctts_offset[run]
+
+    def is_sync(self, sample):
+        if self.sync_samples is None:
+            return True
+        i = bisect_right(self.sync_samples, sample) - 1
+        return i >= 0 and self.sync_samples[i] == sample
+
+    def sample_at_time(self, dts):
+        """ :return: the index of the first sample that is decoded at or after 'dts' """
+        run = bisect_right(self.stts_first_dts, dts) - 1
+        if run < 0:
+            return 0
+        delta = self.stts_delta[run]
+        offset = dts - self.stts_first_dts[run]
+        n = -(-offset // delta) if delta else 0
+        sample = self.stts_first_sample[run] + n
+        # the time may fall past the end of this run
+        if run + 1 < len(self.stts_first_sample):
+            sample = min(sample, self.stts_first_sample[run + 1])
+        return min(sample, self.sample_count)
+
+    def sync_sample_times(self):
+        """ yield (sample, dts) for every sync sample, in order """
+        if self.sync_samples is None:
+            for run in range(len(self.stts_first_sample)):
+                first = self.stts_first_sample[run]
+                last = self.stts_first_sample[run + 1] if run + 1 < len(self.stts_first_sample) else self.sample_count
+                dts = self.stts_first_dts[run]
+                delta = self.stts_delta[run]
+                for sample in range(first, last):
+                    yield sample, dts
+                    dts += delta
+        else:
+            for sample in self.sync_samples:
+                yield sample, self.dts(sample)
+
+    def chunk_of(self, sample):
+        """ :return: (0 based chunk index, index of the first sample in that chunk) """
+        run = bisect_right(self.stsc_first_sample, sample) - 1
+        samples_per_chunk = self.stsc_samples_per_chunk[run]
+        chunk_in_run = (sample - self.stsc_first_sample[run]) // samples_per_chunk
+        chunk = self.stsc_first_chunk[run] - 1 + chunk_in_run
+        return chunk, self.stsc_first_sample[run] + chunk_in_run * samples_per_chunk
+
+    def offset(self, sample):
+        chunk, first_sample = self.chunk_of(sample)
+        offset = self.chunk_offsets[chunk]
+        if self.sizes is None:
+            return offset + (sample - first_sample) * self.uniform_size
+        for s in range(first_sample, sample):
+            offset += self.sizes[s]
+        return offset
+
+    def samples(self, first, end):
+        """ yield (offset, size, dts, cts_offset, is_sync) for each sample in [first, end) """
+        if first >= end:
+            return
+        offset = self.offset(first)
+        chunk, _ = self.chunk_of(first)
+        dts = self.dts(first)
+        for sample in range(first, end):
+            sample_chunk, _ = self.chunk_of(sample)
+            if sample_chunk != chunk:
+                chunk = sample_chunk
+                offset = self.chunk_offsets[chunk]
+            size = self.size(sample)
+            yield offset, size, dts, self.cts_offset(sample), self.is_sync(sample)
+            offset += size
+            dts += self.duration(sample)
+
+
+class Mp4TrackInfo:
+    """ what we know about a track from its 'trak' box """
+
+    def __init__(self, trak):
+        tkhd = trak.child('tkhd')
+        version = trak.data[tkhd.payload_start]
+        if version == 1:
+            self.id = struct.unpack_from('>I', trak.data, tkhd.payload_start + 20)[0]
+        else:
+            self.id = struct.unpack_from('>I', trak.data, tkhd.payload_start + 12)[0]
+
+        mdhd = trak.find('mdia/mdhd')
+        version = trak.data[mdhd.payload_start]
+        if version == 1:
+            self.timescale, self.duration = struct.unpack_from('>IQ', trak.data, mdhd.payload_start + 20)
+            language = struct.unpack_from('>H', trak.data, mdhd.payload_start + 32)[0]
+        else:
+            self.timescale, self.duration = struct.unpack_from('>II', trak.data, mdhd.payload_start + 12)
+            language = struct.unpack_from('>H', trak.data, mdhd.payload_start + 20)[0]
+        self.language = ''.join(chr(((language >> shift) & 0x1F) + 0x60) for shift in (10, 5, 0))
+
+        hdlr = trak.find('mdia/hdlr')
+        handler_type = bytes(trak.data[hdlr.payload_start + 8:hdlr.payload_start + 12]).decode('latin-1')
+        self.type = HANDLER_TYPES.get(handler_type, 'other')
+
+        stbl = trak.find('mdia/minf/stbl')
+        self.stbl = stbl
+        stsd = stbl.child('stsd')
+        self.sample_description = stsd.children[0] if stsd is not None and stsd.children else None
+        self.coding = self.sample_description.type if self.sample_description else None
+
+        self.width = self.height = 0
+        self.channels = self.sample_rate = 0
+        if self.coding in VISUAL_SAMPLE_ENTRIES:
+            self.width, self.height = struct.unpack_from('>HH', trak.data, self.sample_description.payload_start + 24)
+        elif self.coding in AUDIO_SAMPLE_ENTRIES:
+            self.channels = struct.unpack_from('>H', trak.data, self.sample_description.payload_start + 16)[0]
+            self.sample_rate = struct.unpack_from('>I', trak.data, self.sample_description.payload_start + 24)[0] >> 16
+
+        self._sample_table = None
+
+    @property
+    def sample_table(self) -> Mp4SampleTable:
+        if self._sample_table is None:
+            self._sample_table = Mp4SampleTable(self.stbl)
+        return self._sample_table
+
+    def decoder_config(self, type):
+        """ :return: the payload of a child of the sample description, eg: 'avcC', 'hvcC' or 'esds' """
+        if self.sample_description is None:
+            return None
+        box = self.sample_description.child(type)
+        if box is None:
+            return None
+        return bytes(box.payload)
+
+    def __repr__(self):
+        return f'Track {self.id} ({self.type} {self.coding})'
+
+
+def ReadBox(f, atom):
+    """ read one top level box (an Mp4Atom from WalkAtoms) from an open file into memory
+
+    :return: an Mp4Box
+    """
+    f.seek(atom.position)
+    data = f.read(atom.size)
+    if len(data) != atom.size:
+        raise ValueError(f'truncated {atom.type} box at {atom.position}')
+    header_size = 16 if struct.unpack_from('>I', data, 0)[0] == 1 else 8
+    return Mp4Box(atom.type, memoryview(data), 0, atom.size, header_size)
+
+
+class Mp4FileMap:
+    """ an mp4 file mapped into memory, with an index of its top level boxes
+
+    Boxes come straight from the mapping, nothing is read or copied until it's used, and container
+    boxes are only parsed when they are descended into.  Boxes from the map can't be used after it is closed.
+    """
+
+    def __init__(self, filename, atoms=None):
+        """
+        :param atoms: the top level atoms of the file, if WalkAtoms has already been run
+        """
+        self.filename = filename
+        with io.open(filename, 'rb') as f:
+            self.data = MapFile(f)
+        self.atoms = atoms if atoms is not None else list(ScanAtoms(self.data))
+        # offsets of the top level boxes, in file order
+        self.positions = array('Q', [atom.position for atom in self.atoms])
+
+    def box(self, atom):
+        """ :return: the Mp4Box for a top level atom """
+        if atom.position + atom.size > len(self.data):
+            raise ValueError(f'truncated {atom.type} box at {atom.position}')
+        header_size = 16 if struct.unpack_from('>I', self.data, atom.position)[0] == 1 else 8
+        return Mp4Box(atom.type, self.data, atom.position, atom.size, header_size)
+
+    def boxes(self, type):
+        """ yield the top level boxes of a type """
+        for atom in self.atoms:
+            if atom.type == type:
+                yield self.box(atom)
+
+    def find(self, path):
+        """ find the first box by a '/' separated path of box types from the top level, eg: 'moov/trak/mdia' """
+        type, _, rest = path.partition('/')
+        for box in self.boxes(type):
+            found = box.find(rest) if rest else box
+            if found is not None:
+                return found
+        return None
+
+    def atom_at(self, offset):
+        """ :return: the top level atom that holds the byte at offset, None if there isn't one """
+        index = bisect_right(self.positions, offset) - 1
+        if index < 0:
+            return None
+        atom = self.atoms[index]
+        return atom if offset < atom.position + atom.size else None
+
+    def close(self):
+        if hasattr(self.data, 'close'):
+            self.data.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def ReadMoov(filename, atoms=None):
+    """ read the 'moov' box of an mp4 file into memory
+
+    :param atoms: the top level atoms of the file, if WalkAtoms has already been run
+    :return: an Mp4Box for 'moov'
+    """
+    if atoms is None:
+        atoms = WalkAtoms(filename)
+    for atom in atoms:
+        if atom.type == 'moov':
+            with io.open(filename, 'rb') as f:
+                return ReadBox(f, atom)
+
+    raise ValueError(f'no moov box found in {filename}')
+
+
+def ReadTracks(filename):
+    """ :return: a list of Mp4TrackInfo for each track of an mp4 file """
+    moov = ReadMoov(filename)
+    return [Mp4TrackInfo(trak) for trak in moov.find_all('trak')]
+
+
+# mp4info names for the handler types
+MP4INFO_TRACK_TYPES = {
+    'vide': 'Video',
+    'soun': 'Audio',
+    'hint': 'Hint',
+    'text': 'Text',
+    'sbtl': 'Subtitles',
+    'subt': 'Subtitles',
+    'meta': 'Metadata',
+}
+
+# sample entries whose mp4info description carries fields we don't decode (Dolby audio info, protection schemes).
+# ReadMp4Info refuses these so the caller falls back to mp4info.
+UNSUPPORTED_SAMPLE_ENTRIES = {'ac-3', 'ec-3', 'ac-4', 'encv', 'enca'}
+
+
+def _ReadDescriptor(data, position):
+    """ :return: (tag, payload start, payload end) of an MPEG-4 descriptor """
+    tag = data[position]
+    position += 1
+    size = 0
+    for _ in range(4):
+        byte = data[position]
+        position += 1
+        size = (size << 7) | (byte & 0x7F)
+        if not byte & 0x80:
+            break
+    return tag, position, position + size
+
+
+def ParseEsds(esds):
+    """
+    :param esds: payload of an 'esds' box
+    :return: (objectTypeIndication, DecoderSpecificInfo bytes)
+    """
+    tag, start, end = _ReadDescriptor(esds, 4)
+    if tag != 0x03:
+        raise NotImplementedError('unexpected esds layout')
+    flags = esds[start + 2]
+    position = start + 3
+    if flags & 0x80:
+        position += 2
+    if flags & 0x40:
+        position += 1 + esds[position]
+    if flags & 0x20:
+        position += 2
+
+    tag, start, end = _ReadDescriptor(esds, position)
+    if tag != 0x04:
+        raise NotImplementedError('unexpected esds layout')
+    object_type = esds[start]
+    decoder_specific_info = b''
+    position = start + 13
+    if position < end:
+        tag, start, info_end = _ReadDescriptor(esds, position)
+        if tag == 0x05:
+            decoder_specific_info = bytes(esds[start:info_end])
+    return object_type, decoder_specific_info
+
+
+def _AudioObjectType(decoder_specific_info):
+    """ :return: (audio object type, channel configuration) from an AudioSpecificConfig """
+    bits = int.from_bytes(decoder_specific_info[:4].ljust(4, b'\x00'), 'big')
+    object_type = bits >> 27
+    position = 5
+    if object_type == 31:
+        object_type = 32 + ((bits >> 21) & 0x3F)
+        position = 11
+    frequency_index = (bits >> (28 - position)) & 0x0F
+    position += 4
+    if frequency_index == 15:
+        # explicit 24 bit frequency: the channel configuration is in the next bytes
+        bits = int.from_bytes(decoder_specific_info[:8].ljust(8, b'\x00'), 'big')
+        position += 24
+        return object_type, (bits >> (64 - position - 4)) & 0x0F
+    return object_type, (bits >> (28 - position)) & 0x0F
+
+
+def CodecsString(track):
+    """ :return: the RFC 6381 codecs string of a track, the way mp4info writes it """
+    coding = track.coding
+    if coding in ('avc1', 'avc2', 'avc3', 'avc4', 'dvav', 'dva1'):
+        avcc = track.decoder_config('avcC')
+        if avcc:
+            return '%s.%02X%02X%02X' % (coding, avcc[1], avcc[2], avcc[3])
+    elif coding in ('hvc1', 'hev1', 'dvhe', 'dvh1'):
+        hvcc = track.decoder_config('hvcC')
+        if hvcc:
+            profile_space = hvcc[1] >> 6
+            tier = 'H' if hvcc[1] & 0x20 else 'L'
+            profile = hvcc[1] & 0x1F
+            compatibility = int('{:032b}'.format(struct.unpack_from('>I', hvcc, 2)[0])[::-1], 2)
+            codecs = '%s.%s%d.%X.%c%d' % (coding, 'ABC'[profile_space - 1] if profile_space else '',
+                                          profile, compatibility, tier, hvcc[12])
+            constraints = bytearray(hvcc[6:12])
+            while constraints and constraints[-1] == 0:
+                constraints.pop()
+            return codecs + ''.join('.%X' % byte for byte in constraints)
+    elif coding == 'mp4a':
+        esds = track.decoder_config('esds')
+        if esds:
+            object_type, decoder_specific_info = ParseEsds(esds)
+            if object_type == 0x40 and decoder_specific_info:
+                return 'mp4a.40.%d' % _AudioObjectType(decoder_specific_info)[0]
+            return 'mp4a.%02X' % object_type
+    return coding
+
+
+def _ParameterSets(avcc, count, position):
+    """ :return: (list of hex parameter sets, position after them) """
+    parameter_sets = []
+    for _ in range(count):
+        length = struct.unpack_from('>H', avcc, position)[0]
+        parameter_sets.append(avcc[position + 2:position + 2 + length].hex())
+        position += 2 + length
+    return parameter_sets, position
+
+
+def _SampleDescription(track):
+    if track.coding in UNSUPPORTED_SAMPLE_ENTRIES:
+        raise NotImplementedError(f'{track.coding} sample descriptions are not supported')
+
+    description = {'coding': track.coding, 'codecs_string': CodecsString(track)}
+    if track.coding in VISUAL_SAMPLE_ENTRIES:
+        description['width'] = track.width
+        description['height'] = track.height
+        avcc = track.decoder_config('avcC')
+        if avcc:
+            # smooth streaming manifests carry the parameter sets
+            description['avc_sps'], position = _ParameterSets(avcc, avcc[5] & 0x1F, 6)
+            description['avc_pps'], _ = _ParameterSets(avcc, avcc[position], position + 1)
+        for type in ('dvcC', 'dvvC'):
+            config = track.decoder_config(type)
+            if config:
+                description['dolby_vision'] = {
+                    'profile': config[2] >> 1,
+                    'level': ((config[2] & 0x01) << 5) | (config[3] >> 3),
+                }
+                break
+    elif track.coding in AUDIO_SAMPLE_ENTRIES:
+        description['sample_rate'] = track.sample_rate
+        description['channels'] = track.channels
+        esds = track.decoder_config('esds') if track.coding == 'mp4a' else None
+        if esds:
+            object_type, decoder_specific_info = ParseEsds(esds)
+            if object_type == 0x40 and decoder_specific_info:
+                description['mpeg_4_audio_decoder_config'] = {
+                    'channels': _AudioObjectType(decoder_specific_info)[1],
+                }
+    return description
+
+
+def _FullBoxVersion(box):
+    return box.data[box.payload_start]
+
+
+def ReadMp4Info(filename, atoms=None):
+    """ read an mp4 file's track information, without running mp4info
+
+    :param atoms: the top level atoms of the file, if WalkAtoms has already been run
+    :return: a dict like the json output of 'mp4info --format json --fast'.
+    Only the fields mp4hls and mp4dash use are filled in.
+    """
+    if atoms is None:
+        atoms = WalkAtoms(filename)
+    moov = ReadMoov(filename, atoms)
+
+    mvhd = moov.child('mvhd')
+    if _FullBoxVersion(mvhd) == 1:
+        time_scale, duration = struct.unpack_from('>IQ', moov.data, mvhd.payload_start + 20)
+    else:
+        time_scale, duration = struct.unpack_from('>II', moov.data, mvhd.payload_start + 12)
+
+    types = [atom.type for atom in atoms]
+    info = {
+        'file': {
+            'fast_start': 'mdat' not in types or types.index('moov') < types.index('mdat'),
+        },
+        'movie': {
+            'duration': duration,
+            'duration_ms': int(duration * 1000 / time_scale) if time_scale else 0,
+            'time_scale': time_scale,
+            'fragments': moov.child('mvex') is not None,
+        },
+        'tracks': [],
+    }
+
+    for trak in moov.find_all('trak'):
+        track = Mp4TrackInfo(trak)
+        hdlr = trak.find('mdia/hdlr')
+        handler_type = bytes(trak.data[hdlr.payload_start + 8:hdlr.payload_start + 12]).decode('latin-1')
+        stsz = trak.find('mdia/minf/stbl/stsz')
+        sample_count = struct.unpack_from('>I', trak.data, stsz.payload_start + 8)[0] if stsz is not None else 0
+        if track.sample_description is None:
+            raise NotImplementedError(f'track {track.id} has no sample description')
+
+        info['tracks'].append({
+            'id': track.id,
+            'type': MP4INFO_TRACK_TYPES.get(handler_type, 'Unknown'),
+            'language': track.language,
+            'media': {
+                'sample_count': sample_count,
+                'timescale': track.timescale,
+                'duration': track.duration,
+                'duration_ms': int(track.duration * 1000 / track.timescale) if track.timescale else 0,
+            },
+            'sample_descriptions': [_SampleDescription(track)],
+        })
+
+    return info
+
+
+def _DumpBox(box):
+    """ :return: a dict like an mp4dump json node, with the fields Mp4File reads """
+    node = {'name': box.type, 'size': box.size}
+    data = box.data
+    start = box.payload_start
+    version = data[start] if box.type not in CONTAINER_BOXES else 0
+
+    if box.type == 'tkhd':
+        node['id'] = struct.unpack_from('>I', data, start + (20 if version == 1 else 12))[0]
+    elif box.type == 'mdhd':
+        node['timescale'] = struct.unpack_from('>I', data, start + (20 if version == 1 else 12))[0]
+    elif box.type == 'trex':
+        node['track id'], _, node['default sample duration'] = struct.unpack_from('>III', data, start + 4)
+    elif box.type == 'tenc':
+        node['default_KID'] = '[' + ' '.join('%02x' % byte for byte in data[start + 8:start + 24]) + ']'
+    elif box.type == 'tfhd':
+        flags = struct.unpack_from('>I', data, start)[0] & 0xFFFFFF
+        node['track ID'] = struct.unpack_from('>I', data, start + 4)[0]
+        position = start + 8
+        if flags & 0x01:
+            position += 8
+        if flags & 0x02:
+            position += 4
+        if flags & 0x08:
+            node['default sample duration'] = struct.unpack_from('>I', data, position)[0]
+    elif box.type == 'trun':
+        flags = struct.unpack_from('>I', data, start)[0] & 0xFFFFFF
+        count = struct.unpack_from('>I', data, start + 4)[0]
+        position = start + 8
+        if flags & 0x01:
+            position += 4
+        if flags & 0x04:
+            position += 4
+        fields = [key for flag, key in ((0x100, 'd'), (0x200, 's'), (0x400, 'f'), (0x800, 'c')) if flags & flag]
+        values = _BigEndianArray('I', data, position, count * len(fields))
+        node['sample count'] = count
+        node['entries'] = [dict(zip(fields, values[i * len(fields):(i + 1) * len(fields)])) for i in range(count)]
+    elif box.type == 'tfra':
+        node['track_ID'], lengths, count = struct.unpack_from('>III', data, start + 4)
+        position = start + 16
+        time_format = '>QQ' if version == 1 else '>II'
+        for i in range(count):
+            time, moof_offset = struct.unpack_from(time_format, data, position)
+            position += struct.calcsize(time_format)
+            numbers = []
+            for shift in (4, 2, 0):
+                length = ((lengths >> shift) & 0x03) + 1
+                numbers.append(int.from_bytes(data[position:position + length], 'big'))
+                position += length
+            node[f'[{i}]'] = 'time=%d, moof_offset=%d, traf_number=%d, trun_number=%d, sample_number=%d' % (
+                time, moof_offset, *numbers)
+
+    node['children'] = [_DumpBox(child) for child in box.children]
+    return node
+
+
+def ReadMp4Tree(filename, atoms=None):
+    """ read the box tree of an mp4 file, without running mp4dump
+
+    Only 'moov', 'moof' and 'mfra' are read and decoded, the media data is skipped.
+
+    :param atoms: the top level atoms of the file, if WalkAtoms has already been run
+    :return: a list like the json output of 'mp4dump --format json --verbosity 1'.
+    Only the fields Mp4File uses are filled in.
+    """
+    tree = []
+    with Mp4FileMap(filename, atoms) as mapped:
+        for atom in mapped.atoms:
+            if atom.type in ('moov', 'moof', 'mfra'):
+                tree.append(_DumpBox(mapped.box(atom)))
+            else:
+                tree.append({'name': atom.type, 'size': atom.size, 'children': []})
+    return tree
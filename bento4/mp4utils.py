@@ -1,17 +1,21 @@
 import collections
-from functools import reduce
 
 __author__    = 'Gilles Boccon-Gibod (bok@bok.net)'
 __copyright__ = 'Copyright 2011-2020 Axiomatic Systems, LLC.'
 
 import sys
 import os
+import contextlib
 import os.path as path
 from subprocess import check_output, CalledProcessError, STDOUT
 import json
 import io
+import mmap
 import struct
+import itertools
+import functools
 import operator
+from array import array
 import hashlib
 import fractions
 import xml.sax.saxutils as saxutils
@@ -282,13 +286,16 @@ def Bento4Command(options, name, *args, **kwargs):
     cmd += args
     logger.debug(f'COMMAND: {" ".join(cmd)}')
 
+    # options.process_slot, if set, returns a context manager to hold while the binary runs
+    process_slot = getattr(options, 'process_slot', None)
     try:
-        try:
-            return check_output(cmd, stderr=STDOUT)
-        except OSError as e:
-            logger.debug(f'executable {executable} not found in exec_dir, trying with PATH')
-            cmd[0] = path.basename(cmd[0])
-            return check_output(cmd, stderr=STDOUT)
+        with process_slot() if process_slot else contextlib.nullcontext():
+            try:
+                return check_output(cmd, stderr=STDOUT)
+            except OSError as e:
+                logger.debug(f'executable {executable} not found in exec_dir, trying with PATH')
+                cmd[0] = path.basename(cmd[0])
+                return check_output(cmd, stderr=STDOUT)
     except CalledProcessError as e:
         message = "binary tool failed with error %d" % e.returncode
         if options.verbose:
@@ -320,6 +327,8 @@ def Mp4IframeIndex(options, input_filename, *args, **kwargs):
     return Bento4Command(options, 'mp4iframeindex', input_filename, *args, **kwargs)
 
 class Mp4Atom:
+    __slots__ = ('type', 'size', 'position')
+
     def __init__(self, type, size, position):
         self.type     = type
         self.size     = size
@@ -329,25 +338,80 @@ class Mp4Atom:
         return 'ATOM: ' + self.type + ',' + str(self.size) + '@' + str(self.position)
 
 
-def WalkAtoms(filename, until=None):
-    cursor = 0
-    atoms = []
-    file = io.FileIO(filename, "rb")
-    while True:
-        try:
-            size = struct.unpack('>I', file.read(4))[0]
-            type = file.read(4).decode('ascii')
-            if type == until:
+def MapFile(file):
+    """ map an open file into memory, read only
+
+    :return: an mmap of the file, or empty bytes for an empty file (which can't be mapped)
+    """
+    size = os.fstat(file.fileno()).st_size
+    if size == 0:
+        return b''
+    return mmap.mmap(file.fileno(), size, access=mmap.ACCESS_READ)
+
+
+class _FileSlices:
+    """ slices of a file by pread, for filesystems that can't mmap """
+    def __init__(self, file):
+        self.file = file
+        self.size = os.fstat(file.fileno()).st_size
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, span):
+        return os.pread(self.file.fileno(), span.stop - span.start, span.start)
+
+
+def ScanAtoms(data, start=0, end=None, until=None):
+    """ yield an Mp4Atom for each of the sibling boxes between start and end of data
+
+    A box of size 1 has its 64 bit size after the type, a box of size 0 runs to 'end'.
+    The scan stops before a box of type 'until', and at anything that isn't a box header.
+    A box that runs past 'end' is the last one: the file may be truncated.
+
+    :param data: the file (mapped by MapFile) or a part of it
+    """
+    if end is None:
+        end = len(data)
+    position = start
+    while position + 8 <= end:
+        header = data[position:position+16]
+        size, type = struct.unpack_from('>I4s', header)
+        header_size = 8
+        if size == 1:
+            if len(header) < 16:
                 break
-            if size == 1:
-                size = struct.unpack('>Q', file.read(8))[0]
-            atoms.append(Mp4Atom(type, size, cursor))
-            cursor += size
-            file.seek(cursor)
-        except Exception:
+            size = struct.unpack_from('>Q', header, 8)[0]
+            header_size = 16
+        elif size == 0:
+            size = end - position
+        try:
+            type = type.decode('ascii')
+        except UnicodeDecodeError:
+            logger.debug(f'no box header at {position}')
+            break
+        if type == until:
+            break
+        if size < header_size:
+            logger.debug(f'invalid {type} box size {size} at {position}')
             break
+        yield Mp4Atom(type, size, position)
+        position += size
 
-    return atoms
+
+def WalkAtoms(filename, until=None):
+    """ :return: an Mp4Atom for each top level box of an mp4 file, up to the first one of type 'until' """
+    with io.open(filename, 'rb') as file:
+        try:
+            data = MapFile(file)
+        except OSError as e:
+            logger.debug(f'can not map {filename} ({e}), reading box headers instead')
+            data = _FileSlices(file)
+        try:
+            return list(ScanAtoms(data, until=until))
+        finally:
+            if isinstance(data, mmap.mmap):
+                data.close()
 
 
 def FilterChildren(parent, type):
@@ -364,18 +428,40 @@ def FindChild(top, path):
         top = children[0]
     return top
 
+# the per fragment tables of a track, as arrays of these types: there is an entry in each for every
+# fragment, and heavily fragmented files have tens of thousands
+TRACK_TABLE_TYPES = {
+    'moofs':                    'L',
+    'sample_counts':            'L',
+    'segment_sizes':            'Q',
+    'segment_durations':        'd',
+    'segment_scaled_durations': 'q',
+    'segment_bitrates':         'q',
+}
+
 class Mp4Track:
+    __slots__ = ('parent', 'info', 'default_sample_duration', 'timescale', 'moofs', 'sample_counts',
+                 'segment_sizes', 'segment_durations', 'segment_scaled_durations', 'segment_bitrates',
+                 'total_sample_count', 'total_duration', 'total_scaled_duration', 'media_size',
+                 'average_segment_duration', 'average_segment_bitrate', 'max_segment_bitrate', 'bandwidth',
+                 'language', 'language_name', 'order_index', 'key_info', 'id', 'type', 'codec_family', 'codec',
+                 'scan_type', 'width', 'height', 'sample_rate', 'channels', 'frame_rate', 'frame_rate_ratio',
+                 # set by mp4dash and mp4hls
+                 'representation_id', 'stream_id', 'group_id', 'label', 'init_segment_name', 'media_info',
+                 'hls_group', 'hls_group_match', 'hls_default', 'hls_autoselect', 'max_playout_rate',
+                 'sidx_atom', 'moov_atom')
+
     def __init__(self, parent, info):
         self.parent                   = parent
         self.info                     = info
         self.default_sample_duration  = 0
         self.timescale                = 0
-        self.moofs                    = []
-        self.sample_counts            = []
-        self.segment_sizes            = []
-        self.segment_durations        = []
-        self.segment_scaled_durations = []
-        self.segment_bitrates         = []
+        self.moofs                    = array(TRACK_TABLE_TYPES['moofs'])
+        self.sample_counts            = array(TRACK_TABLE_TYPES['sample_counts'])
+        self.segment_sizes            = array(TRACK_TABLE_TYPES['segment_sizes'])
+        self.segment_durations        = array(TRACK_TABLE_TYPES['segment_durations'])
+        self.segment_scaled_durations = array(TRACK_TABLE_TYPES['segment_scaled_durations'])
+        self.segment_bitrates         = array(TRACK_TABLE_TYPES['segment_bitrates'])
         self.total_sample_count       = 0
         self.total_duration           = 0
         self.total_scaled_duration    = 0
@@ -442,30 +528,30 @@ class Mp4Track:
 
     def update(self, options):
         # compute the total number of samples
-        self.total_sample_count = reduce(operator.add, self.sample_counts, 0)
+        self.total_sample_count = sum(self.sample_counts)
 
         # compute the total duration
-        self.total_duration = reduce(operator.add, self.segment_durations, 0)
-        self.total_scaled_duration = reduce(operator.add, self.segment_scaled_durations, 0)
+        self.total_duration = sum(self.segment_durations)
+        self.total_scaled_duration = sum(self.segment_scaled_durations)
 
         # compute the average segment durations
         segment_count = len(self.segment_durations)
         if segment_count > 2:
             # do not count the last two segments, which could be shorter
-            self.average_segment_duration = reduce(operator.add, self.segment_durations[:-2], 0)/float(segment_count-2)
+            self.average_segment_duration = sum(itertools.islice(self.segment_durations, segment_count-2))/float(segment_count-2)
         elif segment_count > 0:
             self.average_segment_duration = self.segment_durations[0]
         else:
             self.average_segment_duration = 0
 
         # compute the average segment bitrates
-        self.media_size = reduce(operator.add, self.segment_sizes, 0)
+        self.media_size = sum(self.segment_sizes)
         if self.total_duration:
             self.average_segment_bitrate = int(8.0*float(self.media_size)/self.total_duration)
 
         # compute the max segment bitrates
         if len(self.segment_bitrates) > 1:
-            self.max_segment_bitrate = max(self.segment_bitrates[:-1])
+            self.max_segment_bitrate = max(itertools.islice(self.segment_bitrates, len(self.segment_bitrates)-1))
         else:
             self.max_segment_bitrate = self.average_segment_bitrate
 
@@ -499,6 +585,10 @@ class Mp4Track:
     def __repr__(self):
         return 'File '+str(self.parent.file_list_index)+'#'+str(self.id)
 
+# what Mp4File works out for each track by reading the file, see Mp4File.analysis()
+ANALYSIS_TRACK_FIELDS = ['default_sample_duration', 'timescale', 'moofs', 'sample_counts', 'segment_sizes',
+                         'segment_durations', 'segment_scaled_durations', 'segment_bitrates', 'key_info']
+
 class Mp4File:
     def __init__(self, options, media_source):
         self.media_source    = media_source
@@ -513,7 +603,11 @@ class Mp4File:
         self.media_name = path.basename(filename)
 
         # walk the atom structure
-        self.atoms = WalkAtoms(filename)
+        saved = media_source.analysis
+        if saved is not None:
+            self.atoms = [Mp4Atom(*atom) for atom in saved['atoms']]
+        else:
+            self.atoms = WalkAtoms(filename)
         self.segments = []
         for atom in self.atoms:
             if atom.type == 'moov':
@@ -529,9 +623,46 @@ class Mp4File:
         for track in self.info['tracks']:
             self.tracks[track['id']] = Mp4Track(self, track)
 
-        # get a complete file dump
-        json_dump = Mp4Dump(options, filename, format='json', verbosity='1')
-        self.tree = json.loads(json_dump, strict=False, object_pairs_hook=collections.OrderedDict)
+        if saved is not None:
+            # analyzed before, restore the results instead of reading the file again
+            for saved_track in saved['tracks']:
+                track = self.tracks[saved_track['id']]
+                for name in ANALYSIS_TRACK_FIELDS:
+                    if name in TRACK_TABLE_TYPES:
+                        setattr(track, name, array(TRACK_TABLE_TYPES[name], saved_track[name]))
+                    else:
+                        setattr(track, name, saved_track[name])
+        else:
+            self.read_tree(options, filename)
+
+        # compute the total numer of samples for each track
+        for track_id in self.tracks:
+            self.tracks[track_id].update(options)
+
+        # print debug info if requested
+        for track in self.tracks.values():
+            logger.debug(f'Track ID                     ={track.id}')
+            logger.debug(f'    Segment Count            ={ len(track.segment_durations)}')
+            logger.debug(f'    Type                     ={track.type}')
+            logger.debug(f'    Sample Count             ={track.total_sample_count}')
+            logger.debug(f'    Average segment bitrate  ={track.average_segment_bitrate}')
+            logger.debug(f'    Max segment bitrate      ={track.max_segment_bitrate}')
+            logger.debug(f'    Required bandwidth       ={int(track.bandwidth)}')
+            logger.debug(f'    Average segment duration ={track.average_segment_duration}')
+
+
+
+    def read_tree(self, options, filename):
+        """ read the box tree and work out the per track timescales, keys and segment statistics """
+        # get the box tree: read natively when we can, it only needs the moov and moof boxes.
+        # mp4dump parses the whole file, so it is only used for files the native reader can't handle
+        try:
+            from .mp4boxes import ReadMp4Tree
+            self.tree = ReadMp4Tree(filename, self.atoms)
+        except Exception as e:
+            logger.debug(f'native box reader failed for {filename} ({e!r}), running mp4dump')
+            json_dump = Mp4Dump(options, filename, format='json', verbosity='1')
+            self.tree = json.loads(json_dump, strict=False, object_pairs_hook=collections.OrderedDict)
 
         # look for KIDs
         for track in self.tracks.values():
@@ -634,22 +765,17 @@ class Mp4File:
                             track.segment_durations[i] = moof_duration_sec
                             track.segment_scaled_durations[i] = moof_duration
 
-        # compute the total numer of samples for each track
-        for track_id in self.tracks:
-            self.tracks[track_id].update(options)
-
-        # print debug info if requested
-        for track in self.tracks.values():
-            logger.debug(f'Track ID                     ={track.id}')
-            logger.debug(f'    Segment Count            ={ len(track.segment_durations)}')
-            logger.debug(f'    Type                     ={track.type}')
-            logger.debug(f'    Sample Count             ={track.total_sample_count}')
-            logger.debug(f'    Average segment bitrate  ={track.average_segment_bitrate}')
-            logger.debug(f'    Max segment bitrate      ={track.max_segment_bitrate}')
-            logger.debug(f'    Required bandwidth       ={int(track.bandwidth)}')
-            logger.debug(f'    Average segment duration ={track.average_segment_duration}')
-
-
+    def analysis(self):
+        """ everything this object learned from reading the file, as a json serializable dict.
+            Pass it to MediaSource() to describe the same, unchanged, file without reading it again.
+        """
+        return {
+            'mp4_info': self.info,
+            'atoms': [[atom.type, atom.size, atom.position] for atom in self.atoms],
+            'tracks': [dict({'id': track.id}, **{name: getattr(track, name).tolist() if name in TRACK_TABLE_TYPES
+                                                   else getattr(track, name) for name in ANALYSIS_TRACK_FIELDS})
+                       for track in self.tracks.values()],
+        }
 
     def find_track_by_id(self, track_id_to_find):
         for track_id in self.tracks:
@@ -662,9 +788,11 @@ class Mp4File:
         return [track for track in list(self.tracks.values()) if track_type_to_find == '' or track_type_to_find == track.type]
 
 class MediaSource:
-    def __init__(self, options, name):
+    def __init__(self, options, name, analysis=None):
         self.name = name
         self.mp4_info = None
+        # a saved Mp4File.analysis() of this file, used instead of reading the file
+        self.analysis = analysis
         self.key_infos = {} # key infos indexed by track ID
         if name.startswith('[') and ']' in name:
             try:
@@ -690,9 +818,16 @@ class MediaSource:
             self.format = 'mp4'
 
         # if the file is an mp4 file, get the mp4 info now
-        if self.format == 'mp4':
-            json_info = Mp4Info(options, self.filename, format='json', fast=True)
-            self.mp4_info = json.loads(json_info, strict=False)
+        if self.format == 'mp4' and analysis is not None:
+            self.mp4_info = analysis['mp4_info']
+        elif self.format == 'mp4':
+            try:
+                from .mp4boxes import ReadMp4Info
+                self.mp4_info = ReadMp4Info(self.filename)
+            except Exception as e:
+                logger.debug(f'native mp4 reader failed for {self.filename} ({e!r}), running mp4info')
+                json_info = Mp4Info(options, self.filename, format='json', fast=True)
+                self.mp4_info = json.loads(json_info, strict=False)
 
         # keep a record of our original filename in case it gets changed later
         self.original_filename = self.filename
@@ -700,19 +835,176 @@ class MediaSource:
     def __repr__(self):
         return self.name
 
+# segments ComputeBandwidth checks one by one, under the tree of hulls
+BANDWIDTH_BLOCK = 16
+
+def _UpperHull(xs, ys, indexes):
+    # the indexes k of the points (xs[k], ys[k]) on the upper convex hull of 'indexes', left to
+    # right.  xs must be non decreasing along indexes, and ys non decreasing where xs ties.
+    hull = []
+    for k in indexes:
+        x, y = xs[k], ys[k]
+        while hull and xs[hull[-1]] == x:
+            hull.pop()
+        while len(hull) > 1:
+            a, b = hull[-2], hull[-1]
+            if (xs[b]-xs[a])*(y-ys[a]) < (ys[b]-ys[a])*(x-xs[a]):
+                break
+            hull.pop()
+        hull.append(k)
+    return hull
+
 def ComputeBandwidth(buffer_time, sizes, durations):
+    # The smallest bandwidth at which a client that buffered buffer_time seconds of it never
+    # stalls, exactly as bento4 computes it.  Walking the segments, bandwidth goes up whenever some
+    # run of segments starting at segment i doesn't fit in the buffer plus what arrives while the
+    # run plays:
+    #
+    #     size(i..j) > buffer_time*bandwidth/8 + duration(i..j)*bandwidth/8
+    #
+    # With running totals X (durations) and Y (sizes), and rate = bandwidth/8, that is
+    #
+    #     Y[j] - rate*X[j] > Y[i-1] - rate*X[i-1] + buffer_time*rate
+    #
+    # Runs of up to BANDWIDTH_BLOCK segments are checked one by one, as bento4 does.  Longer ones
+    # are only looked for: the segments are cut in blocks of BANDWIDTH_BLOCK, under a binary tree
+    # where every node keeps the upper hull of the (X, Y) points below it.  The largest Y-rate*X of
+    # a node is found by walking its hull, and as the rate only goes up that walk never turns back,
+    # so finding the first j that might not fit takes O(log n).  The largest Y-rate*X to the end of
+    # the block and in the blocks after it are kept while the rate stays the same, so most segments
+    # that raise nothing cost O(1).
+    #
+    # The running totals round differently than sums taken segment by segment, so a run is only
+    # passed over when it fits by more than 'slack', a bound on that rounding.  Any other run is
+    # summed segment by segment from i and checked as bento4 does, and the bandwidth it raises to
+    # is computed from those sums, so every decision and every bandwidth is bento4's own.
+    count = len(sizes)
+    if count == 0:
+        return 0
+    xs = list(itertools.accumulate(durations))
+    ys = list(itertools.accumulate(sizes))
+
+    # the first segment with a duration from each segment on
+    timed = [count]*count
+    following = count
+    for k in range(count-1, -1, -1):
+        if durations[k]:
+            following = k
+        timed[k] = following
+
+    blocks = (count+BANDWIDTH_BLOCK-1)//BANDWIDTH_BLOCK
+    leaves = 1 << (blocks-1).bit_length()
+    hulls = [[] for _ in range(2*leaves)]
+    for block in range(blocks):
+        hulls[leaves+block] = _UpperHull(xs, ys, range(block*BANDWIDTH_BLOCK, min(count, (block+1)*BANDWIDTH_BLOCK)))
+    for node in range(leaves-1, 0, -1):
+        hulls[node] = _UpperHull(xs, ys, hulls[2*node]+hulls[2*node+1])
+    positions = [len(hull)-1 for hull in hulls]
+
+    def peak(node, rate):
+        # largest Y-rate*X under node, its segment is hulls[node][positions[node]]
+        hull = hulls[node]
+        if not hull:
+            return float('-inf')
+        position = positions[node]
+        best = ys[hull[position]] - rate*xs[hull[position]]
+        while position:
+            value = ys[hull[position-1]] - rate*xs[hull[position-1]]
+            if value < best:
+                break
+            position -= 1
+            best = value
+        positions[node] = position
+        return best
+
+    def first_above(start, limit, rate):
+        # the first segment j from start on where Y[j]-rate*X[j] > limit, None if there is none
+        while start < count:
+            block = start//BANDWIDTH_BLOCK
+            for j in range(start, min(count, (block+1)*BANDWIDTH_BLOCK)):
+                if ys[j] - rate*xs[j] > limit:
+                    return j
+            # up to the first node on the right that goes above limit, then down to its first block that does
+            node = leaves+block
+            while node > 1 and (node & 1 or peak(node+1, rate) <= limit):
+                node >>= 1
+            if node == 1:
+                return None
+            node += 1
+            while node < leaves:
+                node <<= 1
+                if peak(node, rate) <= limit:
+                    node += 1
+            start = (node-leaves)*BANDWIDTH_BLOCK
+        return None
+
+    def peak_after(block, rate):
+        # largest Y-rate*X in the blocks after 'block'
+        best = float('-inf')
+        node = leaves+block
+        while node > 1:
+            if not node & 1:
+                best = max(best, peak(node+1, rate))
+            node >>= 1
+        return best
+
+    # rounding of the running totals, the hulls and the walks along them, relative to the totals
+    rounding = 64*(count+4)*count.bit_length()*sys.float_info.epsilon
+
     bandwidth = 0.0
-    for i in range(len(sizes)):
+    rate = 0.0
+    slack = rounding*ys[-1]
+    tail = None      # largest Y-rate*X from each segment to the end of its block, at this rate
+    tail_block = None
+    after = None     # and in the blocks after it
+    for i in range(count):
+        start = timed[i]
+        if start == count:
+            break
+        buffer_size = (buffer_time*bandwidth)/8.0
+        limit = (ys[i-1] - rate*xs[i-1] if i else 0) + buffer_size - slack
+
+        block, offset = divmod(i, BANDWIDTH_BLOCK)
+        current = tail is not None and tail_block == block
+        if current and tail[offset] <= limit and after <= limit:
+            continue
+
         accu_size     = 0
         accu_duration = 0
-        buffer_size = (buffer_time*bandwidth)/8.0
-        for j in range(i, len(sizes)):
+        raised = False
+        j = i
+        while j < count:
+            if j >= i+BANDWIDTH_BLOCK:
+                # past the short runs, go on to the next one that might not fit.  The segments before it
+                # are added one at a time, in order, as below (sum() compensates since Python 3.12)
+                candidate = first_above(max(start, j), limit, rate)
+                if candidate is None:
+                    break
+                accu_size     = functools.reduce(operator.add, sizes[j:candidate], accu_size)
+                accu_duration = functools.reduce(operator.add, durations[j:candidate], accu_duration)
+                j = candidate
             accu_size     += sizes[j]
             accu_duration += durations[j]
             max_avail = buffer_size+accu_duration*bandwidth/8.0
             if accu_size > max_avail and accu_duration != 0:
                 bandwidth = 8.0*(accu_size-buffer_size)/accu_duration
+                raised = True
                 break
+            j += 1
+
+        if raised:
+            rate = bandwidth/8.0
+            slack = rounding*(ys[-1] + rate*(xs[-1]+buffer_time))
+            tail = None
+        elif not current:
+            # nothing raised the bandwidth: the next segments are likely to be skipped
+            first = block*BANDWIDTH_BLOCK
+            tail = [ys[k] - rate*xs[k] for k in range(first, min(count, first+BANDWIDTH_BLOCK))]
+            for k in range(len(tail)-2, -1, -1):
+                tail[k] = max(tail[k], tail[k+1])
+            tail_block = block
+            after = peak_after(block, rate)
+
     return int(bandwidth)
 
 def MakeNewDir(dir, exit_if_exists=False, severity=None, recursive=False):
@@ -1230,6 +1522,8 @@ __all__ = [
     'Mp4Encrypt',
     'Mp42Hls',
     'Mp4IframeIndex',
+    'MapFile',
+    'ScanAtoms',
     'WalkAtoms',
     'Mp4Track',
     'Mp4File',
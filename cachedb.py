@@ -2,22 +2,23 @@
 #GNU GENERAL PUBLIC LICENSE Version 2
 #See file LICENCE or visit https://github.com/flipmcf/CasterPak/blob/master/LICENSE
 
-# ## TODO: [CasterPak 0.8.x Refactor] - Database Initialization & Concurrency
-# 1. Decouple Schema Creation: Move 'CREATE TABLE IF NOT EXISTS' out of the 
-#    request-level connection loop. It causes unnecessary locking in Docker.
-# 2. Permanent WAL Mode: Run 'PRAGMA journal_mode=WAL;' once during a dedicated 
-#    initialization phase (e.g., in app.py before Gunicorn forks).
-# 3. Connection Tuning: Ensure the SQLite context manager remains 'lean'—only 
-#    handling cursor yields and commits. Increase timeout to 10.0s for 
-#    containerized I/O overhead.
-# 4. Bootstrap Logic: Create a 'db.initialize()' method to be called once at 
-#    process start to handle items 1 & 2.
-
-
-from typing import Iterable
+# Connections:
+# Each process (and each thread in it) keeps its own long lived connection to the cache database,
+# opened on first use and tuned once: a busy timeout so workers wait for each other instead of failing,
+# and synchronous=NORMAL, which is safe under WAL and skips an fsync on every commit.
+# Reads can use a separate read-only connection.  sqlite3 caches the prepared statements of a connection
+# by their SQL text, so the queries below are written with parameters, never with values formatted in.
+# Connections are not carried across fork(); the child opens its own.
+
+
+from typing import Iterable, Iterator, Optional
+import os
+import json
+import atexit
 import datetime
 import sqlite3
 import logging
+import threading
 
 logger = logging.getLogger("casterpak cleanup")
 
@@ -25,17 +26,138 @@ logger = logging.getLogger("casterpak cleanup")
 SEGMENT_FILE_CACHE = 'segmentfile'
 INPUT_FILE_CACHE = 'inputfile'
 
+# seconds a connection waits for another process's write lock before giving up
+BUSY_TIMEOUT = 10.0
+# prepared statements kept per connection
+STATEMENT_CACHE_SIZE = 64
+
+# defaults for batching CacheDB.touch() writes, see configure_access_recorder()
+ACCESS_FLUSH_INTERVAL = 1.0   # seconds
+ACCESS_FLUSH_RECORDS = 500
+
+# rows per query when walking a cache from the oldest entry, see CacheDB.oldest_batches()
+OLDEST_BATCH_SIZE = 1000
+
+CACHE_TABLES = [SEGMENT_FILE_CACHE, INPUT_FILE_CACHE]
+
+# saved media analyses, see MediaAnalysisDB
+MEDIA_ANALYSIS_TABLE = 'mediaanalysis'
+
+# the packaging job queue, see PackagingJobDB
+PACKAGING_JOB_TABLE = 'packagingjob'
+
+
+def _add_timestamp_index(cursor, table_name):
+    # (timestamp, filename) covers find() and get_oldest(), neither has to scan or sort the table
+    cursor.execute(f"CREATE INDEX IF NOT EXISTS {table_name}_timestamp ON {table_name}(timestamp, filename)")
+
+
+def _add_size_ledger(cursor, table_name):
+    # bytes on disk of each entry, and a running total per cache kept up to date by triggers,
+    # so the cleaner doesn't have to walk the cache to know how full it is.
+    # Refreshing an entry's timestamp doesn't touch the size, so the hot path never writes the totals row.
+    cursor.execute("""CREATE TABLE IF NOT EXISTS cachesize (
+                      cache text PRIMARY KEY,
+                      bytes int NOT NULL DEFAULT 0,
+                      entries int NOT NULL DEFAULT 0,
+                      reconciled int NOT NULL DEFAULT 0)""")
+    cursor.execute(f"ALTER TABLE {table_name} ADD COLUMN size int NOT NULL DEFAULT 0")
+    cursor.execute(f"INSERT OR IGNORE INTO cachesize(cache, entries) "
+                   f"VALUES('{table_name}', (SELECT COUNT(*) FROM {table_name}))")
+    cursor.execute(f"""CREATE TRIGGER IF NOT EXISTS {table_name}_size_insert AFTER INSERT ON {table_name}
+                       BEGIN
+                           UPDATE cachesize SET bytes = bytes + NEW.size, entries = entries + 1
+                           WHERE cache = '{table_name}';
+                       END""")
+    cursor.execute(f"""CREATE TRIGGER IF NOT EXISTS {table_name}_size_update AFTER UPDATE OF size ON {table_name}
+                       BEGIN
+                           UPDATE cachesize SET bytes = bytes - OLD.size + NEW.size
+                           WHERE cache = '{table_name}';
+                       END""")
+    cursor.execute(f"""CREATE TRIGGER IF NOT EXISTS {table_name}_size_delete AFTER DELETE ON {table_name}
+                       BEGIN
+                           UPDATE cachesize SET bytes = bytes - OLD.size, entries = entries - 1
+                           WHERE cache = '{table_name}';
+                       END""")
+
+
+def _add_eviction_stats(cursor, table_name):
+    # how often each entry has been used, for eviction weighting, and what the last eviction pass did
+    cursor.execute(f"ALTER TABLE {table_name} ADD COLUMN hits int NOT NULL DEFAULT 0")
+    for column in ('evicted_at', 'evicted_entries', 'evicted_bytes'):
+        try:
+            cursor.execute(f"ALTER TABLE cachesize ADD COLUMN {column} int NOT NULL DEFAULT 0")
+        except sqlite3.OperationalError:
+            # added while migrating the other cache table
+            pass
+    try:
+        cursor.execute("ALTER TABLE cachesize ADD COLUMN eviction_seconds real NOT NULL DEFAULT 0")
+    except sqlite3.OperationalError:
+        pass
+
+
+def _add_media_analysis(cursor, table_name):
+    # what bento4 learned about each input file (tracks, codecs, segment statistics), keyed by the file's identity.
+    # Rows outlive the input files, so an evicted and re-fetched input isn't analyzed again.
+    cursor.execute(f"""CREATE TABLE IF NOT EXISTS {MEDIA_ANALYSIS_TABLE} (
+                       key text PRIMARY KEY,
+                       analysis text NOT NULL,
+                       timestamp int NOT NULL)""")
+    cursor.execute(f"CREATE INDEX IF NOT EXISTS {MEDIA_ANALYSIS_TABLE}_timestamp "
+                   f"ON {MEDIA_ANALYSIS_TABLE}(timestamp)")
+    if table_name == INPUT_FILE_CACHE:
+        # hash of a fetched input's content, the identity of inputs that don't have a stable mtime
+        cursor.execute(f"ALTER TABLE {table_name} ADD COLUMN content_hash text")
+
+
+def _add_packaging_jobs(cursor, table_name):
+    # packaging jobs queued by requests for the packager processes.  Finished jobs stay a while, so the
+    # requests waiting on them can read how they ended.  There is only ever one queued or running job per key:
+    # a request for the same output joins that one.
+    cursor.execute(f"""CREATE TABLE IF NOT EXISTS {PACKAGING_JOB_TABLE} (
+                       id integer PRIMARY KEY,
+                       key text NOT NULL,
+                       kind text NOT NULL,
+                       arguments text NOT NULL,
+                       priority int NOT NULL DEFAULT 0,
+                       state text NOT NULL DEFAULT 'queued',
+                       error text,
+                       worker text,
+                       created int NOT NULL,
+                       started int,
+                       finished int)""")
+    cursor.execute(f"CREATE UNIQUE INDEX IF NOT EXISTS {PACKAGING_JOB_TABLE}_active "
+                   f"ON {PACKAGING_JOB_TABLE}(key) WHERE state IN ('queued', 'running')")
+    cursor.execute(f"CREATE INDEX IF NOT EXISTS {PACKAGING_JOB_TABLE}_queue "
+                   f"ON {PACKAGING_JOB_TABLE}(state, priority, id)")
+
+
+# schema changes, in order.  The database's PRAGMA user_version is the number of migrations it has had.
+MIGRATIONS = [
+    _add_timestamp_index,
+    _add_size_ledger,
+    _add_eviction_stats,
+    _add_media_analysis,
+    _add_packaging_jobs,
+]
+
+
 def initialize_cache_db(dbname: str = 'cacheDB.db'):
     """Initialize the cache database with the necessary tables and WAL mode.
        This should be called once at application startup before any requests are handled.
+       Databases created by older versions are migrated to the current schema.
     """
     with SQLite(dbname) as cursor:
         # Enable Write-Ahead Logging for better concurrency
         cursor.execute("PRAGMA journal_mode=WAL;")
         logger.debug(f"Set journal_mode to WAL for database {dbname}")
 
+    with SQLite(dbname) as cursor:
+        # every worker runs this at start up.  Take the write lock first, so only one of them migrates.
+        cursor.execute("BEGIN IMMEDIATE")
+
         # Create tables for different caches if they don't exist
-        for cache_name in [SEGMENT_FILE_CACHE, INPUT_FILE_CACHE]:
+        for cache_name in CACHE_TABLES:
             table_name = ''.join(c for c in cache_name if c.isalnum())
             create_query = f"""CREATE TABLE IF NOT EXISTS {table_name} (
                                filename text PRIMARY KEY,
@@ -44,20 +166,77 @@ def initialize_cache_db(dbname: str = 'cacheDB.db'):
             cursor.execute(create_query)
             logger.debug(f"Ensured table '{table_name}' exists in database {dbname}")
 
+        cursor.execute("PRAGMA user_version")
+        version = cursor.fetchone()[0]
+        for number, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+            logger.info(f"migrating cache database {dbname} to schema version {number}")
+            for cache_name in CACHE_TABLES:
+                migration(cursor, ''.join(c for c in cache_name if c.isalnum()))
+            cursor.execute(f"PRAGMA user_version={number}")
+
+
 class SQLite(object):
-    def __init__(self, file='sqlite.db'):
+    """ context manager that yields a cursor on this thread's connection to 'file',
+        and commits (or rolls back, on an exception) when the block ends.
+        The connection stays open for the next caller.
+    """
+    def __init__(self, file='sqlite.db', readonly=False):
         self.file = file
+        self.readonly = readonly
 
     def __enter__(self):
-        ## TODO: handle connect timeout to avoid locking
-        self.conn = sqlite3.connect(self.file)  #timeout=5.0)
-        self.conn.row_factory = sqlite3.Row
-
-        return self.conn.cursor()
+        self.conn = get_connection(self.file, self.readonly)
+        self.cursor = self.conn.cursor()
+        return self.cursor
 
     def __exit__(self, exc_type, exc_value, traceback):
-        self.conn.commit()
-        self.conn.close()
+        self.cursor.close()
+        if exc_type is None:
+            self.conn.commit()
+        else:
+            self.conn.rollback()
+
+
+_connections = threading.local()
+# connections inherited over a fork.  Kept referenced so they are never closed in the child
+_abandoned_connections = []
+
+
+def connect(file: str, readonly: bool = False) -> sqlite3.Connection:
+    """ open and tune a new connection """
+    if readonly:
+        conn = sqlite3.connect(f"file:{os.path.abspath(file)}?mode=ro", uri=True,
+                               timeout=BUSY_TIMEOUT, cached_statements=STATEMENT_CACHE_SIZE)
+    else:
+        conn = sqlite3.connect(file, timeout=BUSY_TIMEOUT, cached_statements=STATEMENT_CACHE_SIZE)
+    conn.row_factory = sqlite3.Row
+    conn.execute(f"PRAGMA busy_timeout={int(BUSY_TIMEOUT * 1000)};")
+    if not readonly:
+        conn.execute("PRAGMA synchronous=NORMAL;")
+    logger.debug(f"opened {'read-only ' if readonly else ''}connection to {file} in process {os.getpid()}")
+    return conn
+
+
+def get_connection(file: str, readonly: bool = False) -> sqlite3.Connection:
+    """ :return: this thread's connection to 'file', opening it if needed """
+    try:
+        pool = _connections.pool
+    except AttributeError:
+        pool = _connections.pool = {}
+
+    key = (file, readonly)
+    conn = pool.get(key)
+    if conn is None:
+        conn = pool[key] = connect(file, readonly)
+    return conn
+
+
+def close_connections() -> None:
+    """ close this thread's connections """
+    pool = getattr(_connections, 'pool', {})
+    while pool:
+        _, conn = pool.popitem()
+        conn.close()
 
 
 class CacheDB(object):
@@ -85,9 +264,9 @@ class CacheDB(object):
         if timestamp is None:
             timestamp = int(datetime.datetime.now(datetime.timezone.utc).timestamp())
 
-        query = f"""INSERT INTO {self.table}
-                    VALUES(?, ?)
-                    ON CONFLICT(filename) DO UPDATE SET timestamp=excluded.timestamp
+        query = f"""INSERT INTO {self.table}(filename, timestamp, hits)
+                    VALUES(?, ?, 1)
+                    ON CONFLICT(filename) DO UPDATE SET timestamp=excluded.timestamp, hits=hits + 1
                  """
 
         with SQLite(self.dbname) as cursor:
@@ -96,19 +275,451 @@ class CacheDB(object):
     def find(self, age_in_minutes: int) -> Iterable[str]:
         then = int(datetime.datetime.now(datetime.timezone.utc).timestamp()) - age_in_minutes*60
 
-        with SQLite(self.dbname) as cursor:
+        with SQLite(self.dbname, readonly=True) as cursor:
             cursor.execute(f"SELECT filename FROM {self.table} WHERE timestamp < ?", (then,))
             return [row[0] for row in cursor.fetchall()]
 
     find_expired = find
 
-    def get_oldest(self, num: int) -> Iterable[str]:
-        """ Get the 'num' oldest files from the cache """
+    def get_oldest(self, num: int, after: tuple = None) -> Iterable[str]:
+        """ Get the 'num' oldest files from the cache
+
+        :param after: (timestamp, filename) of the last row of the previous batch, to get the next batch
+        """
+        return [row[1] for row in self._oldest_rows(num, after)]
+
+    def _oldest_rows(self, num: int, after: tuple = None) -> list:
+        """ :return: list of (timestamp, filename, size), oldest first """
+        with SQLite(self.dbname, readonly=True) as cursor:
+            if after is None:
+                cursor.execute(f"SELECT timestamp, filename, size FROM {self.table} "
+                               f"ORDER BY timestamp, filename LIMIT ?", (num,))
+            else:
+                cursor.execute(f"SELECT timestamp, filename, size FROM {self.table} "
+                               f"WHERE (timestamp, filename) > (?, ?) "
+                               f"ORDER BY timestamp, filename LIMIT ?", (after[0], after[1], num))
+            return [tuple(row) for row in cursor.fetchall()]
+
+    def oldest_batches(self, batch_size: int = OLDEST_BATCH_SIZE, with_size: bool = False) -> Iterator[list]:
+        """ walk the cache from the oldest entry, 'batch_size' filenames at a time.
+            Each batch is one indexed query that starts where the last one ended,
+            so records deleted between batches don't make it skip any.
+
+        :param with_size: yield lists of (filename, size) instead of filenames
+        """
+        after = None
+        while True:
+            rows = self._oldest_rows(batch_size, after)
+            if not rows:
+                return
+            if with_size:
+                yield [(filename, size) for timestamp, filename, size in rows]
+            else:
+                yield [filename for timestamp, filename, size in rows]
+            after = rows[-1][:2]
+
+    def eviction_candidates(self, bytes_to_free: int, hit_weight: float = 0, size_weight: float = 0) -> list:
+        """ plan an eviction pass in one query.
+
+        Entries are ranked by their last use, oldest first, and taken until they add up to 'bytes_to_free'.
+        The weights shift an entry's last use time in the ranking:
+
+        :param hit_weight: seconds of credit per hit.  Popular entries are kept longer.
+        :param size_weight: seconds of debit per MiB.  Big entries go sooner.
+        :return: list of (filename, size)
+        """
+        if bytes_to_free <= 0:
+            return []
+
+        if hit_weight or size_weight:
+            rank = "timestamp + :hit_weight * hits - :size_weight * size / 1048576.0, filename"
+        else:
+            # plain LRU reads the timestamp index in order, no sort
+            rank = "timestamp, filename"
+
+        with SQLite(self.dbname, readonly=True) as cursor:
+            cursor.execute(f"""SELECT filename, size FROM (
+                                   SELECT filename, size,
+                                          COALESCE(SUM(size) OVER (ORDER BY {rank}
+                                                   ROWS BETWEEN UNBOUNDED PRECEDING AND 1 PRECEDING), 0) AS freed
+                                   FROM {self.table})
+                               WHERE freed < :bytes_to_free
+                            """, {'bytes_to_free': bytes_to_free, 'hit_weight': hit_weight, 'size_weight': size_weight})
+            return [tuple(row) for row in cursor.fetchall()]
+
+    def record_eviction(self, entries: int, size: int, seconds: float) -> None:
+        """ keep the outcome of the last eviction pass in the cachesize table """
+        now = int(datetime.datetime.now(datetime.timezone.utc).timestamp())
         with SQLite(self.dbname) as cursor:
-            cursor.execute(f"SELECT filename FROM {self.table} order by timestamp limit {num} ")
-            return [row[0] for row in cursor.fetchall()]
+            cursor.execute("""UPDATE cachesize
+                              SET evicted_at = ?, evicted_entries = ?, evicted_bytes = ?, eviction_seconds = ?
+                              WHERE cache = ?""", (now, entries, size, seconds, self.table))
+
+    def set_size(self, filename: str, size: int) -> None:
+        """ record the bytes on disk of an entry, adding the entry if it's new """
+        now = int(datetime.datetime.now(datetime.timezone.utc).timestamp())
+        with SQLite(self.dbname) as cursor:
+            cursor.execute(f"""INSERT INTO {self.table}(filename, timestamp, size)
+                               VALUES(?, ?, ?)
+                               ON CONFLICT(filename) DO UPDATE SET size=excluded.size
+                            """, (filename, now, size))
+
+    def add_size(self, filename: str, size: int) -> None:
+        """ add 'size' bytes to an entry, eg: when one more segment has been written into it """
+        now = int(datetime.datetime.now(datetime.timezone.utc).timestamp())
+        with SQLite(self.dbname) as cursor:
+            cursor.execute(f"""INSERT INTO {self.table}(filename, timestamp, size)
+                               VALUES(?, ?, ?)
+                               ON CONFLICT(filename) DO UPDATE SET size=size + excluded.size
+                            """, (filename, now, size))
+
+    def total_size(self) -> int:
+        """ :return: bytes of all entries in this cache, according to the ledger """
+        with SQLite(self.dbname, readonly=True) as cursor:
+            cursor.execute("SELECT bytes FROM cachesize WHERE cache = ?", (self.table,))
+            row = cursor.fetchone()
+            return row[0] if row else 0
+
+    def last_reconciled(self) -> int:
+        """ :return: the time reconcile_sizes() last ran for this cache, 0 if never """
+        with SQLite(self.dbname, readonly=True) as cursor:
+            cursor.execute("SELECT reconciled FROM cachesize WHERE cache = ?", (self.table,))
+            row = cursor.fetchone()
+            return row[0] if row else 0
+
+    def reconcile_sizes(self, sizes: dict) -> None:
+        """ replace every entry's size with what is actually on disk, in one transaction.
+
+        :param sizes: {filename: bytes} found by scanning the cache.  Entries not in it have nothing on disk.
+        """
+        now = int(datetime.datetime.now(datetime.timezone.utc).timestamp())
+        with SQLite(self.dbname) as cursor:
+            cursor.execute("BEGIN IMMEDIATE")
+            cursor.execute(f"SELECT filename, size FROM {self.table}")
+            changed = [(sizes.get(filename, 0), filename) for filename, size in cursor.fetchall()
+                       if sizes.get(filename, 0) != size]
+            cursor.executemany(f"UPDATE {self.table} SET size = ? WHERE filename == ?", changed)
+            # the running total is maintained by triggers.  Set it outright in case it ever drifted.
+            cursor.execute(f"""UPDATE cachesize
+                               SET bytes = (SELECT COALESCE(SUM(size), 0) FROM {self.table}),
+                                   entries = (SELECT COUNT(*) FROM {self.table}),
+                                   reconciled = ?
+                               WHERE cache = ?""", (now, self.table))
+        logger.info(f"reconciled {self.table}: {len(changed)} entries changed size")
+
+    def set_content_hash(self, filename: str, content_hash: str) -> None:
+        """ record the content hash of an entry, adding the entry if it's new """
+        now = int(datetime.datetime.now(datetime.timezone.utc).timestamp())
+        with SQLite(self.dbname) as cursor:
+            cursor.execute(f"""INSERT INTO {self.table}(filename, timestamp, content_hash)
+                               VALUES(?, ?, ?)
+                               ON CONFLICT(filename) DO UPDATE SET content_hash=excluded.content_hash
+                            """, (filename, now, content_hash))
+
+    def content_hash(self, filename: str) -> Optional[str]:
+        """ :return: the content hash recorded for an entry, or None """
+        with SQLite(self.dbname, readonly=True) as cursor:
+            cursor.execute(f"SELECT content_hash FROM {self.table} WHERE filename == ?", (filename,))
+            row = cursor.fetchone()
+            return row[0] if row else None
 
     def delrecord(self, filename: str) -> None:
         """Remove cache record for 'filename'"""
         with SQLite(self.dbname) as cursor:
             cursor.execute(f"DELETE FROM {self.table} WHERE filename == ?", (filename,))
+
+    def delrecords(self, filenames: Iterable[str]) -> None:
+        """Remove the cache records of all 'filenames' in one transaction"""
+        with SQLite(self.dbname) as cursor:
+            cursor.executemany(f"DELETE FROM {self.table} WHERE filename == ?",
+                               [(filename,) for filename in filenames])
+
+    def touch(self, filename: str = None, timestamp: int = None) -> None:
+        """ Like addrecord, but the write is batched with other touches by this process.
+            Use this on the request path; the record shows up in the database within ACCESS_FLUSH_INTERVAL.
+        """
+        if filename is None:
+            raise ValueError('filename must be specified to add a cache record')
+
+        recorder = get_access_recorder(self.dbname)
+        if recorder.flush_interval <= 0:
+            # batching turned off
+            self.addrecord(filename=filename, timestamp=timestamp)
+            return
+        recorder.record(self.table, filename, timestamp)
+
+
+class MediaAnalysisDB(object):
+    """ Saved media analyses: what bento4 found out about an input file, so it is only worked out once.
+
+        The key is whatever identifies the file's content, eg: its path, size and mtime.
+        An analysis is a json serializable dict.
+    """
+
+    def __init__(self, dbname: str = 'cacheDB.db') -> None:
+        self.dbname = dbname
+
+    def get(self, key: str) -> Optional[dict]:
+        """ :return: the analysis saved under 'key', or None """
+        now = int(datetime.datetime.now(datetime.timezone.utc).timestamp())
+        with SQLite(self.dbname) as cursor:
+            cursor.execute(f"SELECT analysis FROM {MEDIA_ANALYSIS_TABLE} WHERE key == ?", (key,))
+            row = cursor.fetchone()
+            if row is None:
+                return None
+            # keep analyses that are in use.  Only master playlist requests get here, so don't bother batching
+            cursor.execute(f"UPDATE {MEDIA_ANALYSIS_TABLE} SET timestamp = ? WHERE key == ?", (now, key))
+        return json.loads(row[0])
+
+    def put(self, key: str, analysis: dict) -> None:
+        now = int(datetime.datetime.now(datetime.timezone.utc).timestamp())
+        with SQLite(self.dbname) as cursor:
+            cursor.execute(f"""INSERT INTO {MEDIA_ANALYSIS_TABLE}(key, analysis, timestamp)
+                               VALUES(?, ?, ?)
+                               ON CONFLICT(key) DO UPDATE SET analysis=excluded.analysis, timestamp=excluded.timestamp
+                            """, (key, json.dumps(analysis, separators=(',', ':')), now))
+
+    def prune(self, age_in_minutes: int) -> int:
+        """ remove analyses that haven't been used for 'age_in_minutes'
+
+        :return: number of analyses removed
+        """
+        then = int(datetime.datetime.now(datetime.timezone.utc).timestamp()) - age_in_minutes*60
+        with SQLite(self.dbname) as cursor:
+            cursor.execute(f"DELETE FROM {MEDIA_ANALYSIS_TABLE} WHERE timestamp < ?", (then,))
+            return cursor.rowcount
+
+
+class PackagingJobDB(object):
+    """ The packaging job queue: requests add jobs, the packager processes (vodhls.packager) run them.
+
+        A job is a 'kind' of packaging and its json serializable 'arguments', see vodhls.jobs.
+        It goes from 'queued' to 'running' to 'done' or 'failed'.  Lower priorities run first.
+    """
+
+    def __init__(self, dbname: str = 'cacheDB.db') -> None:
+        self.dbname = dbname
+
+    def enqueue(self, kind: str, key: str, arguments: dict, priority: int = 0) -> int:
+        """ queue a job, unless one for the same key is already queued or running
+
+        :param key: identifies the output the job makes.  Jobs for the same key are the same job
+        :return: the id of the new job, or of the one that was already there.
+        A queued job that is joined by a more urgent one (eg: a request for a segment that was queued
+        to be cut ahead) takes its kind and priority.
+        """
+        now = int(datetime.datetime.now(datetime.timezone.utc).timestamp())
+        while True:
+            with SQLite(self.dbname) as cursor:
+                cursor.execute(f"""INSERT OR IGNORE INTO {PACKAGING_JOB_TABLE}(key, kind, arguments, priority, created)
+                                   VALUES(?, ?, ?, ?, ?)""",
+                               (key, kind, json.dumps(arguments, separators=(',', ':')), priority, now))
+                if cursor.rowcount:
+                    return cursor.lastrowid
+                cursor.execute(f"""SELECT id FROM {PACKAGING_JOB_TABLE}
+                                   WHERE key == ? AND state IN ('queued', 'running')""", (key,))
+                row = cursor.fetchone()
+                if row is not None:
+                    cursor.execute(f"""UPDATE {PACKAGING_JOB_TABLE} SET kind = ?, priority = ?
+                                       WHERE id == ? AND state == 'queued' AND priority > ?""",
+                                   (kind, priority, row[0], priority))
+            if row is not None:
+                return row[0]
+            # the job we were joining finished in between, queue another
+
+    def claim(self, worker: str, stale_after: int = None) -> Optional[dict]:
+        """ take the next job off the queue
+
+        :param worker: recorded with the job, see requeue()
+        :param stale_after: seconds after which a running job is presumed dead and can be claimed again
+        :return: the job (id, kind, key, arguments), or None if there is nothing to do
+        """
+        now = int(datetime.datetime.now(datetime.timezone.utc).timestamp())
+        with SQLite(self.dbname) as cursor:
+            cursor.execute("BEGIN IMMEDIATE")
+            cursor.execute(f"""SELECT id, kind, key, arguments FROM {PACKAGING_JOB_TABLE}
+                               WHERE state == 'queued' ORDER BY priority, id LIMIT 1""")
+            row = cursor.fetchone()
+            if row is None and stale_after is not None:
+                cursor.execute(f"""SELECT id, kind, key, arguments FROM {PACKAGING_JOB_TABLE}
+                                   WHERE state == 'running' AND started < ? ORDER BY priority, id LIMIT 1""",
+                               (now - stale_after,))
+                row = cursor.fetchone()
+                if row is not None:
+                    logger.warning(f"packaging job {row['id']} ({row['key']}) ran for over {stale_after}s, "
+                                   f"running it again")
+            if row is None:
+                return None
+            cursor.execute(f"""UPDATE {PACKAGING_JOB_TABLE} SET state = 'running', started = ?, worker = ?
+                               WHERE id == ?""", (now, worker, row['id']))
+        return {'id': row['id'], 'kind': row['kind'], 'key': row['key'], 'arguments': json.loads(row['arguments'])}
+
+    def finish(self, job_id: int, error: str = None) -> None:
+        """ :param error: the name of the error the job failed with, None if it succeeded """
+        now = int(datetime.datetime.now(datetime.timezone.utc).timestamp())
+        with SQLite(self.dbname) as cursor:
+            cursor.execute(f"""UPDATE {PACKAGING_JOB_TABLE} SET state = ?, error = ?, finished = ?
+                               WHERE id == ?""", ('failed' if error else 'done', error, now, job_id))
+
+    def get(self, job_id: int) -> Optional[dict]:
+        """ :return: the job's state and error, None if it has been pruned """
+        with SQLite(self.dbname, readonly=True) as cursor:
+            cursor.execute(f"SELECT state, error FROM {PACKAGING_JOB_TABLE} WHERE id == ?", (job_id,))
+            row = cursor.fetchone()
+            return dict(row) if row else None
+
+    def requeue(self, worker: str = None) -> int:
+        """ put running jobs back on the queue, after the packager running them died
+
+        :param worker: only the jobs of this worker, None for every running job
+        :return: number of jobs queued again
+        """
+        with SQLite(self.dbname) as cursor:
+            if worker is None:
+                cursor.execute(f"UPDATE {PACKAGING_JOB_TABLE} SET state = 'queued' WHERE state == 'running'")
+            else:
+                cursor.execute(f"""UPDATE {PACKAGING_JOB_TABLE} SET state = 'queued'
+                                   WHERE state == 'running' AND worker == ?""", (worker,))
+            return cursor.rowcount
+
+    def prune(self, age_in_minutes: int) -> int:
+        """ remove jobs that finished more than 'age_in_minutes' ago
+
+        :return: number of jobs removed
+        """
+        then = int(datetime.datetime.now(datetime.timezone.utc).timestamp()) - age_in_minutes*60
+        with SQLite(self.dbname) as cursor:
+            cursor.execute(f"""DELETE FROM {PACKAGING_JOB_TABLE}
+                               WHERE state IN ('done', 'failed') AND finished < ?""", (then,))
+            return cursor.rowcount
+
+
+class AccessRecorder(object):
+    """ Coalesces cache 'touches' in memory and writes them to the database in one transaction.
+
+        A touch only moves a record's timestamp forward, so many touches of the same file
+        between flushes become a single row write.  Pending touches are written every flush_interval seconds
+        by a background thread, as soon as max_pending different files have been touched,
+        and when the process exits.
+    """
+
+    def __init__(self, dbname: str = 'cacheDB.db', flush_interval: float = ACCESS_FLUSH_INTERVAL,
+                 max_pending: int = ACCESS_FLUSH_RECORDS) -> None:
+        self.dbname = dbname
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self._reset()
+
+    def _reset(self) -> None:
+        """ start with nothing pending and no flush thread.  Also used in a newly forked child """
+        self.lock = threading.Lock()
+        self.pending = {}   # (table, filename): timestamp
+        self.wakeup = threading.Event()
+        self.thread = None
+
+    def record(self, table: str, filename: str, timestamp: int = None) -> None:
+        if timestamp is None:
+            timestamp = int(datetime.datetime.now(datetime.timezone.utc).timestamp())
+
+        key = (table, filename)
+        with self.lock:
+            touched = self.pending.get(key)
+            if touched is None:
+                self.pending[key] = [timestamp, 1]
+            else:
+                touched[0] = max(touched[0], timestamp)
+                touched[1] += 1
+            pending_count = len(self.pending)
+
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name='cachedb-access-recorder', daemon=True)
+                self.thread.start()
+
+        if pending_count >= self.max_pending:
+            self.wakeup.set()
+
+    def flush(self) -> None:
+        """ write every pending touch in one transaction """
+        with self.lock:
+            pending, self.pending = self.pending, {}
+        if not pending:
+            return
+
+        by_table = {}
+        for (table, filename), (timestamp, hits) in pending.items():
+            by_table.setdefault(table, []).append((filename, timestamp, hits))
+
+        try:
+            with SQLite(self.dbname) as cursor:
+                for table, rows in by_table.items():
+                    # another process may have written a newer touch already, never move a timestamp back
+                    cursor.executemany(f"""INSERT INTO {table}(filename, timestamp, hits)
+                                           VALUES(?, ?, ?)
+                                           ON CONFLICT(filename) DO UPDATE
+                                           SET timestamp=MAX(timestamp, excluded.timestamp),
+                                               hits=hits + excluded.hits
+                                        """, rows)
+        except sqlite3.Error:
+            logger.exception(f"could not write {len(pending)} cache records, will retry")
+            with self.lock:
+                for key, (timestamp, hits) in pending.items():
+                    touched = self.pending.setdefault(key, [timestamp, 0])
+                    touched[0] = max(touched[0], timestamp)
+                    touched[1] += hits
+            return
+
+        logger.debug(f"wrote {len(pending)} cache records")
+
+    def _run(self) -> None:
+        while True:
+            self.wakeup.wait(self.flush_interval)
+            self.wakeup.clear()
+            try:
+                self.flush()
+            except Exception:
+                logger.exception("cache access recorder flush failed")
+
+
+_access_recorders = {}
+_access_recorder_settings = {}
+
+
+def configure_access_recorder(flush_interval: float = ACCESS_FLUSH_INTERVAL,
+                              max_pending: int = ACCESS_FLUSH_RECORDS) -> None:
+    """ set how CacheDB.touch() batches its writes, for recorders created after this call.
+    :param flush_interval: seconds between writes.  0 turns batching off, every touch is written immediately.
+    :param max_pending: write as soon as this many different files are waiting
+    """
+    _access_recorder_settings['flush_interval'] = flush_interval
+    _access_recorder_settings['max_pending'] = max_pending
+    for recorder in _access_recorders.values():
+        recorder.flush_interval = flush_interval
+        recorder.max_pending = max_pending
+
+
+def get_access_recorder(dbname: str = 'cacheDB.db') -> AccessRecorder:
+    recorder = _access_recorders.get(dbname)
+    if recorder is None:
+        recorder = _access_recorders.setdefault(dbname, AccessRecorder(dbname, **_access_recorder_settings))
+    return recorder
+
+
+def flush_access_records() -> None:
+    """ write all pending touches now.  Called at process exit, and from gunicorn's worker_exit hook """
+    for recorder in list(_access_recorders.values()):
+        recorder.flush()
+
+
+def _after_fork_in_child() -> None:
+    global _connections
+    # sqlite connections must not be used across a fork, and closing them here could disturb the parent's locks
+    _abandoned_connections.append(_connections)
+    _connections = threading.local()
+
+    # the flush thread doesn't survive a fork, and the parent's pending touches are the parent's to write
+    for recorder in _access_recorders.values():
+        recorder._reset()
+
+
+atexit.register(flush_access_records)
+os.register_at_fork(after_in_child=_after_fork_in_child)
@@ -76,6 +76,9 @@ def create_app(test_config=None):
     # initialize the cache database
     app.logger.info(f"initializing cache database")
     cachedb.initialize_cache_db()
+    cachedb.configure_access_recorder(
+        flush_interval=app.config['cache'].getint('access_flush_interval', fallback=1000) / 1000.0,
+        max_pending=app.config['cache'].getint('access_flush_records', fallback=500))
 
     if __name__ != "__main__":
         setup_gunicorn_logging(app, base_config)
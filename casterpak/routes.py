@@ -1,11 +1,15 @@
 import os
 import re
+import functools
 import typing as t
+from urllib.parse import quote
 
-from flask import Blueprint, abort, current_app, send_from_directory, send_file
+from flask import Blueprint, Response, abort, current_app, send_file
+from werkzeug.exceptions import ServiceUnavailable
 
 import cachedb
-from vodhls import EncodingError
+from vodhls import EncodingError, LockTimeout, PackagingPending
+from vodhls import jobs
 from vodhls.factory import (vodhls_master_playlist_factory,
                             vodhls_media_playlist_factory)
 
@@ -31,6 +35,31 @@ def get_base_url(dir_name: t.Union[os.PathLike, str]) -> str:
     return baseurl
 
 
+def send_output_file(path: t.Union[os.PathLike, str], mimetype: str) -> Response:
+    """ respond with a file under segmentParentPath.
+
+    With [output] delivery = x-accel-redirect (or x-sendfile) only the headers are sent from here,
+    and the web server in front of us sends the file.  The worker is free as soon as the headers are out.
+    """
+    output_config = current_app.config['output']
+    delivery = output_config.get('delivery', fallback='flask')
+
+    relative_path = os.path.relpath(path, output_config['segmentParentPath'])
+    if relative_path.startswith(os.pardir):
+        abort(404)
+
+    if delivery == 'x-accel-redirect':
+        prefix = output_config.get('accel_redirect_prefix', fallback='/_segments/')
+        if not prefix.endswith('/'):
+            prefix += '/'
+        return Response(headers={'X-Accel-Redirect': prefix + quote(relative_path)}, mimetype=mimetype)
+
+    if delivery == 'x-sendfile':
+        return Response(headers={'X-Sendfile': os.path.abspath(path)}, mimetype=mimetype)
+
+    return send_file(path, mimetype=mimetype)
+
+
 @bp.route('/i/<path:dir_name>')
 def mp4_file(dir_name: t.Union[os.PathLike, str]):
     """Path directly to MP4 file, without a stream"""
@@ -53,16 +82,20 @@ def single_bitrate_manifest(dir_name: str):
     vodhls_manager = vodhls_master_playlist_factory(files, dirname)
 
     if not vodhls_manager.manifest_exists():
-        vodhls_manager.set_baseurl(get_base_url(dirname))
-
         try:
-            vodhls_manager.output_hls()
+            jobs.run('master', os.path.join(vodhls_manager.output_dir, vodhls_manager.master_playlist_name),
+                     files=files, output_dir=dirname, baseurl=get_base_url(dirname))
         except FileNotFoundError:
             abort(404)
+        except EncodingError:
+            abort(500)
+        except LockTimeout:
+            abort(503)
+        except PackagingPending as e:
+            raise ServiceUnavailable(retry_after=e.retry_after)
 
-    return send_from_directory(directory=vodhls_manager.output_dir,
-                               path=vodhls_manager.master_playlist_name,
-                               mimetype="application/vnd.apple.mpegurl")
+    return send_output_file(os.path.join(vodhls_manager.output_dir, vodhls_manager.master_playlist_name),
+                            mimetype="application/vnd.apple.mpegurl")
 
 
 @bp.route('/i/<path:csmil_str>.csmil/master.m3u8')
@@ -83,23 +116,20 @@ def csmil_parent_manifest(csmil_str: str):
     vodhls_manager = vodhls_master_playlist_factory(files, dir)
 
     if not vodhls_manager.manifest_exists():
-        vodhls_manager.set_baseurl(get_base_url(dir))
-
         try:
-            vodhls_manager.output_hls()
+            jobs.run('master', os.path.join(vodhls_manager.output_dir, vodhls_manager.master_playlist_name),
+                     files=files, output_dir=dir, baseurl=get_base_url(dir))
         except FileNotFoundError:
             abort(404)
+        except EncodingError:
+            abort(500)
+        except LockTimeout:
+            abort(503)
+        except PackagingPending as e:
+            raise ServiceUnavailable(retry_after=e.retry_after)
 
-        for manager in vodhls_manager.segment_managers:
-            if manager['status'] != 'ready':
-                continue
-            segment_dir_name = manager['segment_manager'].filename
-            db = cachedb.CacheDB(cache_name=cachedb.SEGMENT_FILE_CACHE)
-            db.addrecord(filename=segment_dir_name)
-
-    return send_from_directory(directory=vodhls_manager.output_dir,
-                               path=vodhls_manager.master_playlist_name,
-                               mimetype="application/vnd.apple.mpegurl")
+    return send_output_file(os.path.join(vodhls_manager.output_dir, vodhls_manager.master_playlist_name),
+                            mimetype="application/vnd.apple.mpegurl")
 
 
 @bp.route('/i/<path:dir_name>/index_0_av.m3u8')
@@ -115,21 +145,24 @@ def child_manifest(dir_name: t.Union[os.PathLike, str]):
         current_app.logger.info(f'{str(e)}')
         abort(500)
 
-    hls_manager.set_baseurl(get_base_url(dir_name))
-
     if not hls_manager.manifest_exists():
         try:
-            hls_manager.create()
+            jobs.run('rendition', hls_manager.output_manifest_filename,
+                     filename=dir_name, baseurl=get_base_url(dir_name))
         except EncodingError:
             abort(500)
         except FileNotFoundError:
             abort(404)
+        except LockTimeout:
+            abort(503)
+        except PackagingPending as e:
+            raise ServiceUnavailable(retry_after=e.retry_after)
 
     db = cachedb.CacheDB(cache_name=cachedb.SEGMENT_FILE_CACHE)
-    db.addrecord(filename=dir_name)
+    db.touch(filename=dir_name)
 
-    return send_file(hls_manager.output_manifest_filename,
-                     mimetype="application/vnd.apple.mpegurl")
+    return send_output_file(hls_manager.output_manifest_filename,
+                            mimetype="application/vnd.apple.mpegurl")
 
 
 @bp.route('/i/<path:dir_name>/<string:filename>.ts')
@@ -148,19 +181,40 @@ def segment(dir_name: t.Union[os.PathLike, str], filename: str):
     if not hls_manager.segment_exists(filename):
         current_app.logger.info(f"request for segment {filepath} that does not exist. creating manifest")
 
-        hls_manager.set_baseurl(get_base_url(dir_name))
+        if hls_manager.jit_packaging:
+            key = os.path.join(hls_manager.output_dir, filename)
+        else:
+            # mp42hls packages the whole rendition at once: all its segments (and its playlist) share one job
+            key = hls_manager.output_manifest_filename
         try:
-            hls_manager.create()
+            jobs.run('segment', key, filename=dir_name, baseurl=get_base_url(dir_name), segment=filename)
         except EncodingError:
             abort(500)
+        except FileNotFoundError:
+            abort(404)
+        except LockTimeout:
+            abort(503)
+        except PackagingPending as e:
+            raise ServiceUnavailable(retry_after=e.retry_after)
 
     db = cachedb.CacheDB(cache_name=cachedb.SEGMENT_FILE_CACHE)
-    db.addrecord(filename=dir_name)
+    db.touch(filename=dir_name)
+
+    response = send_output_file(os.path.join(current_app.config['output']['segmentParentPath'], filepath),
+                                mimetype="video/MP2T")
+
+    if hls_manager.jit_packaging and hls_manager.jit_lookahead:
+        # cut the next few segments in the background, once this one has been sent
+        hls_manager.set_baseurl(get_base_url(dir_name))
+        lookahead = functools.partial(hls_manager.schedule_segments_ahead, filename)
+        if response.direct_passthrough:
+            # send_file() hands its file straight to the server, which never closes the response.
+            # Scheduling only hands the work over, this request doesn't wait for it
+            lookahead()
+        else:
+            response.call_on_close(lookahead)
 
-    return send_from_directory(directory=current_app.config['output']['segmentParentPath'],
-                               path=filepath,
-                               mimetype="video/MP2T"
-                               )
+    return response
 
 
 @bp.route('/i/<path:dir_name>/figure/this/out/media.m3u8')
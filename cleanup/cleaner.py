@@ -5,18 +5,27 @@
 # cleanup/cleaner.py
 import sys
 import os
+import json
 import logging
 import typing as t
-import subprocess
 import shutil
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 
 import config
 import cachedb
+from vodhls.media_manifest_base import STAGING_DIR
+from vodhls.locking import LOCK_DIR, prune_lock_files
+from vodhls.segmenter import SIDECAR_SUFFIX
 
 app_config = config.get_config()
 logger = logging.getLogger('CasterPak-cleanup')
 
+# how far into the nginx access log the cleanup has read.  Kept in segmentParentPath unless
+# [cache] nginx_access_log_state says where.
+ACCESS_LOG_STATE_FILE = '.nginx_access_log.offset'
+
 if app_config.get('application', 'debug', fallback=False):
     logger.setLevel(logging.DEBUG)
 
@@ -30,24 +39,94 @@ def run_cleanup():
         logger.error(f'cleanup exited with Error: \n {err}')
 
 
-def get_disk_usage(path: t.Union[os.PathLike, str]) -> int:
-    """ get the total file size of the directory."""
+def scan_directory_sizes(path: t.Union[os.PathLike, str]) -> t.Dict[str, int]:
+    """ walk 'path' once.
 
-    if not os.path.exists(path):
-        logger.debug(f"directory {path} does not exist, returning 0 usage")
-        return 0
-    # This will only work on posix / linux - but that's ok.  It's efficient.
-    size = subprocess.check_output(['du', '-BM', '--max-depth=0', path]).split()[0]
+    :return: {directory relative to path: bytes of the files directly in it}
+    Hidden directories (staging, locks) are skipped.
+    """
+    sizes = {}
+    for dirpath, dirnames, filenames in os.walk(path):
+        dirnames[:] = [name for name in dirnames if not name.startswith('.')]
+        total = 0
+        for name in filenames:
+            try:
+                total += os.lstat(os.path.join(dirpath, name)).st_size
+            except FileNotFoundError:
+                pass
+        sizes[os.path.relpath(dirpath, path)] = total
+    return sizes
+
+
+def scan_file_sizes(path: t.Union[os.PathLike, str]) -> t.Dict[str, int]:
+    """ walk 'path' once.
+
+    :return: {file relative to path: bytes}.  A segment index sidecar is counted with its input file.
+    """
+    sizes = {}
+    for dirpath, dirnames, filenames in os.walk(path):
+        dirnames[:] = [name for name in dirnames if not name.startswith('.')]
+        for name in filenames:
+            try:
+                size = os.lstat(os.path.join(dirpath, name)).st_size
+            except FileNotFoundError:
+                continue
+            filename = os.path.relpath(os.path.join(dirpath, name), path)
+            if filename.endswith(SIDECAR_SUFFIX):
+                filename = filename[:-len(SIDECAR_SUFFIX)]
+            sizes[filename] = sizes.get(filename, 0) + size
+    return sizes
+
+
+def read_access_log(path: t.Union[os.PathLike, str], state_file: t.Union[os.PathLike, str]) -> t.List[t.Tuple[str, int]]:
+    """ read what nginx has appended to its 'casterpak_hits' access log since the last call.
+
+    Each line is '<time in seconds> <rendition directory>' (see nginx/conf.d/default.conf).
+    The offset read up to is kept in state_file.  If the log was rotated (a new inode) or truncated,
+    it is read from the start: the lines written to the old file after the last call are lost,
+    which only makes those renditions look a little older than they are.
+
+    :return: [(rendition directory, unix timestamp)]
+    """
+    try:
+        with open(state_file) as f:
+            state = json.load(f)
+    except (FileNotFoundError, ValueError):
+        state = {}
 
-    # size is a string like '120M' for 120 megabytes.
-    # strip off that 'M' and return an integer
-    ## Don't fix this - the subprocess call forces Megabytes
-    return int(size[:-1])
+    try:
+        f = open(path, 'rb')
+    except FileNotFoundError:
+        logger.debug(f"no access log at {path}")
+        return []
+
+    with f:
+        st = os.fstat(f.fileno())
+        offset = state.get('offset', 0)
+        if state.get('inode') != st.st_ino or offset > st.st_size:
+            offset = 0
+        f.seek(offset)
+        data = f.read()
+
+    # a line nginx is still writing is left for next time
+    end = data.rfind(b'\n') + 1
+    accesses = []
+    for line in data[:end].decode('utf-8', errors='replace').splitlines():
+        try:
+            timestamp, filename = line.split(' ', 1)
+            accesses.append((filename.strip('/'), int(float(timestamp))))
+        except ValueError:
+            logger.debug(f"skipping access log line {line!r}")
+
+    with open(state_file, 'w') as f:
+        json.dump({'inode': st.st_ino, 'offset': offset + end}, f)
+    return accesses
 
 
 class CacheCleaner(object):
     def __init__(self):
         ## TODO - scan the filesystem for files that do no exist in the cache_db, and remove them.
+        app_config = config.get_config()
         output_config = app_config['output']
         input_config = app_config['input']
         cache_config = app_config['cache']
@@ -68,33 +147,89 @@ class CacheCleaner(object):
         self.input_file_age = cache_config.getint('input_file_age', fallback=8640)
         self.input_cache_size = cache_config.getint('input_file_cache_size', fallback=8192)
         self.input_cache_threshold = cache_config.getint('input_file_cache_limit', fallback=90)
+        self.staging_age = cache_config.getint('staging_file_age', fallback=720)
+        self.lock_age = output_config.getfloat('lock_timeout', fallback=300.0)
+        self.reconcile_interval = cache_config.getint('reconcile_interval', fallback=1440)
+        self.eviction_hit_weight = cache_config.getfloat('eviction_hit_weight', fallback=0)
+        self.eviction_size_weight = cache_config.getfloat('eviction_size_weight', fallback=0)
+        self.delete_threads = cache_config.getint('delete_threads', fallback=4)
+        self.analysis_age = cache_config.getint('analysis_age', fallback=43200)
+        self.nginx_access_log = cache_config.get('nginx_access_log', fallback='')
+        self.access_log_state = cache_config.get('nginx_access_log_state', fallback='') or \
+            os.path.join(output_config.get('segmentParentPath', ''), ACCESS_LOG_STATE_FILE)
 
         self.segment_db = cachedb.CacheDB(cache_name=cachedb.SEGMENT_FILE_CACHE)
         self.input_file_db = cachedb.CacheDB(cache_name=cachedb.INPUT_FILE_CACHE)
+        self.analysis_db = cachedb.MediaAnalysisDB()
 
     def clean(self):
+        self.collect_access_log()
+        self.clean_staging()
+        self.clean_locks()
+
         files = self.get_old_segment_files()
         logger.debug(f"segment files to clean: {files}")
-        for file in files:
-            self.delete_segment(file)
+        self.delete_segments(files)
 
         files = self.get_old_input_files()
         logger.debug(f"input files to clean {files}")
-        for file in files:
-            self.delete_input(file)
+        self.delete_inputs(files)
+
+        self.reconcile()
 
-        while self.segment_cache_threshold_reached:
+        removed = self.analysis_db.prune(self.analysis_age)
+        logger.debug(f"removed {removed} unused media analyses")
+
+        excess = self.segment_cache_excess
+        if excess > 0:
             logger.warning("segment cache threshold reached. consider increasing segment cache size")
-            file = self.get_oldest_segment_file()
-            self.delete_segment(file)
+            self.evict(self.segment_db, excess, self.delete_segments)
 
-        while self.input_cache_threshold_reached:
+        excess = self.input_cache_excess
+        if excess > 0:
             logger.warning("input file cache threshold reached. consider increasing input file cache size")
-            file = self.get_oldest_input_file()
-            self.delete_input(file)
+            self.evict(self.input_file_db, excess, self.delete_inputs)
 
         return 0
 
+    def collect_access_log(self) -> None:
+        """ segments and manifests nginx sent by itself never reached casterpak.
+            Count them as cache hits, from nginx's access log, before deciding what to evict.
+        """
+        if not self.nginx_access_log:
+            return
+
+        accesses = read_access_log(self.nginx_access_log, self.access_log_state)
+        for filename, timestamp in accesses:
+            self.segment_db.touch(filename=filename, timestamp=timestamp)
+        cachedb.flush_access_records()
+        logger.debug(f"recorded {len(accesses)} hits from {self.nginx_access_log}")
+
+    def evict(self, db: cachedb.CacheDB, excess: int, delete: t.Callable[[t.List[str]], t.List[str]]) -> None:
+        """ free at least 'excess' bytes from a cache: plan the whole pass in one query, then delete it """
+        start = time.monotonic()
+        victims = db.eviction_candidates(excess, hit_weight=self.eviction_hit_weight,
+                                         size_weight=self.eviction_size_weight)
+        removed = set(delete([filename for filename, size in victims]))
+        elapsed = time.monotonic() - start
+
+        freed = sum(size for filename, size in victims if filename in removed)
+        logger.info(f"evicted {len(removed)} entries, {freed // (1024 * 1024)}M from {db.table} in {elapsed:.2f}s")
+        db.record_eviction(len(removed), freed, elapsed)
+
+    def reconcile(self):
+        """ The size ledger in the cache database is kept up to date as files are written and deleted.
+            Every reconcile_interval minutes, correct it against what is really on disk.
+        """
+        now = time.time()
+        if now - self.segment_db.last_reconciled() >= self.reconcile_interval * 60:
+            logger.info(f"reconciling segment cache sizes with {self.output_dir}")
+            self.segment_db.reconcile_sizes(scan_directory_sizes(self.output_dir))
+
+        if now - self.input_file_db.last_reconciled() >= self.reconcile_interval * 60:
+            logger.info(f"reconciling input cache sizes with {self.input_dir}")
+            self.input_file_db.reconcile_sizes(scan_file_sizes(self.input_dir))
+
     def get_old_segment_files(self):
         return self.segment_db.find(self.segment_file_age)
 
@@ -110,6 +245,19 @@ class CacheCleaner(object):
         return result[0]
 
     def delete_segment(self, file):
+        self.delete_segments([file])
+
+    def delete_segments(self, files) -> t.List[str]:
+        """ remove the segment directories of 'files', then their cache records in one transaction.
+            The records of directories that could not be removed stay, for the next pass.
+
+        :return: the files removed
+        """
+        removed = self.run_parallel(self._delete_segment_dir, files)
+        self.segment_db.delrecords(removed)
+        return removed
+
+    def _delete_segment_dir(self, file):
         logger.debug(f"asked to delete segments {file}")
 
         segment_dir = os.path.join(self.output_dir, file)
@@ -118,12 +266,70 @@ class CacheCleaner(object):
             shutil.rmtree(segment_dir)
         except FileNotFoundError:
             logger.debug(f"{segment_dir} not found")
-        self.segment_db.delrecord(file)
 
         parent_dir = os.path.dirname(file)
         self.clean_empty_parents(self.output_dir, parent_dir)
 
+    def run_parallel(self, function, files) -> t.List[str]:
+        """ call function(file) for every file, on up to delete_threads threads.
+            Removing files is mostly waiting on the filesystem, so a few threads help even on one core.
+
+        :return: the files function succeeded for.  Failures (OSError) are logged.
+        """
+        def attempt(file):
+            try:
+                function(file)
+                return True
+            except OSError:
+                logger.exception(f"could not remove cache entry {file}")
+                return False
+
+        if self.delete_threads <= 1 or len(files) <= 1:
+            results = [attempt(file) for file in files]
+        else:
+            with ThreadPoolExecutor(max_workers=self.delete_threads) as executor:
+                results = list(executor.map(attempt, files))
+        return [file for file, done in zip(files, results) if done]
+
+    def clean_staging(self):
+        """ remove staging directories abandoned by packaging runs that never finished (eg: a killed worker) """
+        staging_parent = os.path.join(self.output_dir, STAGING_DIR)
+        then = time.time() - self.staging_age*60
+
+        try:
+            entries = list(os.scandir(staging_parent))
+        except FileNotFoundError:
+            return
+
+        for entry in entries:
+            try:
+                if entry.stat().st_mtime >= then:
+                    continue
+            except FileNotFoundError:
+                # published or removed while we were looking
+                continue
+            logger.info(f"removing abandoned staging directory {entry.path}")
+            shutil.rmtree(entry.path, ignore_errors=True)
+
+    def clean_locks(self):
+        """ remove the lock files nobody has held for longer than the [output] lock_timeout """
+        removed = prune_lock_files(os.path.join(self.output_dir, LOCK_DIR), self.lock_age)
+        logger.debug(f"removed {removed} unused lock files")
+
     def delete_input(self, file):
+        self.delete_inputs([file])
+
+    def delete_inputs(self, files) -> t.List[str]:
+        """ remove the cached input 'files', then their cache records in one transaction.
+            The records of files that could not be removed stay, for the next pass.
+
+        :return: the files removed
+        """
+        removed = self.run_parallel(self._delete_input_file, files)
+        self.input_file_db.delrecords(removed)
+        return removed
+
+    def _delete_input_file(self, file):
         logger.debug(f"asked to delete input file {file}")
 
         delete_file = os.path.join(self.input_dir, file)
@@ -132,32 +338,31 @@ class CacheCleaner(object):
             os.remove(delete_file)
         except (FileNotFoundError, NotADirectoryError) as e:
             logger.debug(f"{delete_file} not found")
-        self.input_file_db.delrecord(file)
+
+        # the saved segment index goes with its input
+        try:
+            os.remove(delete_file + SIDECAR_SUFFIX)
+        except (FileNotFoundError, NotADirectoryError):
+            pass
 
         parent_dir = os.path.dirname(file)
         self.clean_empty_parents(self.input_dir, parent_dir)
 
     @property
-    def segment_cache_threshold_reached(self) -> bool:
-        """ Return true if the output segment cache is at it's configured size limit, False otherwise"""
-        usage = get_disk_usage(self.output_dir)
-        pct_full = usage / self.segment_cache_size * 100
-        logger.debug(f"segment cache is {usage}M - {pct_full}% full")
-
-        if pct_full > self.segment_cache_threshold:
-            return True
-        return False
+    def segment_cache_excess(self) -> int:
+        """ :return: bytes the output segment cache is over its configured limit, 0 or less if it isn't """
+        usage = self.segment_db.total_size()
+        limit = self.segment_cache_size * 1024 * 1024 * self.segment_cache_threshold / 100
+        logger.debug(f"segment cache is {usage // (1024 * 1024)}M - {usage / (self.segment_cache_size * 1024 * 1024) * 100}% full")
+        return int(usage - limit)
 
     @property
-    def input_cache_threshold_reached(self) -> bool:
-        """ Return true if the input cache is at it's configured size limit, False otherwise"""
-        usage = get_disk_usage(self.input_dir)
-        pct_full = usage / self.input_cache_size * 100
-        logger.debug(f"input cache is {usage}M - {pct_full}% full")
-
-        if pct_full > self.input_cache_threshold:
-            return True
-        return False
+    def input_cache_excess(self) -> int:
+        """ :return: bytes the input cache is over its configured limit, 0 or less if it isn't """
+        usage = self.input_file_db.total_size()
+        limit = self.input_cache_size * 1024 * 1024 * self.input_cache_threshold / 100
+        logger.debug(f"input cache is {usage // (1024 * 1024)}M - {usage / (self.input_cache_size * 1024 * 1024) * 100}% full")
+        return int(usage - limit)
 
     @staticmethod
     def clean_empty_parents(dir_root, sub_dir):
@@ -2,6 +2,7 @@
 #GNU GENERAL PUBLIC LICENSE Version 2
 #See file LICENCE or visit https://github.com/flipmcf/CasterPak/blob/master/LICENSE
 import os
+import threading
 import configparser
 
 from configparser import ConfigParser
@@ -12,13 +13,53 @@ dname = os.path.dirname(abspath)
 os.chdir(dname)
 
 
-def get_config() -> ConfigParser:
-    config: ConfigParser = configparser.ConfigParser()
-    successfully_read = config.read('config.ini')
+class ConfigSnapshot(ConfigParser):
+    """ A ConfigParser that can't be changed once it has been read.
+
+        One snapshot is shared by every request in a process,
+        so nobody gets to modify it in place.  Use reload_config() to replace it.
+    """
+    _frozen = False
+
+    def freeze(self) -> None:
+        self._frozen = True
+
+    def _check_frozen(self):
+        if self._frozen:
+            raise TypeError("the configuration snapshot is read only, use config.reload_config()")
+
+    def _read(self, fp, fpname):
+        self._check_frozen()
+        super(ConfigSnapshot, self)._read(fp, fpname)
+
+    def set(self, section, option, value=None):
+        self._check_frozen()
+        super(ConfigSnapshot, self).set(section, option, value)
+
+    def add_section(self, section):
+        self._check_frozen()
+        super(ConfigSnapshot, self).add_section(section)
+
+    def remove_option(self, section, option):
+        self._check_frozen()
+        return super(ConfigSnapshot, self).remove_option(section, option)
+
+    def remove_section(self, section):
+        self._check_frozen()
+        return super(ConfigSnapshot, self).remove_section(section)
+
+
+def read_config(filename: str = 'config.ini') -> ConfigSnapshot:
+    """ read config.ini and apply the CASTERPAK_<SECTION>_<OPTION> environment overrides
 
-    if 'config.ini' not in successfully_read:
-        raise FileNotFoundError("""
-        config file config.ini not found.
+    :return: a new, read only, configuration
+    """
+    config: ConfigSnapshot = ConfigSnapshot()
+    successfully_read = config.read(filename)
+
+    if filename not in successfully_read:
+        raise FileNotFoundError(f"""
+        config file {filename} not found.
         Copy config_example.ini to config.ini and configure the application
         """)
 
@@ -29,4 +70,36 @@ def get_config() -> ConfigParser:
                 print(f"Overriding config option {section}.{option} with environment variable {env_var}")
                 config.set(section, option, os.environ[env_var])
 
+    config.freeze()
+    return config
+
+
+_snapshot = None
+_snapshot_lock = threading.Lock()
+
+
+def get_config() -> ConfigParser:
+    """
+    :return: the configuration of this process.
+    config.ini is read the first time this is called, after that the same snapshot is returned
+    until reload_config() is called.
+    """
+    global _snapshot
+    if _snapshot is None:
+        with _snapshot_lock:
+            if _snapshot is None:
+                _snapshot = read_config()
+    return _snapshot
+
+
+def reload_config() -> ConfigParser:
+    """ re-read config.ini and replace the snapshot returned by get_config()
+
+    If config.ini can't be read the exception is raised and the old snapshot stays in place.
+    Callers that are holding on to the old snapshot keep seeing the old values.
+    """
+    global _snapshot
+    config = read_config()
+    with _snapshot_lock:
+        _snapshot = config
     return config
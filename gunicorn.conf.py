@@ -1,8 +1,14 @@
 
-from config import get_config
+import sys
+import subprocess
+
+from config import reload_config
 from cleanup import start_maintenance_loop
+import cachedb
 
-app_config = get_config()
+# gunicorn runs this file in the master process when it starts, and again on every SIGHUP.
+# Re-reading config.ini here means workers forked after a 'kill -HUP' get the new configuration.
+app_config = reload_config()
 
 workers = 3
 bind = "unix:/home/casterpak/CasterPak/casterpak.sock"
@@ -18,6 +24,7 @@ accesslog = app_config.get('logging', 'access_log', fallback='/var/log/casterpak
 errorlog = app_config.get('logging', 'error_log', fallback='/var/log/casterpak.error.log')
 cachelog = app_config.get('logging', 'cache_log', fallback='/var/log/casterpak.cache.log')
 cleanup_interval = app_config.getint('cache', 'cleanup_interval', fallback=300)
+packaging_queue = app_config.getboolean('packager', 'queue', fallback=False)
 
 
 capture_output = False
@@ -32,4 +39,34 @@ def on_starting(server):
     server.log.info("CASTERPAK: Master Process starting up.")
     server.log.info("Cleanup: initializing background maintenance loop.")
     start_maintenance_loop(cleanup_interval,server=server)
-    server.log.info("--------------------------------------------------")
\ No newline at end of file
+    if packaging_queue:
+        server.log.info("Packager: starting the packaging job processes.")
+        server.packager = subprocess.Popen([sys.executable, '-m', 'vodhls.packager'])
+    server.log.info("--------------------------------------------------")
+
+
+def on_exit(server):
+    """
+    Runs in the Gunicorn Master process as it shuts down.
+    """
+    packager = getattr(server, 'packager', None)
+    if packager is not None:
+        server.log.info("Packager: stopping the packaging job processes.")
+        packager.terminate()
+        packager.wait(timeout=30)
+
+
+def on_reload(server):
+    """
+    Runs in the Gunicorn Master process on SIGHUP, after config.ini has been re-read (above)
+    and before the new workers are spawned.
+    """
+    server.log.info("CASTERPAK: configuration reloaded, restarting workers.")
+
+
+def worker_exit(server, worker):
+    """
+    Runs in the worker process as it exits.
+    Write the cache 'last used' times it is still holding in memory.
+    """
+    cachedb.flush_access_records()
@@ -0,0 +1,70 @@
+#Copyright (c) 2022, Michael McFadden & Radio Free Asia
+#BSD 3-Clause License
+#See file LICENCE or visit https://github.com/flipmcf/CasterPak/blob/master/LICENSE
+""" Walking the top level boxes of a heavily fragmented file: reads and seeks per box vs. the mapped file.
+
+    python -m tests.bench_atoms [fragments]
+"""
+import io
+import os
+import sys
+import time
+import struct
+import tempfile
+
+from bento4.mp4utils import Mp4Atom, WalkAtoms
+from bento4.mp4boxes import ReadMp4Tree
+
+from tests.test_mp4boxes import build_fragmented_mp4
+
+
+def read_and_seek(filename, until=None):
+    """ the old WalkAtoms: two reads and a seek on an unbuffered file per box """
+    cursor = 0
+    atoms = []
+    file = io.FileIO(filename, "rb")
+    while True:
+        try:
+            size = struct.unpack('>I', file.read(4))[0]
+            type = file.read(4).decode('ascii')
+            if type == until:
+                break
+            if size == 1:
+                size = struct.unpack('>Q', file.read(8))[0]
+            atoms.append(Mp4Atom(type, size, cursor))
+            cursor += size
+            file.seek(cursor)
+        except Exception:
+            break
+
+    return atoms
+
+
+def timed(label, function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    elapsed = time.perf_counter() - start
+    print(f"{label:45s} {elapsed:10.3f}s   {len(result)} boxes")
+
+
+def main(fragments=20000):
+    directory = tempfile.mkdtemp()
+    filename = os.path.join(directory, 'fragmented.mp4')
+    # the file's one fragment, repeated
+    data = build_fragmented_mp4(fragments=1, samples_per_fragment=48)
+    moof = data.index(b'moof') - 4
+    with open(filename, 'wb') as f:
+        f.write(data[:moof])
+        for _ in range(fragments):
+            f.write(data[moof:])
+
+    timed(f'{fragments} fragments, read and seek', read_and_seek, filename)
+    timed(f'{fragments} fragments, WalkAtoms', WalkAtoms, filename)
+    timed(f'{fragments} fragments, ReadMp4Tree', ReadMp4Tree, filename)
+
+    os.remove(filename)
+    os.rmdir(directory)
+
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,49 @@
+#Copyright (c) 2022, Michael McFadden & Radio Free Asia
+#BSD 3-Clause License
+#See file LICENCE or visit https://github.com/flipmcf/CasterPak/blob/master/LICENSE
+""" ComputeBandwidth over synthetic fragment tables: the scan over every run of fragments vs. bento4.mp4utils.
+    The bitrate of the tables is steady, rising or falling.
+
+    python -m tests.bench_bandwidth [largest table] [largest table for the scan over every run]
+"""
+import sys
+import time
+import random
+
+from bento4.mp4utils import ComputeBandwidth
+
+from tests.test_mp4utils import scan_every_run
+
+
+def fragment_table(count, seed=0, trend=0.0, noise=0.5):
+    """ :return: sizes and durations of 'count' fragments of 2 seconds at 90kHz around 4Mbps, with a few spikes.
+        The bitrate goes from 4Mbps to (1 + trend) times that over the table, each fragment within 'noise' of it.
+    """
+    rng = random.Random(seed)
+    durations = [rng.choice((179820, 180000, 180180)) / 90000 for _ in range(count)]
+    sizes = [int(duration * 500000 * (1 + trend * i / count) * rng.uniform(1 - noise, 1 + noise) * (3 if rng.random() < 0.001 else 1))
+             for i, duration in enumerate(durations)]
+    return sizes, durations
+
+
+def timed(label, function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    elapsed = time.perf_counter() - start
+    print(f"{label:55s} {elapsed:10.3f}s   {result} bps")
+
+
+def main(largest=1000000, largest_scan=10000):
+    for label, trend, noise in (('steady', 0.0, 0.5), ('rising', 9.0, 0.5), ('smoothly rising', 1.0, 0.0),
+                                ('falling', -0.9, 0.5)):
+        count = 10000
+        while count <= largest:
+            sizes, durations = fragment_table(count, trend=trend, noise=noise)
+            if count <= largest_scan:
+                timed(f'{count} {label} fragments, scan over every run', scan_every_run, 2.0, sizes, durations)
+            timed(f'{count} {label} fragments, ComputeBandwidth', ComputeBandwidth, 2.0, sizes, durations)
+            count *= 10
+
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:]])
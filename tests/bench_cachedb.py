@@ -0,0 +1,83 @@
+#Copyright (c) 2022, Michael McFadden & Radio Free Asia
+#BSD 3-Clause License
+#See file LICENCE or visit https://github.com/flipmcf/CasterPak/blob/master/LICENSE
+""" Cache database throughput: a new connection per operation vs. the persistent connections in cachedb.
+
+    python -m tests.bench_cachedb [operations]
+"""
+import os
+import sys
+import time
+import sqlite3
+import tempfile
+
+import cachedb
+
+
+class PerOperationSQLite(object):
+    """ the old cachedb.SQLite: connect, execute, commit and close for every operation """
+    def __init__(self, file):
+        self.file = file
+
+    def __enter__(self):
+        self.conn = sqlite3.connect(self.file)
+        self.conn.row_factory = sqlite3.Row
+        return self.conn.cursor()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.conn.commit()
+        self.conn.close()
+
+
+def upsert(context, dbname, operations):
+    query = f"""INSERT INTO {cachedb.SEGMENT_FILE_CACHE}
+                VALUES(?, ?)
+                ON CONFLICT(filename) DO UPDATE SET timestamp=excluded.timestamp
+             """
+    for i in range(operations):
+        with context(dbname) as cursor:
+            cursor.execute(query, (f'video-{i % 1000}.mp4', i))
+
+
+def select_oldest(context, dbname, operations):
+    for i in range(operations):
+        with context(dbname) as cursor:
+            cursor.execute(f"SELECT filename FROM {cachedb.SEGMENT_FILE_CACHE} order by timestamp limit ?", (10,))
+            cursor.fetchall()
+
+
+def touch(dbname, operations):
+    db = cachedb.CacheDB(dbname=dbname, cache_name=cachedb.SEGMENT_FILE_CACHE)
+    for i in range(operations):
+        db.touch(filename=f'video-{i % 1000}.mp4', timestamp=i)
+    cachedb.flush_access_records()
+
+
+def timed(label, function, *args):
+    operations = args[-1]
+    start = time.perf_counter()
+    function(*args)
+    elapsed = time.perf_counter() - start
+    print(f"{label:45s} {operations / elapsed:12.0f} ops/sec")
+
+
+def main(operations=5000):
+    directory = tempfile.mkdtemp()
+    dbname = os.path.join(directory, 'bench.db')
+    cachedb.initialize_cache_db(dbname)
+
+    timed('upsert, connection per operation', upsert, PerOperationSQLite, dbname, operations)
+    timed('upsert, persistent connection', upsert, cachedb.SQLite, dbname, operations)
+    timed('select, connection per operation', select_oldest, PerOperationSQLite, dbname, operations)
+    timed('select, persistent read-only connection', select_oldest,
+          lambda file: cachedb.SQLite(file, readonly=True), dbname, operations)
+    timed('CacheDB.touch, batched', touch, dbname, operations)
+
+    cachedb.close_connections()
+    for name in os.listdir(directory):
+        os.remove(os.path.join(directory, name))
+    os.rmdir(directory)
+
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:]])
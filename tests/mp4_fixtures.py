@@ -0,0 +1,132 @@
+#Copyright (c) 2022, Michael McFadden & Radio Free Asia
+#BSD 3-Clause License
+#See file LICENCE or visit https://github.com/flipmcf/CasterPak/blob/master/LICENSE
+""" Builds small, structurally valid mp4 files for tests.
+
+The sample data is not real H.264/AAC, but every box, sample table and NAL unit length is.
+"""
+import struct
+
+SPS = b'\x67\x64\x00\x1f\xac\xd9\x40\x50\x05\xbb\x01\x10'
+PPS = b'\x68\xeb\xe3\xcb\x22\xc0'
+# AAC-LC, 44.1kHz, stereo
+AUDIO_SPECIFIC_CONFIG = b'\x12\x10'
+
+
+def box(type, *payloads):
+    payload = b''.join(payloads)
+    return struct.pack('>I4s', 8 + len(payload), type.encode('latin-1')) + payload
+
+
+def full_box(type, version, flags, *payloads):
+    return box(type, struct.pack('>I', (version << 24) | flags), *payloads)
+
+
+def descriptor(tag, payload):
+    return bytes([tag, len(payload)]) + payload
+
+
+def video_samples(seconds, fps=25, keyframe_interval=2):
+    """ :return: list of (data, is_sync) """
+    samples = []
+    for i in range(seconds * fps):
+        is_sync = i % (fps * keyframe_interval) == 0
+        nal = bytes([0x65 if is_sync else 0x41]) + bytes([i % 256]) * 200
+        samples.append((struct.pack('>I', len(nal)) + nal, is_sync))
+    return samples
+
+
+def audio_samples(seconds, sample_rate=44100):
+    count = seconds * sample_rate // 1024
+    return [(bytes([0x21, i % 256]) * 50, True) for i in range(count)]
+
+
+def trak(track_id, handler, timescale, durations, sizes, chunk_offsets, samples_per_chunk, sample_entry, sync=None):
+    total = sum(durations)
+    tkhd = full_box('tkhd', 0, 3, struct.pack('>III', 0, 0, track_id), b'\x00' * 4,
+                    struct.pack('>I', total), b'\x00' * 60)
+    language = ((ord('e') - 0x60) << 10) | ((ord('n') - 0x60) << 5) | (ord('g') - 0x60)
+    mdhd = full_box('mdhd', 0, 0, struct.pack('>IIIIHH', 0, 0, timescale, total, language, 0))
+    hdlr = full_box('hdlr', 0, 0, b'\x00' * 4, handler.encode('latin-1'), b'\x00' * 12, b'handler\x00')
+
+    # run length encode the durations
+    runs = []
+    for duration in durations:
+        if runs and runs[-1][1] == duration:
+            runs[-1][0] += 1
+        else:
+            runs.append([1, duration])
+    stts = full_box('stts', 0, 0, struct.pack('>I', len(runs)), b''.join(struct.pack('>II', *run) for run in runs))
+    stsd = full_box('stsd', 0, 0, struct.pack('>I', 1), sample_entry)
+    stsz = full_box('stsz', 0, 0, struct.pack('>II', 0, len(sizes)), b''.join(struct.pack('>I', s) for s in sizes))
+    stsc = full_box('stsc', 0, 0, struct.pack('>I', 1), struct.pack('>III', 1, samples_per_chunk, 1))
+    stco = full_box('stco', 0, 0, struct.pack('>I', len(chunk_offsets)),
+                    b''.join(struct.pack('>I', o) for o in chunk_offsets))
+    tables = [stsd, stts, stsc, stsz, stco]
+    if sync is not None:
+        tables.append(full_box('stss', 0, 0, struct.pack('>I', len(sync)), b''.join(struct.pack('>I', n + 1) for n in sync)))
+    stbl = box('stbl', *tables)
+    minf = box('minf', stbl)
+    mdia = box('mdia', mdhd, hdlr, minf)
+    return box('trak', tkhd, mdia)
+
+
+def avc1_entry(width=1280, height=720):
+    avcc = box('avcC', bytes([1, 0x64, 0x00, 0x1f, 0xff, 0xe1]), struct.pack('>H', len(SPS)), SPS,
+               b'\x01', struct.pack('>H', len(PPS)), PPS)
+    return box('avc1', b'\x00' * 6, struct.pack('>H', 1), b'\x00' * 16, struct.pack('>HH', width, height),
+               struct.pack('>II', 0x00480000, 0x00480000), b'\x00' * 4, struct.pack('>H', 1), b'\x00' * 32,
+               struct.pack('>Hh', 0x18, -1), avcc)
+
+
+def mp4a_entry(sample_rate=44100, channels=2):
+    decoder_specific = descriptor(0x05, AUDIO_SPECIFIC_CONFIG)
+    decoder_config = descriptor(0x04, bytes([0x40, 0x15]) + b'\x00' * 11 + decoder_specific)
+    es = descriptor(0x03, struct.pack('>HB', 1, 0) + decoder_config + descriptor(0x06, b'\x02'))
+    esds = full_box('esds', 0, 0, es)
+    return box('mp4a', b'\x00' * 6, struct.pack('>H', 1), b'\x00' * 8, struct.pack('>HHHH', channels, 16, 0, 0),
+               struct.pack('>I', sample_rate << 16), esds)
+
+
+def build_mp4(seconds=20, fps=25, keyframe_interval=2, with_audio=True, moov_first=True):
+    """ :return: bytes of an mp4 file with an H.264 track (id 1) and optionally an AAC track (id 2) """
+    video = video_samples(seconds, fps, keyframe_interval)
+    audio = audio_samples(seconds) if with_audio else []
+
+    # one chunk per second of video, one chunk per 43 audio frames, interleaved
+    video_chunks = [video[i:i + fps] for i in range(0, len(video), fps)]
+    audio_chunks = [audio[i:i + 43] for i in range(0, len(audio), 43)]
+
+    def layout(mdat_start):
+        video_offsets, audio_offsets, data = [], [], []
+        position = mdat_start + 8
+        for i in range(max(len(video_chunks), len(audio_chunks))):
+            if i < len(video_chunks):
+                video_offsets.append(position)
+                for sample, _ in video_chunks[i]:
+                    data.append(sample)
+                    position += len(sample)
+            if i < len(audio_chunks):
+                audio_offsets.append(position)
+                for sample, _ in audio_chunks[i]:
+                    data.append(sample)
+                    position += len(sample)
+        return video_offsets, audio_offsets, box('mdat', *data)
+
+    def moov(video_offsets, audio_offsets):
+        traks = [trak(1, 'vide', fps * 1000, [1000] * len(video), [len(s) for s, _ in video], video_offsets, fps,
+                      avc1_entry(), sync=[i for i, (_, is_sync) in enumerate(video) if is_sync])]
+        if with_audio:
+            traks.append(trak(2, 'soun', 44100, [1024] * len(audio), [len(s) for s, _ in audio], audio_offsets, 43,
+                              mp4a_entry()))
+        mvhd = full_box('mvhd', 0, 0, struct.pack('>IIII', 0, 0, 1000, seconds * 1000), b'\x00' * 80)
+        return box('moov', mvhd, *traks)
+
+    ftyp = box('ftyp', b'isom', struct.pack('>I', 512), b'isomiso2avc1mp41')
+    if moov_first:
+        # moov size doesn't depend on the offsets, so lay out twice
+        size = len(moov(*layout(0)[:2]))
+        video_offsets, audio_offsets, mdat = layout(len(ftyp) + size)
+        return ftyp + moov(video_offsets, audio_offsets) + mdat
+    video_offsets, audio_offsets, mdat = layout(len(ftyp))
+    return ftyp + mdat + moov(video_offsets, audio_offsets)
@@ -0,0 +1,144 @@
+#Copyright (c) 2022, Michael McFadden & Radio Free Asia
+#BSD 3-Clause License
+#See file LICENCE or visit https://github.com/flipmcf/CasterPak/blob/master/LICENSE
+import json
+import time
+import tempfile
+import threading
+import unittest
+import multiprocessing
+
+from vodhls import PackagingPending
+from vodhls.locking import ProcessSlots, INTERACTIVE, BACKGROUND, admission, current_admission
+from bento4.mp4utils import Bento4Command
+from vodhls.media_manifest_base import OptionsConfig
+
+
+def hold_slot(directory, seconds, started):
+    with ProcessSlots(directory, 1).slot():
+        started.set()
+        time.sleep(seconds)
+
+
+class ProcessSlotsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.slots = ProcessSlots(self.directory.name, 2, background_slots=1, poll_interval=0.01)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_limit_across_threads(self):
+        running = []
+        most = []
+        lock = threading.Lock()
+
+        def work():
+            with self.slots.slot():
+                with lock:
+                    running.append(1)
+                    most.append(len(running))
+                time.sleep(0.05)
+                with lock:
+                    running.pop()
+
+        threads = [threading.Thread(target=work) for _ in range(6)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(max(most), 2)
+
+    def test_limit_across_processes(self):
+        started = multiprocessing.get_context('fork').Event()
+        other = multiprocessing.get_context('fork').Process(target=hold_slot,
+                                                            args=(self.directory.name, 0.5, started))
+        other.start()
+        try:
+            self.assertTrue(started.wait(5))
+            with self.assertRaises(PackagingPending):
+                ProcessSlots(self.directory.name, 1, poll_interval=0.01).acquire(timeout=0.1)
+        finally:
+            other.join()
+        # free again once the other process is done
+        with ProcessSlots(self.directory.name, 1).slot(timeout=0.1) as slot:
+            self.assertEqual(slot, 0)
+
+    def test_background_slots(self):
+        with self.slots.slot(BACKGROUND):
+            with self.assertRaises(PackagingPending):
+                self.slots.acquire(BACKGROUND, timeout=0.1)
+            # the rest are kept for requests
+            with self.slots.slot(INTERACTIVE, timeout=0.1) as slot:
+                self.assertEqual(slot, 1)
+
+    def test_background_gives_way(self):
+        order = []
+        slot, fd = self.slots.acquire(INTERACTIVE)
+        other = self.slots.acquire(INTERACTIVE)
+
+        def take(priority):
+            with self.slots.slot(priority):
+                order.append(priority)
+
+        background = threading.Thread(target=take, args=(BACKGROUND,))
+        background.start()
+        time.sleep(0.05)
+        interactive = threading.Thread(target=take, args=(INTERACTIVE,))
+        interactive.start()
+        time.sleep(0.05)
+
+        # slot 0 is the only one background work can use, but a request is waiting too
+        self.slots.release(slot, fd)
+        interactive.join()
+        self.slots.release(*other)
+        background.join()
+        self.assertEqual(order, [INTERACTIVE, BACKGROUND])
+
+    def test_fails_fast_on_long_wait(self):
+        for slot in range(2):
+            with open(self.slots.slot_path(slot), 'w') as f:
+                json.dump({'started': None, 'last': 60.0}, f)
+        held = [self.slots.acquire(), self.slots.acquire()]
+
+        start = time.monotonic()
+        with self.assertRaises(PackagingPending) as raised:
+            self.slots.acquire(timeout=10)
+        self.assertLess(time.monotonic() - start, 1)
+        self.assertGreaterEqual(raised.exception.retry_after, 59)
+
+        for slot in held:
+            self.slots.release(*slot)
+        with open(self.slots.slot_path(0)) as f:
+            self.assertLess(json.load(f)['last'], 60)
+
+    def test_admission(self):
+        self.assertEqual(current_admission(), (INTERACTIVE, True))
+        with admission(BACKGROUND, deadline=False):
+            self.assertEqual(current_admission(), (BACKGROUND, False))
+            seen = []
+            thread = threading.Thread(target=lambda: seen.append(current_admission()))
+            thread.start()
+            thread.join()
+            self.assertEqual(seen, [(INTERACTIVE, True)])
+        self.assertEqual(current_admission(), (INTERACTIVE, True))
+
+    def test_bento4_command(self):
+        slots = ProcessSlots(self.directory.name, 1, poll_interval=0.01)
+        options = OptionsConfig({'exec_dir': '-', 'process_slot': lambda: slots.slot(timeout=0.1)})
+        with slots.slot():
+            with self.assertRaises(PackagingPending):
+                Bento4Command(options, 'true')
+        self.assertEqual(Bento4Command(options, 'true'), b'')
+
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(ProcessSlotsTestCase)
+    return suite
+
+
+if __name__ == "__main__":
+    runner = unittest.TextTestRunner()
+    runner.run(suite())
@@ -2,33 +2,265 @@
 #BSD 3-Clause License
 #See file LICENCE or visit https://github.com/flipmcf/CasterPak/blob/master/LICENSE
 import os
+import time
+import sqlite3
 import unittest
 
 import cachedb
 
 
-class CacheDBTestCase(unittest.TestCase):
+class CacheDBFixture(unittest.TestCase):
     db_filename = 'test_CacheDB.db'
 
     def setUp(self):
-        self.testclass = cachedb.CacheDB(dbname=self.db_filename)
+        cachedb.initialize_cache_db(self.db_filename)
+        self.testclass = cachedb.CacheDB(dbname=self.db_filename, cache_name=cachedb.SEGMENT_FILE_CACHE)
 
     def tearDown(self):
-        os.remove(self.db_filename)
+        cachedb.close_connections()
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(self.db_filename + suffix):
+                os.remove(self.db_filename + suffix)
+
+
+class CacheDBTestCase(CacheDBFixture):
 
     def test_addrecord(self):
-        pass
+        self.testclass.addrecord('a.mp4', 100)
+        self.testclass.addrecord('a.mp4', 200)
+        self.assertEqual(self.testclass.get_oldest(num=10), ['a.mp4'])
+        self.assertEqual(self.testclass._oldest_rows(num=10), [(200, 'a.mp4', 0)])
 
     def test_find(self):
-        pass
+        now = int(time.time())
+        self.testclass.addrecord('old.mp4', now - 3600)
+        self.testclass.addrecord('new.mp4', now)
+        self.assertEqual(self.testclass.find(age_in_minutes=30), ['old.mp4'])
 
     def test_delrecord(self):
-        pass
+        self.testclass.addrecord('a.mp4', 100)
+        self.testclass.delrecord('a.mp4')
+        self.assertEqual(self.testclass.get_oldest(num=10), [])
+
+    def test_delrecords(self):
+        for i in range(10):
+            self.testclass.addrecord(f'{i}.mp4', i)
+        self.testclass.delrecords([f'{i}.mp4' for i in range(0, 10, 2)])
+        self.assertEqual(self.testclass.get_oldest(num=10), [f'{i}.mp4' for i in range(1, 10, 2)])
+
+    def test_oldest_batches(self):
+        # equal timestamps must not make a batch boundary skip or repeat a file
+        for i in range(25):
+            self.testclass.addrecord(f'{i:02d}.mp4', i // 4)
+        batches = list(self.testclass.oldest_batches(batch_size=10))
+        self.assertEqual([len(batch) for batch in batches], [10, 10, 5])
+        self.assertEqual(sum(batches, []), [f'{i:02d}.mp4' for i in range(25)])
+
+    def test_queries_use_timestamp_index(self):
+        with cachedb.SQLite(self.db_filename) as cursor:
+            for query, args in [(f"SELECT filename FROM {self.testclass.table} WHERE timestamp < ?", (1,)),
+                                (f"SELECT timestamp, filename FROM {self.testclass.table} "
+                                 f"ORDER BY timestamp, filename LIMIT ?", (1,))]:
+                cursor.execute("EXPLAIN QUERY PLAN " + query, args)
+                plan = ' '.join(row[-1] for row in cursor.fetchall())
+                self.assertIn('segmentfile_timestamp', plan)
+                self.assertNotIn('TEMP B-TREE', plan)
+
+    def test_migration(self):
+        # a database made before the timestamp index existed
+        cachedb.close_connections()
+        os.remove(self.db_filename)
+        conn = sqlite3.connect(self.db_filename)
+        conn.execute("CREATE TABLE segmentfile (filename text PRIMARY KEY, timestamp int NOT NULL)")
+        conn.execute("INSERT INTO segmentfile VALUES('a.mp4', 1)")
+        conn.commit()
+        conn.close()
+
+        cachedb.initialize_cache_db(self.db_filename)
+        with cachedb.SQLite(self.db_filename) as cursor:
+            cursor.execute("PRAGMA user_version")
+            self.assertEqual(cursor.fetchone()[0], len(cachedb.MIGRATIONS))
+            cursor.execute("SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = 'segmentfile'")
+            self.assertIn('segmentfile_timestamp', [row[0] for row in cursor.fetchall()])
+        self.assertEqual(self.testclass.get_oldest(num=10), ['a.mp4'])
+
+
+class SizeLedgerTestCase(CacheDBFixture):
+
+    def test_running_total(self):
+        self.testclass.set_size('a.mp4', 1000)
+        self.testclass.add_size('b.mp4', 100)
+        self.testclass.add_size('b.mp4', 50)
+        self.assertEqual(self.testclass.total_size(), 1150)
+
+        # touching an entry leaves its size alone
+        self.testclass.addrecord('a.mp4', 5)
+        self.testclass.set_size('a.mp4', 400)
+        self.assertEqual(self.testclass.total_size(), 550)
+
+        self.testclass.delrecords(['a.mp4'])
+        self.assertEqual(self.testclass.total_size(), 150)
+
+    def test_reconcile_sizes(self):
+        self.testclass.set_size('a.mp4', 1000)
+        self.testclass.set_size('b.mp4', 1000)
+        self.assertEqual(self.testclass.last_reconciled(), 0)
+
+        # b.mp4 is gone from disk, c.mp4 isn't in the cache
+        self.testclass.reconcile_sizes({'a.mp4': 700, 'c.mp4': 5})
+        self.assertEqual(self.testclass.total_size(), 700)
+        self.assertGreater(self.testclass.last_reconciled(), 0)
+
+    def test_eviction_candidates(self):
+        for i, size in enumerate([10, 20, 30, 40]):
+            self.testclass.addrecord(f'{i}.mp4', i)
+            self.testclass.set_size(f'{i}.mp4', size)
+
+        def names(candidates):
+            return [filename for filename, size in candidates]
+
+        self.assertEqual(self.testclass.eviction_candidates(0), [])
+        self.assertEqual(self.testclass.eviction_candidates(25), [('0.mp4', 10), ('1.mp4', 20)])
+        self.assertEqual(names(self.testclass.eviction_candidates(30)), ['0.mp4', '1.mp4'])
+        self.assertEqual(names(self.testclass.eviction_candidates(1000)), ['0.mp4', '1.mp4', '2.mp4', '3.mp4'])
+
+    def test_weighted_eviction(self):
+        for i, size in enumerate([1, 1, 100 * 1048576]):
+            self.testclass.addrecord(f'{i}.mp4', i)
+            self.testclass.set_size(f'{i}.mp4', size)
+        for _ in range(10):
+            self.testclass.addrecord('0.mp4', 0)
+
+        # 10 hits buy 0.mp4 ten seconds, 100MiB costs 2.mp4 100 seconds
+        candidates = self.testclass.eviction_candidates(2, hit_weight=1, size_weight=1)
+        self.assertEqual([filename for filename, size in candidates], ['2.mp4'])
+        candidates = self.testclass.eviction_candidates(100 * 1048576 + 2, hit_weight=1)
+        self.assertEqual([filename for filename, size in candidates], ['1.mp4', '2.mp4', '0.mp4'])
+
+    def test_eviction_plan_uses_timestamp_index(self):
+        with cachedb.SQLite(self.db_filename) as cursor:
+            cursor.execute(f"""EXPLAIN QUERY PLAN SELECT filename, size,
+                                   SUM(size) OVER (ORDER BY timestamp, filename ROWS UNBOUNDED PRECEDING)
+                               FROM {self.testclass.table}""")
+            plan = ' '.join(row[-1] for row in cursor.fetchall())
+        self.assertNotIn('TEMP B-TREE', plan)
+
+    def test_record_eviction(self):
+        self.testclass.record_eviction(3, 3000, 0.25)
+        with cachedb.SQLite(self.db_filename) as cursor:
+            cursor.execute("SELECT evicted_entries, evicted_bytes, eviction_seconds FROM cachesize WHERE cache = ?",
+                           (self.testclass.table,))
+            self.assertEqual(tuple(cursor.fetchone()), (3, 3000, 0.25))
+
+class ConnectionTestCase(CacheDBFixture):
+
+    def test_connection_is_reused(self):
+        with cachedb.SQLite(self.db_filename) as cursor:
+            first = cursor.connection
+        with cachedb.SQLite(self.db_filename) as cursor:
+            self.assertIs(cursor.connection, first)
+            cursor.execute("PRAGMA synchronous;")
+            self.assertEqual(cursor.fetchone()[0], 1)   # NORMAL
+
+    def test_readonly_connection(self):
+        with cachedb.SQLite(self.db_filename, readonly=True) as cursor:
+            with self.assertRaises(sqlite3.OperationalError):
+                cursor.execute(f"INSERT INTO {cachedb.SEGMENT_FILE_CACHE} VALUES('a.mp4', 1)")
+
+    def test_rollback_on_exception(self):
+        db = cachedb.CacheDB(dbname=self.db_filename, cache_name=cachedb.SEGMENT_FILE_CACHE)
+        with self.assertRaises(RuntimeError):
+            with cachedb.SQLite(self.db_filename) as cursor:
+                cursor.execute(f"INSERT INTO {db.table}(filename, timestamp) VALUES('a.mp4', 1)")
+                raise RuntimeError
+        self.assertEqual(db.get_oldest(num=10), [])
+
+
+class MediaAnalysisTestCase(CacheDBFixture):
+
+    def test_put_and_get(self):
+        analysis_db = cachedb.MediaAnalysisDB(dbname=self.db_filename)
+        self.assertIsNone(analysis_db.get('a.mp4:100:1'))
+        analysis_db.put('a.mp4:100:1', {'tracks': [{'id': 1}]})
+        self.assertEqual(analysis_db.get('a.mp4:100:1'), {'tracks': [{'id': 1}]})
+
+    def test_prune(self):
+        analysis_db = cachedb.MediaAnalysisDB(dbname=self.db_filename)
+        analysis_db.put('old', {})
+        analysis_db.put('new', {})
+        with cachedb.SQLite(self.db_filename) as cursor:
+            cursor.execute(f"UPDATE {cachedb.MEDIA_ANALYSIS_TABLE} SET timestamp = 0 WHERE key = 'old'")
+
+        self.assertEqual(analysis_db.prune(60), 1)
+        self.assertIsNone(analysis_db.get('old'))
+        self.assertEqual(analysis_db.get('new'), {})
+
+    def test_content_hash(self):
+        input_db = cachedb.CacheDB(dbname=self.db_filename, cache_name=cachedb.INPUT_FILE_CACHE)
+        self.assertIsNone(input_db.content_hash('a.mp4'))
+        input_db.set_content_hash('a.mp4', '0123abcd')
+        self.assertEqual(input_db.content_hash('a.mp4'), '0123abcd')
+        self.assertEqual(input_db.get_oldest(num=10), ['a.mp4'])
+
+
+class AccessRecorderTestCase(CacheDBFixture):
+
+    def setUp(self):
+        super(AccessRecorderTestCase, self).setUp()
+        self.recorder = cachedb.AccessRecorder(self.db_filename, flush_interval=60, max_pending=1000)
+
+    def timestamps(self):
+        with cachedb.SQLite(self.db_filename) as cursor:
+            cursor.execute(f"SELECT filename, timestamp FROM {self.testclass.table}")
+            return dict(cursor.fetchall())
+
+    def test_hits_are_counted(self):
+        for timestamp in (100, 300, 200):
+            self.recorder.record(self.testclass.table, 'a.mp4', timestamp)
+        self.recorder.flush()
+        self.recorder.record(self.testclass.table, 'a.mp4', 400)
+        self.recorder.flush()
+        with cachedb.SQLite(self.db_filename) as cursor:
+            cursor.execute(f"SELECT timestamp, hits FROM {self.testclass.table}")
+            self.assertEqual(tuple(cursor.fetchone()), (400, 4))
+
+    def test_touches_are_coalesced(self):
+        self.recorder.record(self.testclass.table, 'a.mp4', 100)
+        self.recorder.record(self.testclass.table, 'a.mp4', 300)
+        self.recorder.record(self.testclass.table, 'a.mp4', 200)
+        self.recorder.record(self.testclass.table, 'b.mp4', 50)
+        self.assertEqual(len(self.recorder.pending), 2)
+        self.assertEqual(self.timestamps(), {})
+
+        self.recorder.flush()
+        self.assertEqual(self.timestamps(), {'a.mp4': 300, 'b.mp4': 50})
+        self.assertEqual(self.recorder.pending, {})
+
+    def test_flush_never_moves_a_timestamp_back(self):
+        self.testclass.addrecord('a.mp4', 500)
+        self.recorder.record(self.testclass.table, 'a.mp4', 400)
+        self.recorder.flush()
+        self.assertEqual(self.timestamps(), {'a.mp4': 500})
+
+    def test_flush_when_max_pending_reached(self):
+        self.recorder.max_pending = 3
+        for i in range(3):
+            self.recorder.record(self.testclass.table, f'{i}.mp4', 100)
+
+        # the background thread writes without waiting for flush_interval
+        deadline = time.monotonic() + 5
+        while len(self.timestamps()) < 3 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(len(self.timestamps()), 3)
 
 
 def suite():
     suite = unittest.TestSuite()
     suite.addTest(CacheDBTestCase)
+    suite.addTest(SizeLedgerTestCase)
+    suite.addTest(ConnectionTestCase)
+    suite.addTest(MediaAnalysisTestCase)
+    suite.addTest(AccessRecorderTestCase)
     return suite
 
 
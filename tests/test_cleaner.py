@@ -0,0 +1,131 @@
+#Copyright (c) 2022, Michael McFadden & Radio Free Asia
+#BSD 3-Clause License
+#See file LICENCE or visit https://github.com/flipmcf/CasterPak/blob/master/LICENSE
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+from configparser import ConfigParser
+
+import cachedb
+
+# the cleaner reads config.ini when it is imported
+with mock.patch('config.get_config', return_value=ConfigParser()):
+    from cleanup.cleaner import read_access_log, CacheCleaner, ACCESS_LOG_STATE_FILE
+
+
+class AccessLogTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.log = os.path.join(self.directory.name, 'casterpak-hits.log')
+        self.state = os.path.join(self.directory.name, 'offset')
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def append(self, text):
+        with open(self.log, 'a') as f:
+            f.write(text)
+
+    def test_reads_new_lines_only(self):
+        self.append("1718000000.120 x/v_300.mp4\n1718000001.500 x/v_600.mp4\n")
+        self.assertEqual(read_access_log(self.log, self.state), [('x/v_300.mp4', 1718000000),
+                                                                 ('x/v_600.mp4', 1718000001)])
+        self.assertEqual(read_access_log(self.log, self.state), [])
+
+        # the last line isn't finished yet
+        self.append("1718000002.000 x/v_900.mp4\n1718000003.000 x/v_")
+        self.assertEqual(read_access_log(self.log, self.state), [('x/v_900.mp4', 1718000002)])
+        self.append("300.mp4\n")
+        self.assertEqual(read_access_log(self.log, self.state), [('x/v_300.mp4', 1718000003)])
+
+    def test_rotated_log(self):
+        self.append("1718000000.000 x/v_300.mp4\n")
+        read_access_log(self.log, self.state)
+
+        os.rename(self.log, self.log + '.1')
+        self.append("1718000005.000 x/v_600.mp4\n")
+        self.assertEqual(read_access_log(self.log, self.state), [('x/v_600.mp4', 1718000005)])
+
+    def test_missing_log_and_bad_lines(self):
+        self.assertEqual(read_access_log(self.log, self.state), [])
+        self.append("garbage\n1718000000.000 x/v_300.mp4\n")
+        self.assertEqual(read_access_log(self.log, self.state), [('x/v_300.mp4', 1718000000)])
+
+
+class DeleteTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.output_dir = os.path.join(self.directory.name, 'segments')
+        self.dbname = os.path.join(self.directory.name, 'cache.db')
+        cachedb.initialize_cache_db(self.dbname)
+
+    def tearDown(self):
+        cachedb.close_connections()
+        self.directory.cleanup()
+
+    def cleaner(self, delete_threads):
+        parser = ConfigParser()
+        parser.read_dict({'output': {'segmentParentPath': self.output_dir},
+                          'input': {'videoCachePath': os.path.join(self.directory.name, 'input')},
+                          'cache': {'delete_threads': str(delete_threads)}})
+        with mock.patch('config.get_config', return_value=parser):
+            cleaner = CacheCleaner()
+        cleaner.segment_db = cachedb.CacheDB(self.dbname, cache_name=cachedb.SEGMENT_FILE_CACHE)
+        return cleaner
+
+    def test_failed_removal_keeps_its_record(self):
+        rmtree = shutil.rmtree
+
+        def failing_rmtree(path, *args, **kwargs):
+            if path.endswith('b.mp4'):
+                raise PermissionError(path)
+            rmtree(path, *args, **kwargs)
+
+        for delete_threads in (1, 4):
+            with self.subTest(delete_threads=delete_threads):
+                cleaner = self.cleaner(delete_threads)
+                files = ['x/a.mp4', 'x/b.mp4', 'x/c.mp4']
+                for file in files:
+                    os.makedirs(os.path.join(self.output_dir, file), exist_ok=True)
+                    cleaner.segment_db.addrecord(filename=file)
+
+                with mock.patch('cleanup.cleaner.shutil.rmtree', failing_rmtree):
+                    self.assertEqual(cleaner.delete_segments(files), ['x/a.mp4', 'x/c.mp4'])
+
+                self.assertEqual(os.listdir(os.path.join(self.output_dir, 'x')), ['b.mp4'])
+                self.assertEqual(list(cleaner.segment_db.find(-1)), ['x/b.mp4'])
+                cleaner.segment_db.delrecords(['x/b.mp4'])
+
+    def test_access_log_state_in_output_dir(self):
+        log = os.path.join(self.directory.name, 'casterpak-hits.log')
+        with open(log, 'w') as f:
+            f.write("1718000000.000 x/v_300.mp4\n")
+        os.makedirs(self.output_dir)
+        cleaner = self.cleaner(1)
+        cleaner.nginx_access_log = log
+
+        cwd = os.getcwd()
+        os.chdir(self.directory.name)
+        try:
+            cleaner.collect_access_log()
+        finally:
+            os.chdir(cwd)
+        self.assertFalse(os.path.exists(os.path.join(self.directory.name, ACCESS_LOG_STATE_FILE)))
+        self.assertEqual(cleaner.access_log_state, os.path.join(self.output_dir, ACCESS_LOG_STATE_FILE))
+        self.assertEqual(read_access_log(log, cleaner.access_log_state), [])
+
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(AccessLogTestCase)
+    suite.addTest(DeleteTestCase)
+    return suite
+
+
+if __name__ == "__main__":
+    runner = unittest.TextTestRunner()
+    runner.run(suite())
@@ -0,0 +1,56 @@
+#Copyright (c) 2022, Michael McFadden & Radio Free Asia
+#BSD 3-Clause License
+#See file LICENCE or visit https://github.com/flipmcf/CasterPak/blob/master/LICENSE
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import config
+
+
+class ConfigSnapshotTestCase(unittest.TestCase):
+
+    def setUp(self):
+        fd, self.filename = tempfile.mkstemp(suffix='.ini')
+        with os.fdopen(fd, 'w') as f:
+            f.write("[output]\nsegmentDuration = 6\n")
+
+    def tearDown(self):
+        os.remove(self.filename)
+
+    def test_read_only(self):
+        snapshot = config.read_config(self.filename)
+        self.assertEqual(snapshot['output'].getint('segmentDuration'), 6)
+        with self.assertRaises(TypeError):
+            snapshot['output']['segmentDuration'] = '10'
+        with self.assertRaises(TypeError):
+            snapshot.read(self.filename)
+
+    def test_environment_override(self):
+        with mock.patch.dict(os.environ, {'CASTERPAK_OUTPUT_SEGMENTDURATION': '4'}):
+            snapshot = config.read_config(self.filename)
+        self.assertEqual(snapshot['output'].getint('segmentDuration'), 4)
+
+    def test_get_config_is_cached_until_reload(self):
+        read_config = config.read_config
+        with mock.patch.object(config, '_snapshot', None), \
+                mock.patch.object(config, 'read_config', side_effect=lambda: read_config(self.filename)):
+            first = config.get_config()
+            self.assertIs(config.get_config(), first)
+            self.assertEqual(config.read_config.call_count, 1)
+
+            reloaded = config.reload_config()
+            self.assertIsNot(reloaded, first)
+            self.assertIs(config.get_config(), reloaded)
+
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(ConfigSnapshotTestCase)
+    return suite
+
+
+if __name__ == "__main__":
+    runner = unittest.TextTestRunner()
+    runner.run(suite())
@@ -0,0 +1,68 @@
+#Copyright (c) 2022, Michael McFadden & Radio Free Asia
+#BSD 3-Clause License
+#See file LICENCE or visit https://github.com/flipmcf/CasterPak/blob/master/LICENSE
+import os
+import tempfile
+import unittest
+from configparser import ConfigParser
+
+from flask import Flask
+from werkzeug.exceptions import NotFound
+
+from casterpak.routes import send_output_file
+
+
+class DeliveryTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        os.makedirs(os.path.join(self.directory.name, 'x', 'video 1.mp4'))
+        self.segment = os.path.join(self.directory.name, 'x', 'video 1.mp4', 'segment-0.ts')
+        with open(self.segment, 'wb') as f:
+            f.write(b'\x47' * 188)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def send(self, delivery, path=None):
+        parser = ConfigParser()
+        parser.read_dict({'output': {'segmentParentPath': self.directory.name, 'delivery': delivery}})
+        app = Flask(__name__)
+        app.config['output'] = parser['output']
+        with app.test_request_context():
+            response = send_output_file(path or self.segment, mimetype='video/MP2T')
+            response.direct_passthrough = False
+            return response.status_code, response.headers, response.get_data()
+
+    def test_flask(self):
+        status, headers, data = self.send('flask')
+        self.assertEqual(status, 200)
+        self.assertEqual(data, b'\x47' * 188)
+        self.assertNotIn('X-Accel-Redirect', headers)
+
+    def test_x_accel_redirect(self):
+        status, headers, data = self.send('x-accel-redirect')
+        self.assertEqual(status, 200)
+        self.assertEqual(data, b'')
+        self.assertEqual(headers['X-Accel-Redirect'], '/_segments/x/video%201.mp4/segment-0.ts')
+        self.assertEqual(headers['Content-Type'], 'video/MP2T')
+
+    def test_x_sendfile(self):
+        status, headers, data = self.send('x-sendfile')
+        self.assertEqual(data, b'')
+        self.assertEqual(headers['X-Sendfile'], self.segment)
+
+    def test_outside_segment_directory(self):
+        with self.assertRaises(NotFound):
+            self.send('x-accel-redirect', os.path.join(self.directory.name, '..', 'etc', 'passwd'))
+
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(DeliveryTestCase)
+    return suite
+
+
+if __name__ == "__main__":
+    runner = unittest.TextTestRunner()
+    runner.run(suite())
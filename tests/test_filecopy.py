@@ -0,0 +1,97 @@
+#Copyright (c) 2022, Michael McFadden & Radio Free Asia
+#BSD 3-Clause License
+#See file LICENCE or visit https://github.com/flipmcf/CasterPak/blob/master/LICENSE
+import os
+import time
+import types
+import tempfile
+import unittest
+from unittest import mock
+
+from vodhls.filecopy import copy_file, ShortCopy
+
+
+class CopyFileTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.source = os.path.join(self.directory.name, 'source.mp4')
+        self.content = os.urandom(3 * 1024 * 1024 + 17)
+        with open(self.source, 'wb') as f:
+            f.write(self.content)
+        self.destination = os.path.join(self.directory.name, 'cached.mp4')
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def assert_copied(self):
+        with open(self.destination, 'rb') as f:
+            self.assertEqual(f.read(), self.content)
+
+    def test_hardlink_on_same_filesystem(self):
+        result = copy_file(self.source, self.destination)
+        self.assertEqual(result.method, 'hardlink')
+        self.assertEqual(result.bytes, len(self.content))
+        self.assertTrue(os.path.samefile(self.source, self.destination))
+
+    def test_each_copy_method(self):
+        for method in ('reflink', 'copy_file_range', 'sendfile', 'copy'):
+            with self.subTest(method=method):
+                result = copy_file(self.source, self.destination, methods=[method], chunk_size=1024 * 1024)
+                # falls back to a plain copy where the method isn't supported
+                self.assertIn(result.method, (method, 'copy'))
+                self.assert_copied()
+                self.assertFalse(os.path.samefile(self.source, self.destination))
+                os.remove(self.destination)
+
+    def test_throughput_limit(self):
+        start = time.monotonic()
+        copy_file(self.source, self.destination, methods=['sendfile'], chunk_size=256 * 1024,
+                  max_bytes_per_second=8 * 1024 * 1024)
+        self.assertGreaterEqual(time.monotonic() - start, 0.3)
+        self.assert_copied()
+
+    def test_missing_source(self):
+        with self.assertRaises(FileNotFoundError):
+            copy_file(self.source + '.missing', self.destination)
+        self.assertFalse(os.path.exists(self.destination))
+
+    def test_unknown_method(self):
+        with self.assertRaises(ValueError):
+            copy_file(self.source, self.destination, methods=['teleport'])
+        # rejected before anything is copied
+        with self.assertRaises(ValueError):
+            copy_file(self.source, self.destination, methods=['sendfile', 'teleport'])
+        self.assertFalse(os.path.exists(self.destination))
+
+    def test_kernel_copy_stops_short(self):
+        sendfile = os.sendfile
+        calls = []
+
+        def sendfile_once(*args):
+            calls.append(args)
+            return sendfile(*args) if len(calls) == 1 else 0
+
+        with mock.patch('os.sendfile', sendfile_once):
+            result = copy_file(self.source, self.destination, methods=['sendfile'], chunk_size=1024 * 1024)
+        self.assertEqual(result.method, 'copy')
+        self.assert_copied()
+
+    def test_source_shrank(self):
+        # the source is shorter than when the copy started: no method can copy all of it
+        stat = types.SimpleNamespace(st_size=len(self.content) + 100)
+        with mock.patch('vodhls.filecopy.os.stat', return_value=stat):
+            with self.assertRaises(ShortCopy):
+                copy_file(self.source, self.destination, methods=['copy_file_range', 'sendfile'])
+        self.assertFalse(os.path.exists(self.destination))
+
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(CopyFileTestCase)
+    return suite
+
+
+if __name__ == "__main__":
+    runner = unittest.TextTestRunner()
+    runner.run(suite())
@@ -0,0 +1,227 @@
+#Copyright (c) 2022, Michael McFadden & Radio Free Asia
+#BSD 3-Clause License
+#See file LICENCE or visit https://github.com/flipmcf/CasterPak/blob/master/LICENSE
+import io
+import os
+import re
+import json
+import tempfile
+import threading
+import unittest
+from unittest import mock
+from hashlib import blake2b
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from vodhls import httpfetch
+from vodhls import segmenter
+from vodhls.httpfetch import HttpFetcher, PartialDownload, PART_SUFFIX, PROGRESS_SUFFIX
+from tests.mp4_fixtures import build_mp4
+
+
+class OriginHandler(BaseHTTPRequestHandler):
+    """ serves server.files, with byte ranges if server.ranges is set """
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_HEAD(self):
+        self.respond(body=False)
+
+    def do_GET(self):
+        self.respond(body=True)
+
+    def respond(self, body):
+        server = self.server
+        content = server.files.get(self.path)
+        range_header = self.headers.get('Range')
+        server.requests.append((self.command, self.path, range_header))
+        if content is None:
+            self.send_error(404)
+            return
+
+        start, end = 0, len(content)
+        status = 200
+        if server.ranges and range_header and self.headers.get('If-Range', server.etag) == server.etag:
+            first, last = re.match(r'bytes=(\d+)-(\d+)', range_header).groups()
+            start, end = int(first), min(int(last) + 1, len(content))
+            status = 206
+
+        self.send_response(status)
+        self.send_header('Content-Length', str(end - start))
+        self.send_header('ETag', server.etag)
+        if server.ranges:
+            self.send_header('Accept-Ranges', 'bytes')
+            if status == 206:
+                self.send_header('Content-Range', f'bytes {start}-{end - 1}/{len(content)}')
+        self.end_headers()
+        if body:
+            self.wfile.write(content[start:end])
+
+
+class HttpFetcherTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), OriginHandler)
+        self.server.content = os.urandom(1000 * 1024 + 123)
+        self.server.files = {'/videos/video.mp4': self.server.content}
+        self.server.ranges = True
+        self.server.etag = '"v1"'
+        self.server.requests = []
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+        self.url = f'http://127.0.0.1:{self.server.server_address[1]}/videos/video.mp4'
+        self.directory = tempfile.TemporaryDirectory()
+        self.destination = os.path.join(self.directory.name, 'videos', 'video.mp4')
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.directory.cleanup()
+
+    def fetcher(self, **kwargs):
+        kwargs.setdefault('piece_size', 100 * 1024)
+        return HttpFetcher(buffer_size=16 * 1024, **kwargs)
+
+    def range_requests(self):
+        return [request for request in self.server.requests if request[0] == 'GET' and request[2]]
+
+    def bytes_fetched(self):
+        total = 0
+        for _, _, range_header in self.range_requests():
+            first, last = re.match(r'bytes=(\d+)-(\d+)', range_header).groups()
+            total += min(int(last) + 1, len(self.server.content)) - int(first)
+        return total
+
+    def assert_fetched(self, content_hash):
+        with open(self.destination, 'rb') as f:
+            self.assertEqual(f.read(), self.server.content)
+        self.assertEqual(content_hash, blake2b(self.server.content, digest_size=16).hexdigest())
+        self.assertFalse(os.path.exists(self.destination + PART_SUFFIX))
+        self.assertFalse(os.path.exists(self.destination + PART_SUFFIX + PROGRESS_SUFFIX))
+
+    def test_parallel_ranges(self):
+        content_hash = self.fetcher(connections=4).fetch(self.url, self.destination)
+        self.assert_fetched(content_hash)
+        self.assertEqual(len(self.range_requests()), 11)
+
+    def test_no_ranges(self):
+        self.server.ranges = False
+        content_hash = self.fetcher(connections=4).fetch(self.url, self.destination)
+        self.assert_fetched(content_hash)
+        self.assertEqual(self.range_requests(), [])
+
+    def test_resume(self):
+        piece_size = 100 * 1024
+        part = self.destination + PART_SUFFIX
+        os.makedirs(os.path.dirname(part))
+        # an earlier attempt got the first three pieces
+        with open(part, 'wb') as f:
+            f.write(self.server.content[:3 * piece_size])
+        with open(part + PROGRESS_SUFFIX, 'w') as f:
+            json.dump({'url': self.url, 'size': len(self.server.content), 'validator': self.server.etag,
+                       'done': [0, piece_size, 2 * piece_size]}, f)
+
+        content_hash = self.fetcher(connections=1).fetch(self.url, self.destination)
+        self.assert_fetched(content_hash)
+        self.assertEqual(len(self.range_requests()), 8)
+        self.assertEqual(self.range_requests()[0][2], f'bytes={3 * piece_size}-{4 * piece_size - 1}')
+
+    def test_changed_file_starts_over(self):
+        piece_size = 100 * 1024
+        part = self.destination + PART_SUFFIX
+        os.makedirs(os.path.dirname(part))
+        with open(part, 'wb') as f:
+            f.write(b'\x00' * piece_size)
+        with open(part + PROGRESS_SUFFIX, 'w') as f:
+            json.dump({'url': self.url, 'size': len(self.server.content), 'validator': '"v0"', 'done': [0]}, f)
+
+        content_hash = self.fetcher(connections=2).fetch(self.url, self.destination)
+        self.assert_fetched(content_hash)
+        self.assertEqual(len(self.range_requests()), 11)
+
+    def test_not_found(self):
+        with self.assertRaises(FileNotFoundError):
+            self.fetcher().fetch(self.url + '.missing', self.destination)
+        self.assertFalse(os.path.exists(self.destination))
+
+    def partial_download(self, moov_first):
+        self.server.content = build_mp4(seconds=20, moov_first=moov_first)
+        self.server.files['/videos/video.mp4'] = self.server.content
+        with mock.patch.object(httpfetch, 'HEADER_FETCH_SIZE', 1024):
+            partial = PartialDownload(self.fetcher(), self.url, self.destination)
+            boxes = partial.fetch_header()
+        self.assertEqual([type for type, _, _ in boxes], ['ftyp', 'moov', 'mdat'] if moov_first else
+                         ['ftyp', 'mdat', 'moov'])
+        return partial
+
+    def assert_cuts_segment(self, partial):
+        index = segmenter.load_index(partial.part, 6, identity=partial.identity)
+        partial.ensure(index.byte_ranges(1))
+        cut = io.BytesIO()
+        index.write_segment(1, cut)
+
+        full_copy = os.path.join(self.directory.name, 'full.mp4')
+        with open(full_copy, 'wb') as f:
+            f.write(self.server.content)
+        expected = io.BytesIO()
+        segmenter.SegmentIndex(full_copy, 6).write_segment(1, expected)
+        self.assertEqual(cut.getvalue(), expected.getvalue())
+
+        # only the moov box and one segment were fetched
+        self.assertLess(self.bytes_fetched(), len(self.server.content) / 2)
+
+    def test_partial_moov_first(self):
+        self.assert_cuts_segment(self.partial_download(moov_first=True))
+
+    def test_partial_moov_at_end(self):
+        self.assert_cuts_segment(self.partial_download(moov_first=False))
+
+    def test_partial_then_full_fetch(self):
+        partial = self.partial_download(moov_first=False)
+        fetched = self.bytes_fetched()
+        partial.ensure([(0, 1024)])
+        # already there, nothing more is requested
+        self.assertEqual(self.bytes_fetched(), fetched)
+
+        content_hash = self.fetcher(connections=2).fetch(self.url, self.destination)
+        self.assert_fetched(content_hash)
+
+    def test_partial_ranges_shared(self):
+        partial = self.partial_download(moov_first=False)
+        partial.ensure([(2000, 3000)])
+        fetched = self.bytes_fetched()
+
+        # another process, with its own PartialDownload of the same file
+        with mock.patch.object(httpfetch, 'HEADER_FETCH_SIZE', 1024):
+            other = PartialDownload(self.fetcher(), self.url, self.destination)
+            other.fetch_header()
+        other.ensure([(2000, 3000)])
+        self.assertEqual(self.bytes_fetched(), fetched)
+        self.assertEqual(other.read(2000, 3000), self.server.content[2000:3000])
+
+    def test_partial_after_full_fetch(self):
+        partial = self.partial_download(moov_first=False)
+        content_hash = self.fetcher(connections=2).fetch(self.url, self.destination)
+        fetched = self.bytes_fetched()
+
+        # read from the published file, the '.part' file isn't made again
+        self.assertEqual(partial.read(0, len(self.server.content)), self.server.content)
+        self.assertEqual(self.bytes_fetched(), fetched)
+        self.assert_fetched(content_hash)
+
+    def test_partial_needs_ranges(self):
+        self.server.ranges = False
+        with self.assertRaises(NotImplementedError):
+            PartialDownload(self.fetcher(), self.url, self.destination)
+
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(HttpFetcherTestCase)
+    return suite
+
+
+if __name__ == "__main__":
+    runner = unittest.TextTestRunner()
+    runner.run(suite())
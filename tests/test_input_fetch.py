@@ -0,0 +1,87 @@
+#Copyright (c) 2022, Michael McFadden & Radio Free Asia
+#BSD 3-Clause License
+#See file LICENCE or visit https://github.com/flipmcf/CasterPak/blob/master/LICENSE
+import os
+import time
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+import config
+import cachedb
+from vodhls.media_manifest_base import MediaManager_Base
+from vodhls.media_manifest_filesystem import MediaManager_filesystem
+
+
+class InputFetchTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        root = self.directory.name
+        for name in ('videos/x', 'cache', 'segments'):
+            os.makedirs(os.path.join(root, name))
+        with open(os.path.join(root, 'videos', 'x', 'video.mp4'), 'wb') as f:
+            f.write(os.urandom(256 * 1024))
+
+        config_file = os.path.join(root, 'config.ini')
+        with open(config_file, 'w') as f:
+            f.write(f"[input]\ninput_type = filesystem\nvideoCachePath = {root}/cache\n"
+                    f"[output]\nsegmentParentPath = {root}/segments\nlock_timeout = 10\n"
+                    f"[filesystem]\nvideoParentPath = {root}/videos\ncache_input = True\n")
+        snapshot = config.read_config(config_file)
+
+        dbname = os.path.join(root, 'cache.db')
+        cachedb.initialize_cache_db(dbname)
+        self.patches = [
+            mock.patch('vodhls.media_manifest_base.get_config', return_value=snapshot),
+            mock.patch.object(MediaManager_Base, 'db', cachedb.CacheDB(dbname, cache_name=cachedb.INPUT_FILE_CACHE)),
+        ]
+        for patch in self.patches:
+            patch.start()
+
+    def tearDown(self):
+        cachedb.flush_access_records()
+        for patch in self.patches:
+            patch.stop()
+        cachedb.close_connections()
+        self.directory.cleanup()
+
+    def test_one_copy_for_simultaneous_misses(self):
+        copies = []
+        fetch_and_cache = MediaManager_filesystem.fetch_and_cache
+
+        def slow_copy(manager):
+            copies.append(manager)
+            time.sleep(0.3)
+            fetch_and_cache(manager)
+
+        with mock.patch.object(MediaManager_filesystem, 'fetch_and_cache', slow_copy):
+            managers = [MediaManager_filesystem('x/video.mp4') for _ in range(4)]
+            threads = [threading.Thread(target=manager.manage_input_file) for manager in managers]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        self.assertEqual(len(copies), 1)
+        with open(managers[0].source_file, 'rb') as source, open(managers[0].cached_filename, 'rb') as cached:
+            self.assertEqual(source.read(), cached.read())
+        self.assertEqual(os.listdir(os.path.dirname(managers[0].cached_filename)), ['video.mp4'])
+
+    def test_failed_copy_leaves_nothing(self):
+        manager = MediaManager_filesystem('x/missing.mp4')
+        with self.assertRaises(FileNotFoundError):
+            manager.manage_input_file()
+        self.assertEqual(os.listdir(os.path.join(self.directory.name, 'cache', 'x')), [])
+
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(InputFetchTestCase)
+    return suite
+
+
+if __name__ == "__main__":
+    runner = unittest.TextTestRunner()
+    runner.run(suite())
@@ -0,0 +1,214 @@
+#Copyright (c) 2022, Michael McFadden & Radio Free Asia
+#BSD 3-Clause License
+#See file LICENCE or visit https://github.com/flipmcf/CasterPak/blob/master/LICENSE
+import os
+import time
+import tempfile
+import threading
+import unittest
+from unittest import mock
+from configparser import ConfigParser
+
+import cachedb
+from vodhls import EncodingError, PackagingPending
+from vodhls import jobs
+
+
+class PackagingJobDBTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.dbname = os.path.join(self.directory.name, 'cache.db')
+        cachedb.initialize_cache_db(self.dbname)
+        self.db = cachedb.PackagingJobDB(self.dbname)
+
+    def tearDown(self):
+        cachedb.close_connections()
+        self.directory.cleanup()
+
+    def test_enqueue_joins_active_job(self):
+        first = self.db.enqueue('rendition', 'x/a.mp4', {'filename': 'x/a.mp4'})
+        self.assertEqual(self.db.enqueue('rendition', 'x/a.mp4', {'filename': 'x/a.mp4'}), first)
+
+        self.assertEqual(self.db.claim('worker')['id'], first)
+        self.assertEqual(self.db.enqueue('rendition', 'x/a.mp4', {'filename': 'x/a.mp4'}), first)
+
+        self.db.finish(first)
+        self.assertEqual(self.db.get(first), {'state': 'done', 'error': None})
+        # finished jobs aren't joined
+        self.assertNotEqual(self.db.enqueue('rendition', 'x/a.mp4', {'filename': 'x/a.mp4'}), first)
+
+    def test_claim_by_priority(self):
+        master = self.db.enqueue('master', 'x/master', {}, priority=2)
+        rendition = self.db.enqueue('rendition', 'x/a.mp4', {'filename': 'x/a.mp4'}, priority=1)
+        segment = self.db.enqueue('segment', 'x/a.mp4/segment-3.ts', {'segment': 'segment-3.ts'}, priority=0)
+
+        claimed = [self.db.claim('worker') for _ in range(3)]
+        self.assertEqual([job['id'] for job in claimed], [segment, rendition, master])
+        self.assertEqual(claimed[0]['arguments'], {'segment': 'segment-3.ts'})
+        self.assertIsNone(self.db.claim('worker'))
+
+    def test_urgent_job_joins_and_goes_first(self):
+        ahead = self.db.enqueue('lookahead', 'x/a.mp4/segment-4.ts', {'segment': 'segment-4.ts'}, priority=3)
+        master = self.db.enqueue('master', 'x/master', {}, priority=2)
+        # the player asks for the segment that was queued to be cut ahead
+        self.assertEqual(self.db.enqueue('segment', 'x/a.mp4/segment-4.ts', {'segment': 'segment-4.ts'}), ahead)
+        # and a later lookahead doesn't push it back
+        self.assertEqual(self.db.enqueue('lookahead', 'x/a.mp4/segment-4.ts', {'segment': 'segment-4.ts'},
+                                         priority=3), ahead)
+
+        claimed = self.db.claim('worker')
+        self.assertEqual((claimed['id'], claimed['kind']), (ahead, 'segment'))
+        self.assertEqual(self.db.claim('worker')['id'], master)
+
+    def test_requeue_and_stale_jobs(self):
+        job = self.db.enqueue('rendition', 'x/a.mp4', {})
+        self.db.claim('dead-worker')
+        self.assertEqual(self.db.requeue(worker='other-worker'), 0)
+        self.assertEqual(self.db.requeue(worker='dead-worker'), 1)
+        self.assertEqual(self.db.claim('worker')['id'], job)
+
+        # a job running for longer than stale_after is claimed again
+        self.assertIsNone(self.db.claim('worker', stale_after=60))
+        with mock.patch('cachedb.datetime') as clock:
+            clock.datetime.now.return_value.timestamp.return_value = time.time() + 120
+            self.assertEqual(self.db.claim('worker', stale_after=60)['id'], job)
+
+    def test_prune(self):
+        job = self.db.enqueue('rendition', 'x/a.mp4', {})
+        self.db.claim('worker')
+        self.db.finish(job, 'EncodingError')
+        self.assertEqual(self.db.prune(age_in_minutes=10), 0)
+        self.assertEqual(self.db.get(job), {'state': 'failed', 'error': 'EncodingError'})
+        self.assertEqual(self.db.prune(age_in_minutes=-1), 1)
+        self.assertIsNone(self.db.get(job))
+
+
+class RunTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        dbname = os.path.join(self.directory.name, 'cache.db')
+        cachedb.initialize_cache_db(dbname)
+        self.db = cachedb.PackagingJobDB(dbname)
+
+        self.calls = []
+        parser = ConfigParser()
+        parser.read_dict({'packager': {'queue': 'True', 'wait': '1', 'retry_after': '7'}})
+        self.patches = [
+            mock.patch.object(jobs, 'job_db', self.db),
+            mock.patch('vodhls.jobs.get_config', return_value=parser),
+            mock.patch.dict(jobs.KINDS, {'test': (self.package, 0)}),
+        ]
+        for patch in self.patches:
+            patch.start()
+
+    def tearDown(self):
+        for patch in self.patches:
+            patch.stop()
+        cachedb.close_connections()
+        self.directory.cleanup()
+
+    def package(self, name, fail=None):
+        self.calls.append(name)
+        if fail == 'missing':
+            raise FileNotFoundError(name)
+        if fail == 'broken':
+            raise RuntimeError(name)
+
+    def packager(self, jobs_to_run=1):
+        """ a packager worker, in a thread """
+        def work():
+            done = 0
+            while done < jobs_to_run:
+                job = self.db.claim('test-worker')
+                if job is None:
+                    time.sleep(0.05)
+                    continue
+                self.db.finish(job['id'], jobs.run_job(job))
+                done += 1
+            cachedb.close_connections()
+        thread = threading.Thread(target=work)
+        thread.start()
+        return thread
+
+    def test_inline(self):
+        with mock.patch('vodhls.jobs.queued', return_value=False):
+            jobs.run('test', 'a', name='a')
+        self.assertEqual(self.calls, ['a'])
+
+    def test_waits_for_the_packager(self):
+        thread = self.packager()
+        jobs.run('test', 'a', name='a')
+        thread.join()
+        self.assertEqual(self.calls, ['a'])
+
+    def test_requests_share_a_job(self):
+        errors = []
+
+        def request():
+            try:
+                jobs.run('test', 'a', name='a')
+            except Exception as e:
+                errors.append(e)
+            cachedb.close_connections()
+
+        requests = [threading.Thread(target=request) for _ in range(4)]
+        for thread in requests:
+            thread.start()
+        time.sleep(0.2)
+        thread = self.packager()
+        for request_thread in requests:
+            request_thread.join()
+        thread.join()
+        self.assertEqual((self.calls, errors), (['a'], []))
+
+    def test_failures_reach_the_request(self):
+        thread = self.packager(jobs_to_run=2)
+        with self.assertRaises(FileNotFoundError):
+            jobs.run('test', 'a', name='a', fail='missing')
+        with self.assertRaises(EncodingError):
+            jobs.run('test', 'b', name='b', fail='broken')
+        thread.join()
+
+    def test_job_gone(self):
+        # the job is done and pruned before the request looks: it is queued again, not taken as done
+        get = self.db.get
+        pruned = []
+
+        def get_after_prune(job_id):
+            job = self.db.claim('test-worker')
+            if job is not None:
+                self.db.finish(job['id'], jobs.run_job(job))
+                if not pruned:
+                    pruned.append(self.db.prune(-1))
+            return get(job_id)
+
+        with mock.patch.object(self.db, 'get', get_after_prune):
+            jobs.run('test', 'a', name='a')
+        self.assertEqual(self.calls, ['a', 'a'])
+
+    def test_submit_doesnt_wait(self):
+        job_id = jobs.submit('test', 'a', name='a')
+        self.assertEqual(self.db.get(job_id), {'state': 'queued', 'error': None})
+        self.assertEqual(self.calls, [])
+        self.packager().join()
+        self.assertEqual(self.calls, ['a'])
+
+    def test_pending(self):
+        with self.assertRaises(PackagingPending) as raised:
+            jobs.run('test', 'a', name='a')
+        self.assertEqual(raised.exception.retry_after, 7)
+        self.assertEqual(self.calls, [])
+
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(PackagingJobDBTestCase)
+    suite.addTest(RunTestCase)
+    return suite
+
+
+if __name__ == "__main__":
+    runner = unittest.TextTestRunner()
+    runner.run(suite())
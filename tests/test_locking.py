@@ -0,0 +1,87 @@
+#Copyright (c) 2022, Michael McFadden & Radio Free Asia
+#BSD 3-Clause License
+#See file LICENCE or visit https://github.com/flipmcf/CasterPak/blob/master/LICENSE
+import os
+import time
+import tempfile
+import threading
+import unittest
+
+from vodhls import LockTimeout
+from vodhls.locking import FileLock, lock_path, prune_lock_files, LOCK_DIR
+
+
+class FileLockTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.lock_dir = os.path.join(self.directory.name, LOCK_DIR)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def age(self, path, seconds):
+        then = time.time() - seconds
+        os.utime(path, (then, then))
+
+    def test_no_wait(self):
+        path = lock_path(self.directory.name, 'segment', 'x/v.mp4/segment-1.ts')
+        with FileLock(path):
+            start = time.monotonic()
+            with self.assertRaises(LockTimeout):
+                FileLock(path, timeout=0, poll_interval=10).acquire()
+            self.assertLess(time.monotonic() - start, 1)
+        with FileLock(path, timeout=0):
+            pass
+
+    def test_prune(self):
+        held = lock_path(self.directory.name, 'segment', 'x/v.mp4/segment-1.ts')
+        unused = lock_path(self.directory.name, 'segment', 'x/v.mp4/segment-2.ts')
+        recent = lock_path(self.directory.name, 'input', 'x/v.mp4')
+        for path in (unused, recent):
+            with FileLock(path):
+                pass
+        slot = os.path.join(self.lock_dir, 'bento4-slot-0.lock')
+        open(slot, 'w').close()
+
+        with FileLock(held):
+            for path in (held, unused, slot):
+                self.age(path, 600)
+            self.assertEqual(prune_lock_files(self.lock_dir, 300), 1)
+        self.assertEqual(sorted(os.listdir(self.lock_dir)),
+                         sorted(os.path.basename(path) for path in (held, recent, slot)))
+        self.assertEqual(prune_lock_files(os.path.join(self.directory.name, 'missing'), 300), 0)
+
+    def test_lock_file_pruned_while_waiting(self):
+        path = lock_path(self.directory.name, 'package', 'x/v.mp4')
+        holder = FileLock(path)
+        holder.acquire()
+        waiter = FileLock(path, timeout=5, poll_interval=0.3)
+        thread = threading.Thread(target=waiter.acquire)
+        thread.start()
+        time.sleep(0.1)
+
+        # the holder lets go and the file is pruned before the waiter gets it
+        self.age(path, 600)
+        holder.release()
+        self.assertEqual(prune_lock_files(self.lock_dir, 300), 1)
+        thread.join()
+
+        # the waiter holds the lock file that is in place now, so nobody else can take it
+        self.assertTrue(os.path.exists(path))
+        with self.assertRaises(LockTimeout):
+            FileLock(path, timeout=0.1).acquire()
+        waiter.release()
+        with FileLock(path, timeout=0.1):
+            pass
+
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(FileLockTestCase)
+    return suite
+
+
+if __name__ == "__main__":
+    runner = unittest.TextTestRunner()
+    runner.run(suite())
@@ -0,0 +1,165 @@
+#Copyright (c) 2022, Michael McFadden & Radio Free Asia
+#BSD 3-Clause License
+#See file LICENCE or visit https://github.com/flipmcf/CasterPak/blob/master/LICENSE
+import os
+import json
+import struct
+import tempfile
+import unittest
+from array import array
+from types import SimpleNamespace
+
+from bento4.mp4boxes import ReadMp4Info, CodecsString, Mp4FileMap
+from bento4.mp4utils import MediaSource, Mp4File, WalkAtoms
+
+from tests.mp4_fixtures import build_mp4, box, full_box, trak, avc1_entry
+
+
+def build_fragmented_mp4(fragments=3, samples_per_fragment=50):
+    """ :return: bytes of a fragmented mp4 with one H.264 track, 2 second fragments at 25fps """
+    mvhd = full_box('mvhd', 0, 0, struct.pack('>IIII', 0, 0, 1000, 0), b'\x00' * 80)
+    trex = full_box('trex', 0, 0, struct.pack('>IIIII', 1, 1, 1000, 0, 0))
+    moov = box('moov', mvhd, trak(1, 'vide', 25000, [], [], [], 1, avc1_entry()), box('mvex', trex))
+
+    data = [box('ftyp', b'iso6', struct.pack('>I', 0), b'iso6dash'), moov]
+    for sequence in range(fragments):
+        sizes = [100 + sequence] * samples_per_fragment
+        # default sample duration comes from the trex box, sample sizes from the trun
+        traf = box('traf',
+                   full_box('tfhd', 0, 0x020000, struct.pack('>I', 1)),
+                   full_box('trun', 0, 0x200, struct.pack('>I', len(sizes)), struct.pack(f'>{len(sizes)}I', *sizes)))
+        data.append(box('moof', full_box('mfhd', 0, 0, struct.pack('>I', sequence + 1)), traf))
+        data.append(box('mdat', b''.join(bytes([sequence]) * size for size in sizes)))
+    return b''.join(data)
+
+
+class Mp4BoxesTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        # a path that doesn't exist: any attempt to run mp4info or mp4dump fails
+        self.options = SimpleNamespace(exec_dir=os.path.join(self.directory.name, 'bin'),
+                                       min_buffer_time=0.0, debug=False, verbose=False)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def write(self, name, data):
+        filename = os.path.join(self.directory.name, name)
+        with open(filename, 'wb') as f:
+            f.write(data)
+        return filename
+
+    def test_media_source_info(self):
+        filename = self.write('input.mp4', build_mp4(seconds=4))
+        info = MediaSource(self.options, filename).mp4_info
+
+        self.assertFalse(info['movie']['fragments'])
+        video, audio = info['tracks']
+        self.assertEqual((video['id'], video['type'], video['language']), (1, 'Video', 'eng'))
+        self.assertEqual(video['media']['timescale'], 25000)
+        self.assertEqual(video['media']['sample_count'], 100)
+        self.assertEqual(video['sample_descriptions'][0]['codecs_string'], 'avc1.64001F')
+        self.assertEqual((video['sample_descriptions'][0]['width'], video['sample_descriptions'][0]['height']),
+                         (1280, 720))
+
+        self.assertEqual((audio['id'], audio['type']), (2, 'Audio'))
+        self.assertEqual(audio['sample_descriptions'][0]['codecs_string'], 'mp4a.40.2')
+        self.assertEqual(audio['sample_descriptions'][0]['sample_rate'], 44100)
+        self.assertEqual(audio['sample_descriptions'][0]['channels'], 2)
+
+    def test_fragmented_file(self):
+        filename = self.write('fragmented.mp4', build_fragmented_mp4())
+        media_source = MediaSource(self.options, filename)
+        self.assertTrue(media_source.mp4_info['movie']['fragments'])
+
+        mp4_file = Mp4File(self.options, media_source)
+        track = mp4_file.tracks[1]
+        self.assertEqual(track.timescale, 25000)
+        self.assertEqual(track.default_sample_duration, 1000)
+        self.assertEqual(track.sample_counts, array('L', [50, 50, 50]))
+        self.assertEqual(track.segment_scaled_durations, array('q', [50000, 50000, 50000]))
+        self.assertEqual(track.segment_durations, array('d', [2.0, 2.0, 2.0]))
+        self.assertEqual(track.total_sample_count, 150)
+        moof_sizes = [atom.size for atom in mp4_file.atoms if atom.type == 'moof']
+        self.assertEqual(track.segment_sizes, array('Q', [moof_sizes[i] + 8 + 50 * (100 + i) for i in range(3)]))
+        self.assertEqual(track.media_size, sum(track.segment_sizes))
+        self.assertEqual(track.average_segment_duration, 2.0)
+        self.assertEqual(track.max_segment_bitrate, max(track.segment_bitrates[:2]))
+        with self.assertRaises(AttributeError):
+            track.not_a_track_field = 1
+
+    def test_saved_analysis(self):
+        filename = self.write('fragmented.mp4', build_fragmented_mp4())
+        media_source = MediaSource(self.options, filename)
+        analysis = json.loads(json.dumps(Mp4File(self.options, media_source).analysis()))
+
+        # a saved analysis describes the file without reading it
+        os.remove(filename)
+        restored = Mp4File(self.options, MediaSource(self.options, filename, analysis=analysis))
+        track = restored.tracks[1]
+        self.assertEqual(track.codec, 'avc1.64001F')
+        self.assertEqual(track.segment_durations, array('d', [2.0, 2.0, 2.0]))
+        self.assertEqual(track.total_sample_count, 150)
+        self.assertEqual(len(restored.segments), 3)
+        self.assertEqual(restored.analysis(), analysis)
+        self.assertGreater(track.bandwidth, 0)
+
+    def test_walk_atoms(self):
+        ftyp = box('ftyp', b'isom', struct.pack('>I', 0))
+        # a 64 bit size, then an mdat that runs to the end of the file
+        wide = struct.pack('>I4sQ', 1, b'free', 16 + 100) + b'\x00' * 100
+        mdat = struct.pack('>I4s', 0, b'mdat') + b'\x00' * 1000
+        filename = self.write('atoms.mp4', ftyp + wide + mdat)
+
+        atoms = [(atom.type, atom.size, atom.position) for atom in WalkAtoms(filename)]
+        self.assertEqual(atoms, [('ftyp', len(ftyp), 0), ('free', 116, len(ftyp)),
+                                 ('mdat', 1008, len(ftyp) + 116)])
+        self.assertEqual([atom.type for atom in WalkAtoms(filename, until='mdat')], ['ftyp', 'free'])
+
+        # truncated: the last box runs past the end of the file
+        filename = self.write('truncated.mp4', ftyp + box('mdat', b'\x00' * 1000)[:500] + b'garbage')
+        self.assertEqual([(atom.type, atom.size) for atom in WalkAtoms(filename)],
+                         [('ftyp', len(ftyp)), ('mdat', 1008)])
+
+        self.assertEqual(WalkAtoms(self.write('empty.mp4', b'')), [])
+
+    def test_file_map(self):
+        filename = self.write('fragmented.mp4', build_fragmented_mp4())
+        with Mp4FileMap(filename) as mapped:
+            self.assertEqual([atom.type for atom in mapped.atoms], ['ftyp', 'moov'] + ['moof', 'mdat'] * 3)
+            tkhd = mapped.find('moov/trak/tkhd')
+            self.assertEqual(struct.unpack_from('>I', mapped.data, tkhd.payload_start + 12)[0], 1)
+            self.assertEqual([box.find('traf/tfhd').type for box in mapped.boxes('moof')], ['tfhd'] * 3)
+            self.assertIsNone(mapped.find('moov/trak/nope'))
+
+            mdat = mapped.atoms[3]
+            self.assertIs(mapped.atom_at(mdat.position), mdat)
+            self.assertIs(mapped.atom_at(mdat.position + mdat.size - 1), mdat)
+            self.assertIsNone(mapped.atom_at(os.path.getsize(filename)))
+
+    def test_hevc_codecs_string(self):
+        # Main profile, level 3.1, progressive source flag set
+        hvcc = bytes([1, 0x01, 0x60, 0, 0, 0, 0x90, 0, 0, 0, 0, 0, 93]) + b'\x00' * 10
+        track = SimpleNamespace(coding='hvc1', decoder_config=lambda type: hvcc if type == 'hvcC' else None)
+        self.assertEqual(CodecsString(track), 'hvc1.1.6.L93.90')
+
+    def test_unsupported_input_falls_back(self):
+        # no moov box
+        filename = self.write('no-moov.mp4', box('ftyp', b'isom', struct.pack('>I', 0)) + box('mdat', b'\x00' * 64))
+        with self.assertRaises(ValueError):
+            ReadMp4Info(filename)
+        # the fallback runs mp4info, which isn't there
+        with self.assertRaises(Exception):
+            MediaSource(self.options, filename)
+
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(Mp4BoxesTestCase)
+    return suite
+
+
+if __name__ == "__main__":
+    runner = unittest.TextTestRunner()
+    runner.run(suite())
@@ -0,0 +1,129 @@
+#Copyright (c) 2022, Michael McFadden & Radio Free Asia
+#BSD 3-Clause License
+#See file LICENCE or visit https://github.com/flipmcf/CasterPak/blob/master/LICENSE
+import random
+import unittest
+
+from bento4.mp4utils import ComputeBandwidth
+
+
+def scan_every_run(buffer_time, sizes, durations):
+    """ ComputeBandwidth as bento4 wrote it, O(n²) in the number of segments """
+    bandwidth = 0.0
+    for i in range(len(sizes)):
+        accu_size     = 0
+        accu_duration = 0
+        buffer_size = (buffer_time*bandwidth)/8.0
+        for j in range(i, len(sizes)):
+            accu_size     += sizes[j]
+            accu_duration += durations[j]
+            max_avail = buffer_size+accu_duration*bandwidth/8.0
+            if accu_size > max_avail and accu_duration != 0:
+                bandwidth = 8.0*(accu_size-buffer_size)/accu_duration
+                break
+    return int(bandwidth)
+
+
+class ComputeBandwidthTestCase(unittest.TestCase):
+
+    def assert_same(self, buffer_time, sizes, durations):
+        self.assertEqual(ComputeBandwidth(buffer_time, sizes, durations),
+                         scan_every_run(buffer_time, sizes, durations))
+
+    def test_empty_and_single_segment(self):
+        self.assertEqual(ComputeBandwidth(2.0, [], []), 0)
+        self.assertEqual(ComputeBandwidth(0.0, [1000], [2.0]), 4000)
+        self.assertEqual(ComputeBandwidth(2.0, [1000], [0]), 0)
+
+    def test_same_as_scan_over_every_run(self):
+        rng = random.Random(21)
+        for count in (2, 10, 63, 64, 65, 500, 1500):
+            for timescale in (1000, 30000, 90000):
+                with self.subTest(count=count, timescale=timescale):
+                    durations = [rng.randrange(timescale // 2, 5 * timescale) / timescale for _ in range(count)]
+                    sizes = [rng.randrange(10 ** 4, 10 ** 7) for _ in range(count)]
+                    for buffer_time in (0.0, 2.0, rng.uniform(0, 20)):
+                        self.assert_same(buffer_time, sizes, durations)
+
+    def test_bitrate_rising_through_the_file(self):
+        rng = random.Random(22)
+        durations = [2002 / 30000 * rng.randrange(1, 90) for _ in range(2000)]
+        sizes = [int(duration * (100000 + 50 * i) * rng.uniform(0.8, 1.2)) for i, duration in enumerate(durations)]
+        self.assert_same(1.5, sizes, durations)
+
+    def test_bitrate_trending_through_the_file(self):
+        rng = random.Random(24)
+        for trend in (9.0, 0.5, -0.5, -0.9):
+            with self.subTest(trend=trend):
+                durations = [rng.choice((179820, 180000, 180180)) / 90000 for _ in range(1500)]
+                sizes = [int(duration * 500000 * (1 + trend * i / 1500) * rng.uniform(0.5, 1.5))
+                         for i, duration in enumerate(durations)]
+                for buffer_time in (0.0, 2.0, 10.0):
+                    self.assert_same(buffer_time, sizes, durations)
+
+        # no noise: every segment raises the bandwidth, through runs longer than BANDWIDTH_BLOCK
+        durations = [2002 / 30000 * rng.randrange(1, 90) for _ in range(1500)]
+        sizes = [int(duration * (100000 + 50 * i)) for i, duration in enumerate(durations)]
+        self.assert_same(1.5, sizes, durations)
+
+    def test_constant_bitrate_and_empty_segments(self):
+        self.assert_same(0.0, [5000] * 300, [2.0] * 300)
+        self.assert_same(2.0, [5000] * 300, [2002 / 30000] * 300)
+
+        rng = random.Random(23)
+        durations = [rng.choice((0, 0, 1.001, 2.0)) for _ in range(800)]
+        sizes = [rng.randrange(0, 10 ** 5) for _ in range(800)]
+        self.assert_same(2.0, sizes, durations)
+
+    def test_runs_that_fit_exactly(self):
+        # segments of 1 to 3 units at one bitrate, so that many runs fit with nothing to spare and
+        # the decision rests on how the sums round
+        rng = random.Random(25)
+        for unit in (0.1, 0.3, 1 / 3, 0.7, 2002 / 30000, 1001 / 24000):
+            for count in (1, 15, 16, 17, 31, 33, 80, 200):
+                with self.subTest(unit=unit, count=count):
+                    for _ in range(25):
+                        units = [rng.choice((1, 2, 3)) for _ in range(count)]
+                        rate = rng.choice((100, 1000, 12345))
+                        sizes = [max(0, rate * k + rng.choice((0, 0, 0, 0, 1, -1, 5 * rate))) for k in units]
+                        durations = [unit * k for k in units]
+                        for buffer_time in (0.0, unit, 2 * unit, 1.0):
+                            self.assert_same(buffer_time, sizes, durations)
+
+    def test_long_runs_that_fit_exactly(self):
+        rng = random.Random(26)
+        for unit in (1 / 3, 2002 / 30000):
+            with self.subTest(unit=unit):
+                # constant bitrate
+                units = [rng.choice((1, 2, 3)) for _ in range(1000)]
+                durations = [unit * k for k in units]
+                for buffer_time in (0.0, 1.0):
+                    self.assert_same(buffer_time, [1000 * k for k in units], durations)
+
+                # the bitrate rising in steps, each step fitting exactly, with a few segments one byte over
+                sizes = [(1000 + 10 * (i // 50)) * k + (1 if rng.random() < 0.01 else 0) for i, k in enumerate(units)]
+                for buffer_time in (0.0, unit, 1.0):
+                    self.assert_same(buffer_time, sizes, durations)
+
+    def test_long_inputs_with_a_rising_bitrate(self):
+        rng = random.Random(27)
+        for count in (1000, 3000):
+            for timescale, ticks in ((1000, (2000, 2002)), (30000, (1001, 2002, 60060)), (90000, (179820, 180000, 180180))):
+                with self.subTest(count=count, timescale=timescale):
+                    durations = [rng.choice(ticks) / timescale for _ in range(count)]
+                    rise = rng.choice((0.5, 3.0, 9.0))
+                    sizes = [int(duration * 500000 * (1 + rise * i / count) * rng.uniform(0.5, 1.5))
+                             for i, duration in enumerate(durations)]
+                    for buffer_time in (0.0, 2.0, rng.uniform(0, 20)):
+                        self.assert_same(buffer_time, sizes, durations)
+
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(ComputeBandwidthTestCase)
+    return suite
+
+
+if __name__ == "__main__":
+    runner = unittest.TextTestRunner()
+    runner.run(suite())
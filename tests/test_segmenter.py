@@ -0,0 +1,255 @@
+#Copyright (c) 2022, Michael McFadden & Radio Free Asia
+#BSD 3-Clause License
+#See file LICENCE or visit https://github.com/flipmcf/CasterPak/blob/master/LICENSE
+import io
+import os
+import random
+import struct
+import tempfile
+import unittest
+
+from vodhls import mpegts
+from vodhls import segmenter
+from vodhls.segmenter import SegmentIndex, segment_number
+from tests.mp4_fixtures import build_mp4, SPS
+
+
+def demux(data):
+    """ :return: {pid: [(pts, dts, payload), ...]} for every PES in a transport stream """
+    pes = {}
+    current = {}
+    continuity = {}
+    for position in range(0, len(data), mpegts.TS_PACKET_SIZE):
+        packet = data[position:position + mpegts.TS_PACKET_SIZE]
+        assert packet[0] == 0x47
+        start = bool(packet[1] & 0x40)
+        pid = struct.unpack('>H', packet[1:3])[0] & 0x1FFF
+        control = (packet[3] >> 4) & 0x3
+        counter = packet[3] & 0x0F
+        if pid in continuity:
+            assert counter == (continuity[pid] + 1) & 0x0F, 'continuity counter'
+        continuity[pid] = counter
+        payload = packet[4:]
+        if control == 3:
+            payload = payload[1 + payload[0]:]
+        if pid in (mpegts.PAT_PID, mpegts.PMT_PID):
+            section_length = struct.unpack('>H', payload[2:4])[0] & 0x0FFF
+            section = payload[1:4 + section_length]
+            assert mpegts.crc32_mpeg2(section) == 0, 'section CRC'
+            continue
+        if start:
+            current[pid] = bytearray()
+            pes.setdefault(pid, []).append(current[pid])
+        current[pid] += payload
+
+    def timestamp(b):
+        return (((b[0] >> 1) & 0x07) << 30) | (b[1] << 22) | ((b[2] >> 1) << 15) | (b[3] << 7) | (b[4] >> 1)
+
+    result = {}
+    for pid, packets in pes.items():
+        for packet in packets:
+            assert packet[:3] == b'\x00\x00\x01'
+            flags = packet[7]
+            header_length = packet[8]
+            pts = timestamp(packet[9:14])
+            dts = timestamp(packet[14:19]) if flags & 0x40 else pts
+            result.setdefault(pid, []).append((pts, dts, bytes(packet[9 + header_length:])))
+    return result
+
+
+def ts_packets(data):
+    """ yield (pid, payload_unit_start, continuity counter, adaptation field, payload) for each TS packet """
+    for position in range(0, len(data), mpegts.TS_PACKET_SIZE):
+        packet = data[position:position + mpegts.TS_PACKET_SIZE]
+        assert len(packet) == mpegts.TS_PACKET_SIZE and packet[0] == 0x47, 'sync byte'
+        pid = struct.unpack('>H', packet[1:3])[0] & 0x1FFF
+        control = (packet[3] >> 4) & 0x3
+        adaptation = b''
+        payload = packet[4:]
+        if control == 3:
+            adaptation = payload[1:1 + payload[0]]
+            payload = payload[1 + payload[0]:]
+        yield pid, bool(packet[1] & 0x40), packet[3] & 0x0F, adaptation, payload
+
+
+class SegmenterTestCase(unittest.TestCase):
+
+    def setUp(self):
+        fd, self.filename = tempfile.mkstemp(suffix='.mp4')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(build_mp4(seconds=20, fps=25, keyframe_interval=2))
+
+    def tearDown(self):
+        os.remove(self.filename)
+
+    def test_segment_number(self):
+        self.assertEqual(segment_number('segment-169.ts'), 169)
+        self.assertIsNone(segment_number('index_0_av.m3u8'))
+
+    def test_boundaries_on_keyframes(self):
+        index = SegmentIndex(self.filename, 6)
+        self.assertEqual([s['start'] for s in index.segments], [0.0, 6.0, 12.0, 18.0])
+        self.assertEqual([s['duration'] for s in index.segments], [6.0, 6.0, 6.0, 2.0])
+
+        # keyframes every 2 seconds, so a 5 second target rounds up to the next keyframe
+        index = SegmentIndex(self.filename, 5)
+        self.assertEqual([s['start'] for s in index.segments], [0.0, 6.0, 12.0, 18.0])
+
+    def test_every_sample_in_exactly_one_segment(self):
+        index = SegmentIndex(self.filename, 6)
+        for track_id, track in index.tracks.items():
+            ranges = [segment['samples'][track_id] for segment in index.segments]
+            self.assertEqual(ranges[0][0], 0)
+            self.assertEqual(ranges[-1][1], track.sample_table.sample_count)
+            for previous, following in zip(ranges, ranges[1:]):
+                self.assertEqual(previous[1], following[0])
+
+    def test_write_segment(self):
+        index = SegmentIndex(self.filename, 6)
+        out = io.BytesIO()
+        index.write_segment(1, out)
+        data = out.getvalue()
+        self.assertEqual(len(data) % mpegts.TS_PACKET_SIZE, 0)
+
+        streams = demux(data)
+        video = streams[mpegts.VIDEO_PID]
+        audio = streams[mpegts.AUDIO_PID]
+
+        # 6 seconds of 25fps video, starting at 6 seconds
+        self.assertEqual(len(video), 150)
+        self.assertEqual(video[0][1], 6 * 90000 + mpegts.PCR_OFFSET)
+        self.assertTrue(video[0][2].startswith(H264_AUD))
+        self.assertIn(SPS, video[0][2])
+        self.assertNotIn(SPS, video[1][2])
+
+        # audio frames are wrapped in ADTS headers that describe their length
+        first, end = index.segments[1]['samples'][2]
+        self.assertEqual(len(audio), end - first)
+        for pts, dts, payload in audio:
+            self.assertEqual(payload[:2], b'\xff\xf1')
+            frame_length = ((payload[3] & 0x03) << 11) | (payload[4] << 3) | (payload[5] >> 5)
+            self.assertEqual(frame_length, len(payload))
+
+    def test_sidecar_round_trip(self):
+        sidecar = self.filename + segmenter.SIDECAR_SUFFIX
+        self.addCleanup(lambda: os.path.exists(sidecar) and os.remove(sidecar))
+
+        index = segmenter.load_index(self.filename, 6, sidecar=sidecar)
+        self.assertTrue(os.path.exists(sidecar))
+
+        saved = segmenter.read_sidecar(self.filename, sidecar, 6)
+        self.assertEqual(saved.segments, index.segments)
+        # reading the sidecar doesn't parse the mp4 file
+        self.assertIsNone(saved._tracks)
+
+        # a different segment duration or a changed input makes the sidecar stale
+        self.assertIsNone(segmenter.read_sidecar(self.filename, sidecar, 4))
+        with open(self.filename, 'ab') as f:
+            f.write(b'\x00')
+        self.assertIsNone(segmenter.read_sidecar(self.filename, sidecar, 6))
+
+    def test_render_playlist(self):
+        index = SegmentIndex(self.filename, 6)
+        playlist = index.render_playlist('http://example.com/i/video.mp4/segment-%d.ts').split('\r\n')
+        self.assertEqual(playlist[0], '#EXTM3U')
+        self.assertIn('#EXT-X-TARGETDURATION:6', playlist)
+        self.assertEqual(playlist[-2], '#EXT-X-ENDLIST')
+        extinf = [line for line in playlist if line.startswith('#EXTINF:')]
+        self.assertEqual(extinf, ['#EXTINF:6.000000,'] * 3 + ['#EXTINF:2.000000,'])
+        self.assertIn('http://example.com/i/video.mp4/segment-3.ts', playlist)
+        self.assertNotIn('http://example.com/i/video.mp4/segment-4.ts', playlist)
+
+    def test_info_matches_written_segments(self):
+        index = SegmentIndex(self.filename, 6)
+        sizes = []
+        for number in range(len(index.segments)):
+            out = io.BytesIO()
+            index.write_segment(number, out)
+            sizes.append(len(out.getvalue()))
+
+        stats = index.info['stats']
+        self.assertAlmostEqual(stats['duration'], 20.0)
+        self.assertAlmostEqual(stats['avg_segment_bitrate'], 8.0 * sum(sizes) / 20.0)
+        self.assertAlmostEqual(stats['max_segment_bitrate'],
+                               max(8.0 * size / segment['duration'] for size, segment in zip(sizes, index.segments)))
+        self.assertEqual(index.info['video'], {'codec': 'avc1.64001F', 'width': 1280, 'height': 720})
+        self.assertEqual(index.info['audio'], {'codec': 'mp4a.40.2'})
+
+        # saved with the segments
+        self.assertEqual(SegmentIndex(self.filename, 6, segments=index.segments, info=index.to_dict()['info']).info,
+                         index.info)
+
+    def test_segments_carry_on_from_each_other(self):
+        index = SegmentIndex(self.filename, 6)
+        # a sidecar round trip keeps the counters
+        index = SegmentIndex(self.filename, 6, segments=index.to_dict()['segments'])
+        segments = []
+        for number in range(len(index.segments)):
+            out = io.BytesIO()
+            index.write_segment(number, out)
+            segments.append(out.getvalue())
+
+        # as one stream: demux() checks the continuity counters of every pid run on across segment boundaries
+        streams = demux(b''.join(segments))
+        # 20 seconds of 25fps video
+        self.assertEqual(len(streams[mpegts.VIDEO_PID]), 500)
+
+        pcrs = []
+        for number, data in enumerate(segments):
+            packets = list(ts_packets(data))
+            # every segment starts with the PAT and the PMT
+            (pat_pid, _, pat_counter, _, pat), (pmt_pid, _, pmt_counter, _, pmt) = packets[:2]
+            self.assertEqual((pat_pid, pmt_pid), (mpegts.PAT_PID, mpegts.PMT_PID))
+            self.assertEqual((pat_counter, pmt_counter), (number & 0x0F, number & 0x0F))
+            self.assertEqual(pat[1], 0x00)
+            self.assertEqual(struct.unpack('>HH', pat[9:13]), (1, 0xE000 | mpegts.PMT_PID))
+            self.assertEqual(pmt[1], 0x02)
+            self.assertEqual(struct.unpack('>H', pmt[9:11])[0] & 0x1FFF, mpegts.VIDEO_PID)
+            self.assertEqual([(pmt[13 + 5 * i], struct.unpack('>H', pmt[14 + 5 * i:16 + 5 * i])[0] & 0x1FFF)
+                              for i in range(2)],
+                             [(mpegts.STREAM_TYPE_H264, mpegts.VIDEO_PID), (mpegts.STREAM_TYPE_AAC_ADTS, mpegts.AUDIO_PID)])
+
+            for pid, start, counter, adaptation, payload in packets[2:]:
+                self.assertIn(pid, (mpegts.VIDEO_PID, mpegts.AUDIO_PID))
+                if adaptation:
+                    self.assertFalse(adaptation[0] & 0x80, 'discontinuity indicator')
+                if not start:
+                    continue
+                self.assertEqual(payload[:3], b'\x00\x00\x01')
+                if pid == mpegts.VIDEO_PID:
+                    # the PCR is in the first packet of every video PES, and comes before its DTS
+                    self.assertTrue(adaptation[0] & 0x10, 'PCR flag')
+                    pcr = (adaptation[1] << 25) | (adaptation[2] << 17) | (adaptation[3] << 9) \
+                        | (adaptation[4] << 1) | (adaptation[5] >> 7)
+                    self.assertEqual(payload[7] & 0xC0, 0xC0, 'video PES has a PTS and a DTS')
+                    dts = payload[14:19]
+                    dts = (((dts[0] >> 1) & 0x07) << 30) | (dts[1] << 22) | ((dts[2] >> 1) << 15) \
+                        | (dts[3] << 7) | (dts[4] >> 1)
+                    self.assertLessEqual(pcr, dts)
+                    pcrs.append(pcr)
+        self.assertEqual(pcrs, sorted(pcrs))
+
+    def test_samples_bytes(self):
+        index = SegmentIndex(self.filename, 6)
+        writer = mpegts.TsWriter(None, list(index.streams.values()))
+        rng = random.Random(4)
+        sizes = [rng.randrange(0, 5000) for _ in range(1000)] + list(range(mpegts.TS_PAYLOAD_SIZE * 3))
+        for stream in index.streams.values():
+            for is_sync in (False, True):
+                self.assertEqual(writer.samples_bytes(stream, sizes, is_sync),
+                                 sum(writer.sample_bytes(stream, size, is_sync) for size in sizes))
+
+
+
+H264_AUD = b'\x00\x00\x00\x01\x09\xf0'
+
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(SegmenterTestCase)
+    return suite
+
+
+if __name__ == "__main__":
+    runner = unittest.TextTestRunner()
+    runner.run(suite())
@@ -8,4 +8,18 @@ class EncodingError(Exception):
 
 
 class ConfigurationError(Exception):
-    pass
\ No newline at end of file
+    pass
+
+class LockTimeout(Exception):
+    """ waited too long for another worker to finish the same job
+    """
+    pass
+
+
+class PackagingPending(Exception):
+    """ waited too long for a queued packaging job, or for a bento4 process slot.
+        Ask again in retry_after seconds
+    """
+    def __init__(self, message: str = '', retry_after: int = 5):
+        super().__init__(message)
+        self.retry_after = retry_after
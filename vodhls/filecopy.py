@@ -0,0 +1,167 @@
+#Copyright (c) 2022, Michael McFadden & Radio Free Asia
+#GNU GENERAL PUBLIC LICENSE Version 2
+#See file LICENCE or visit https://github.com/flipmcf/CasterPak/blob/master/LICENSE
+"""
+Filling the input cache from a local (or network mounted) filesystem.
+
+copy_file() tries the cheapest way to get a copy first:
+
+    hardlink        no copy at all, when the cache is on the same filesystem as the source
+    reflink         a copy-on-write clone (FICLONE), on btrfs, xfs and the like
+    copy_file_range the kernel copies, without the data passing through user space
+    sendfile        the same, for kernels and filesystems without copy_file_range
+    copy            plain reads and writes
+
+The copying methods move chunk_size bytes at a time, and can be held to a maximum throughput
+so filling the cache doesn't starve the network mount everybody else is reading from.
+"""
+import os
+import time
+import errno
+import fcntl
+import logging
+import typing as t
+from collections import namedtuple
+
+logger = logging.getLogger('vodhls')
+
+# ioctl that clones a whole file: _IOW(0x94, 9, int)
+FICLONE = 0x40049409
+
+METHODS = ('hardlink', 'reflink', 'copy_file_range', 'sendfile', 'copy')
+
+# seconds between progress messages of a long copy
+PROGRESS_INTERVAL = 10.0
+
+# errors that mean a method isn't available here, rather than the copy failed
+UNSUPPORTED_ERRORS = {errno.EXDEV, errno.EPERM, errno.EACCES, errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP,
+                      errno.ENOTTY, errno.EBADF, errno.EMLINK}
+
+CopyResult = namedtuple('CopyResult', ['method', 'bytes', 'seconds'])
+
+
+class ShortCopy(OSError):
+    """ a copying method stopped before the end of the source file.  The next method is tried """
+
+
+class Throttle(object):
+    """ Keeps a copy under a maximum number of bytes per second, and logs its progress. """
+
+    def __init__(self, name: str, total: int, max_bytes_per_second: float = 0):
+        """
+        :param max_bytes_per_second: 0 for no limit
+        """
+        self.name = name
+        self.total = total
+        self.max_bytes_per_second = max_bytes_per_second
+        self.done = 0
+        self.start = time.monotonic()
+        self.last_report = self.start
+
+    def update(self, count: int) -> None:
+        """ count more bytes were copied.  Sleeps if that puts the copy ahead of the limit """
+        self.done += count
+        now = time.monotonic()
+        if self.max_bytes_per_second:
+            ahead = self.done / self.max_bytes_per_second - (now - self.start)
+            if ahead > 0:
+                time.sleep(ahead)
+                now = time.monotonic()
+
+        if now - self.last_report >= PROGRESS_INTERVAL:
+            self.last_report = now
+            logger.info(f"copying {self.name}: {self.done}/{self.total} bytes, "
+                        f"{self.done / (now - self.start) / 1e6:.1f} MB/s")
+
+
+def _hardlink(source, destination, chunk_size, throttle):
+    os.link(source, destination)
+
+
+def _reflink(source, destination, chunk_size, throttle):
+    with open(source, 'rb') as src, open(destination, 'wb') as dst:
+        fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+
+
+def _kernel_copy(copy_function):
+    """ :return: a copy method that calls copy_function(src fd, dst fd, offset, count) until the file is copied """
+    def copy(source, destination, chunk_size, throttle):
+        with open(source, 'rb') as src, open(destination, 'wb') as dst:
+            offset = 0
+            while offset < throttle.total:
+                count = copy_function(src.fileno(), dst.fileno(), offset, min(chunk_size, throttle.total - offset))
+                if count == 0:
+                    # the source shrank, or a filesystem that doesn't really support this
+                    raise ShortCopy(errno.EIO, f"copied {offset} of {throttle.total} bytes", source)
+                offset += count
+                throttle.update(count)
+    return copy
+
+
+# copy_file_range writes at the (advancing) file position of dst
+_copy_file_range = _kernel_copy(lambda src, dst, offset, count: os.copy_file_range(src, dst, count, offset_src=offset))
+_sendfile = _kernel_copy(lambda src, dst, offset, count: os.sendfile(dst, src, offset, count))
+
+
+def _copy(source, destination, chunk_size, throttle):
+    with open(source, 'rb') as src, open(destination, 'wb') as dst:
+        while True:
+            chunk = src.read(chunk_size)
+            if not chunk:
+                break
+            dst.write(chunk)
+            throttle.update(len(chunk))
+    if throttle.done != throttle.total:
+        raise ShortCopy(errno.EIO, f"copied {throttle.done} of {throttle.total} bytes", source)
+
+
+_METHODS = {
+    'hardlink': _hardlink,
+    'reflink': _reflink,
+    'copy_file_range': _copy_file_range,
+    'sendfile': _sendfile,
+    'copy': _copy,
+}
+
+
+def copy_file(source: t.Union[os.PathLike, str], destination: t.Union[os.PathLike, str],
+              methods: t.Sequence[str] = METHODS, chunk_size: int = 8 * 1024 * 1024,
+              max_bytes_per_second: float = 0) -> CopyResult:
+    """ copy source to destination (which must not exist) with the first of 'methods' that works here
+
+    A hardlink or reflink shares its data with the source, a hardlink also shares later changes to it.
+
+    :param methods: names from METHODS, in the order to try them.  'copy' is always tried last.
+    :param max_bytes_per_second: limit for the methods that copy bytes, 0 for no limit
+    :return: the method used, the bytes copied and how long it took
+    """
+    for method in methods:
+        if method not in _METHODS:
+            raise ValueError(f"unknown copy method {method}, expected one of {', '.join(METHODS)}")
+
+    size = os.stat(source).st_size
+    start = time.monotonic()
+
+    for method in list(methods) + ['copy']:
+        throttle = Throttle(os.fspath(source), size, max_bytes_per_second)
+        try:
+            _METHODS[method](source, destination, chunk_size, throttle)
+        except OSError as err:
+            if not (err.errno in UNSUPPORTED_ERRORS or isinstance(err, ShortCopy)) or method == 'copy':
+                _remove(destination)
+                raise
+            (logger.warning if isinstance(err, ShortCopy) else logger.debug)(
+                f"can not {method} {source} to {destination}: {err}")
+            _remove(destination)
+            continue
+
+        result = CopyResult(method, size, time.monotonic() - start)
+        logger.info(f"cached {source} by {method}: {size} bytes in {result.seconds:.2f}s")
+        return result
+
+
+def _remove(filename):
+    try:
+        os.remove(filename)
+    except FileNotFoundError:
+        pass
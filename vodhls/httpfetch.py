@@ -0,0 +1,437 @@
+#Copyright (c) 2022, Michael McFadden & Radio Free Asia
+#GNU GENERAL PUBLIC LICENSE Version 2
+#See file LICENCE or visit https://github.com/flipmcf/CasterPak/blob/master/LICENSE
+"""
+Fetching input files over http.
+
+Downloads go to a '.part' file next to the destination, which is renamed into place once it is whole,
+so a reader of the input cache never sees half a file.
+
+If the server supports byte ranges the file is fetched in pieces, several at a time.
+The pieces and byte ranges that have been written are recorded in a small json file next to the '.part' file,
+so an interrupted download picks up where it left off - as long as the ETag (or Last-Modified)
+of the remote file hasn't changed in the meantime.
+That file is locked while it is read and updated, so every process working on the download shares it.
+
+A PartialDownload lets an mp4 input be used before it has all arrived:
+its top level box headers and 'moov' box are fetched first, then just the byte ranges that are asked for.
+"""
+import os
+import json
+import fcntl
+import struct
+import logging
+import threading
+import contextlib
+import typing as t
+from hashlib import blake2b
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger('vodhls')
+
+# appended to the destination file name while it is being downloaded
+PART_SUFFIX = '.part'
+
+# appended to the '.part' file name: the validator of the remote file and the pieces written so far
+PROGRESS_SUFFIX = '.json'
+
+# connections kept open to the origin, per process
+POOL_SIZE = 16
+
+# bytes fetched from the start of a file to find its top level boxes
+HEADER_FETCH_SIZE = 64 * 1024
+
+# a PartialDownload gives up on files with more top level boxes than this (eg: fragmented mp4)
+MAX_TOP_LEVEL_BOXES = 64
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def get_session() -> requests.Session:
+    """
+    :return: the http session of this process.
+    Connections to the origin are kept alive and shared by every fetch.
+    """
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE)
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                _session = session
+    return _session
+
+
+def missing_ranges(ranges: t.List[t.Tuple[int, int]], start: int, end: int) -> t.List[t.Tuple[int, int]]:
+    """
+    :param ranges: sorted, non overlapping [start, end) ranges
+    :return: the parts of [start, end) that aren't in ranges
+    """
+    gaps = []
+    for range_start, range_end in ranges:
+        if range_end <= start:
+            continue
+        if range_start >= end:
+            break
+        if range_start > start:
+            gaps.append((start, range_start))
+        start = max(start, range_end)
+    if start < end:
+        gaps.append((start, end))
+    return gaps
+
+
+def merge_ranges(ranges: t.Iterable[t.Tuple[int, int]]) -> t.List[t.Tuple[int, int]]:
+    """ :return: ranges, sorted, with the ones that touch or overlap joined up """
+    merged = []
+    for start, end in sorted(tuple(span) for span in ranges):
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+class RemoteFileChanged(Exception):
+    """ the remote file changed while it was being fetched in pieces """
+
+
+class HttpFetcher(object):
+    """ Download one url to a local file. """
+
+    def __init__(self, connect_timeout: float = 3.05, read_timeout: float = 30.0, buffer_size: int = 1024 * 1024,
+                 piece_size: int = 64 * 1024 * 1024, connections: int = 4, session: requests.Session = None):
+        """
+        :param connect_timeout: seconds to wait for a connection to the server
+        :param read_timeout: seconds to wait for the server between bytes
+        :param buffer_size: bytes read from the connection and written to disk at a time
+        :param piece_size: bytes fetched by each range request
+        :param connections: number of range requests made at the same time.  1 fetches the pieces in order.
+        """
+        self.timeout = (connect_timeout, read_timeout)
+        self.buffer_size = buffer_size
+        self.piece_size = piece_size
+        self.connections = max(1, connections)
+        self.session = session or get_session()
+
+    def fetch(self, url: str, destination: t.Union[os.PathLike, str]) -> str:
+        """ download url to destination
+
+        :return: the blake2b hash (16 byte digest, hex) of the content
+        :raises FileNotFoundError: if the server doesn't have the file
+        """
+        os.makedirs(os.path.dirname(destination), exist_ok=True)
+        part = f'{destination}{PART_SUFFIX}'
+
+        size, validator = self.probe(url)
+        if size is None:
+            content_hash = self.fetch_stream(url, part)
+        else:
+            try:
+                content_hash = self.fetch_pieces(url, part, size, validator)
+            except RemoteFileChanged:
+                logger.info(f"{url} changed while it was being fetched, starting over")
+                self.discard(part)
+                size, validator = self.probe(url)
+                content_hash = self.fetch_pieces(url, part, size, validator)
+
+        # under the lock, so a PartialDownload never writes to the '.part' file once it has been published
+        with self.progress(part, url, size, validator):
+            os.replace(part, destination)
+            self.remove_progress(part)
+        return content_hash
+
+    def probe(self, url: str) -> t.Tuple[t.Optional[int], t.Optional[str]]:
+        """
+        :return: (size, validator) if url can be fetched in pieces, else (None, None)
+        """
+        response = self.session.head(url, timeout=self.timeout, allow_redirects=True)
+        if response.status_code == 404:
+            logger.error(f"error {response.status_code} while requesting {url}")
+            raise FileNotFoundError(url)
+
+        if response.status_code != 200 or response.headers.get('Accept-Ranges', '').lower() != 'bytes':
+            return None, None
+        try:
+            size = int(response.headers['Content-Length'])
+        except (KeyError, ValueError):
+            return None, None
+        validator = response.headers.get('ETag') or response.headers.get('Last-Modified')
+        return size, validator
+
+    def fetch_stream(self, url: str, part: t.Union[os.PathLike, str]) -> str:
+        """ download the whole file in one request.  Used when the server can't send byte ranges. """
+        content_hash = blake2b(digest_size=16)
+        with self.session.get(url, timeout=self.timeout, stream=True) as response:
+            if response.status_code != 200:
+                logger.error(f"error {response.status_code} while requesting {url}")
+                raise FileNotFoundError(url)
+
+            with open(part, 'wb') as f:
+                for chunk in response.iter_content(chunk_size=self.buffer_size):
+                    f.write(chunk)
+                    content_hash.update(chunk)
+        return content_hash.hexdigest()
+
+    def fetch_pieces(self, url: str, part: t.Union[os.PathLike, str], size: int, validator: t.Optional[str]) -> str:
+        """ download the file in piece_size range requests,
+            skipping the pieces an earlier attempt, or a PartialDownload, wrote
+        """
+        with self.progress(part, url, size, validator) as progress:
+            done = set(progress['done'])
+            starts = range(0, size, self.piece_size)
+            pieces = [start for start in starts if start not in done
+                      and missing_ranges(progress['ranges'], start, min(start + self.piece_size, size))]
+            if len(pieces) < len(starts):
+                logger.info(f"resuming {url}: {len(starts) - len(pieces)} pieces already fetched, "
+                            f"{len(pieces)} to go")
+            fd = self.open_part(part, size)
+
+        def fetch_piece(start):
+            end = min(start + self.piece_size, size)
+            self.fetch_range(url, fd, start, end, validator)
+            with self.progress(part, url, size, validator) as progress:
+                progress['done'].append(start)
+                progress['ranges'] = merge_ranges(progress['ranges'] + [(start, end)])
+
+        try:
+            if self.connections == 1 or len(pieces) < 2:
+                for start in pieces:
+                    fetch_piece(start)
+            else:
+                with ThreadPoolExecutor(max_workers=self.connections, thread_name_prefix='fetch') as pool:
+                    # list() re-raises the first failure
+                    list(pool.map(fetch_piece, pieces))
+        finally:
+            os.close(fd)
+
+        return self.hash_file(part)
+
+    def open_part(self, part: t.Union[os.PathLike, str], size: int) -> int:
+        """
+        :return: a file descriptor of the '.part' file, which is created with the full size of the download
+        """
+        os.makedirs(os.path.dirname(part), exist_ok=True)
+        fd = os.open(part, os.O_RDWR | os.O_CREAT, 0o644)
+        if os.fstat(fd).st_size != size:
+            os.ftruncate(fd, size)
+        return fd
+
+    def fetch_range(self, url: str, fd: int, start: int, end: int, validator: t.Optional[str]) -> None:
+        """ fetch bytes [start, end) of url and write them at the same offset in fd """
+        headers = {'Range': f'bytes={start}-{end - 1}'}
+        if validator:
+            # the server sends the whole (new) file instead of the range if this doesn't match
+            headers['If-Range'] = validator
+
+        with self.session.get(url, headers=headers, timeout=self.timeout, stream=True) as response:
+            if response.status_code == 200:
+                raise RemoteFileChanged(url)
+            if response.status_code != 206:
+                logger.error(f"error {response.status_code} while requesting {url} bytes {start}-{end - 1}")
+                raise FileNotFoundError(url)
+
+            offset = start
+            for chunk in response.iter_content(chunk_size=self.buffer_size):
+                view = memoryview(chunk)
+                while view:
+                    written = os.pwrite(fd, view, offset)
+                    offset += written
+                    view = view[written:]
+
+        if offset != end:
+            raise EOFError(f"{url}: expected bytes {start}-{end - 1}, got {offset - start} bytes")
+
+    def hash_file(self, filename: t.Union[os.PathLike, str]) -> str:
+        content_hash = blake2b(digest_size=16)
+        with open(filename, 'rb') as f:
+            while True:
+                chunk = f.read(self.buffer_size)
+                if not chunk:
+                    break
+                content_hash.update(chunk)
+        return content_hash.hexdigest()
+
+    @staticmethod
+    @contextlib.contextmanager
+    def progress(part: t.Union[os.PathLike, str], url: str, size: int,
+                 validator: t.Optional[str]) -> t.Iterator[dict]:
+        """ lock the progress record of this download, across threads and processes
+
+        :return: (as a context manager) the progress of this download so far,
+        or a fresh one if there was none or the remote file has changed since.
+        Changes made to it are saved when the context exits.
+        """
+        fresh = {'url': url, 'size': size, 'validator': validator, 'done': [], 'ranges': []}
+        if validator is None:
+            # no way to tell if the remote file changed, so an interrupted download starts over
+            yield fresh
+            return
+
+        os.makedirs(os.path.dirname(part), exist_ok=True)
+        filename = f'{part}{PROGRESS_SUFFIX}'
+        while True:
+            fd = os.open(filename, os.O_RDWR | os.O_CREAT, 0o644)
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            try:
+                stat = os.stat(filename)
+                if (stat.st_ino, stat.st_dev) == (os.fstat(fd).st_ino, os.fstat(fd).st_dev):
+                    break
+            except FileNotFoundError:
+                pass
+            # removed by the fetch that finished while we waited
+            os.close(fd)
+
+        try:
+            try:
+                progress = json.loads(os.pread(fd, os.fstat(fd).st_size, 0) or b'{}')
+            except ValueError:
+                progress = {}
+            if (progress.get('url'), progress.get('size'), progress.get('validator')) != (url, size, validator) \
+                    or not os.path.exists(part):
+                progress = fresh
+            progress.setdefault('ranges', [])
+
+            try:
+                yield progress
+            finally:
+                data = json.dumps(progress).encode()
+                os.ftruncate(fd, 0)
+                os.pwrite(fd, data, 0)
+        finally:
+            os.close(fd)
+
+    @staticmethod
+    def remove_progress(part: t.Union[os.PathLike, str]) -> None:
+        try:
+            os.remove(f'{part}{PROGRESS_SUFFIX}')
+        except FileNotFoundError:
+            pass
+
+    def discard(self, part: t.Union[os.PathLike, str]) -> None:
+        self.remove_progress(part)
+        try:
+            os.remove(part)
+        except FileNotFoundError:
+            pass
+
+
+class PartialDownload(object):
+    """ An mp4 file on an http server, used while it is being downloaded.
+
+        The bytes fetched so far live in the same '.part' file HttpFetcher.fetch() downloads into,
+        at their offsets in the remote file, so a full fetch running alongside completes the same file.
+        The ranges that are filled in are recorded in its progress file, shared with every other process.
+        Once the full fetch has published the file, it is read from there.
+    """
+
+    def __init__(self, fetcher: HttpFetcher, url: str, destination: t.Union[os.PathLike, str]):
+        """
+        :raises NotImplementedError: if the server can't send byte ranges
+        """
+        self.fetcher = fetcher
+        self.url = url
+        self.destination = destination
+        self.part = f'{destination}{PART_SUFFIX}'
+        self.size, self.validator = fetcher.probe(url)
+        if self.size is None or self.validator is None:
+            raise NotImplementedError(f"{url} can't be fetched in byte ranges")
+
+        self.lock = threading.Lock()
+        # sorted, non overlapping [start, end) ranges of the '.part' file that had been written at the last ensure()
+        self.fetched = []
+
+    @property
+    def identity(self) -> dict:
+        """ identifies the version of the remote file, see segmenter.load_index() """
+        return {'url': self.url, 'size': self.size, 'validator': self.validator}
+
+    def missing(self, start: int, end: int) -> t.List[t.Tuple[int, int]]:
+        """ :return: the parts of [start, end) that haven't been fetched """
+        return missing_ranges(self.fetched, start, end)
+
+    def ensure(self, ranges: t.Iterable[t.Tuple[int, int]]) -> None:
+        """ fetch the byte ranges that aren't in the '.part' file yet, unless the whole file is in already """
+        ranges = [(max(0, start), min(end, self.size)) for start, end in ranges]
+        if os.path.exists(self.destination):
+            return
+
+        with self.lock, self.fetcher.progress(self.part, self.url, self.size, self.validator) as progress:
+            if os.path.exists(self.destination):
+                # published while we waited for the lock, this just made a new progress file
+                self.fetcher.remove_progress(self.part)
+                return
+
+            self.fetched = merge_ranges(progress['ranges'])
+            gaps = [gap for start, end in ranges if start < end for gap in self.missing(start, end)]
+            if not gaps:
+                return
+
+            fd = self.fetcher.open_part(self.part, self.size)
+            try:
+                for start, end in gaps:
+                    self.fetcher.fetch_range(self.url, fd, start, end, self.validator)
+                    self.add_fetched(start, end)
+                    progress['ranges'] = self.fetched
+            finally:
+                os.close(fd)
+
+    def add_fetched(self, start: int, end: int) -> None:
+        self.fetched = merge_ranges(self.fetched + [(start, end)])
+
+    def read(self, start: int, end: int) -> bytes:
+        """ :return: bytes [start, end) of the file, fetching them if needed """
+        self.ensure([(start, end)])
+        if not os.path.exists(self.destination):
+            try:
+                return self.read_file(self.part, start, end)
+            except FileNotFoundError:
+                # published since
+                pass
+        return self.read_file(self.destination, start, end)
+
+    @staticmethod
+    def read_file(filename: t.Union[os.PathLike, str], start: int, end: int) -> bytes:
+        with open(filename, 'rb') as f:
+            f.seek(start)
+            return f.read(end - start)
+
+    def fetch_header(self) -> t.List[t.Tuple[str, int, int]]:
+        """ fetch every top level box header, and the whole 'moov' box, wherever it is in the file
+
+        :return: [(type, position, size)] of the top level boxes
+        :raises NotImplementedError: if there is no 'moov' box, or too many top level boxes to walk
+        """
+        self.ensure([(0, HEADER_FETCH_SIZE)])
+
+        boxes = []
+        position = 0
+        while position + 8 <= self.size:
+            if len(boxes) >= MAX_TOP_LEVEL_BOXES:
+                raise NotImplementedError(f"{self.url}: more than {MAX_TOP_LEVEL_BOXES} top level boxes")
+
+            header = self.read(position, min(position + 16, self.size))
+            size, type = struct.unpack('>I4s', header[:8])
+            if size == 1:
+                size = struct.unpack('>Q', header[8:16])[0]
+            elif size == 0:
+                # the last box, runs to the end of the file
+                size = self.size - position
+            if size < 8:
+                raise ValueError(f"{self.url}: bad box size {size} at {position}")
+
+            type = type.decode('ascii', errors='replace')
+            boxes.append((type, position, size))
+            if type == 'moov':
+                self.ensure([(position, position + size)])
+            position += size
+
+        if 'moov' not in [type for type, _, _ in boxes]:
+            raise NotImplementedError(f"{self.url}: no moov box")
+        return boxes
@@ -0,0 +1,154 @@
+#Copyright (c) 2022, Michael McFadden & Radio Free Asia
+#GNU GENERAL PUBLIC LICENSE Version 2
+#See file LICENCE or visit https://github.com/flipmcf/CasterPak/blob/master/LICENSE
+"""
+Packaging jobs: making a media playlist, a segment or a master playlist that doesn't exist yet.
+
+By default a job runs inside the request that needs it.  With [packager] queue = True the request queues it
+in the cache database instead (or joins the job already queued for the same output) and the packager
+processes run it, see vodhls.packager.  The request waits [packager] wait seconds for the job, then gives up
+with PackagingPending; the job carries on, and the player is asked to come back for the result.
+"""
+import time
+import logging
+import typing as t
+
+import cachedb
+from config import get_config
+
+from . import EncodingError, LockTimeout, PackagingPending
+from .locking import BACKGROUND, admission
+
+logger = logging.getLogger('vodhls')
+
+# seconds between looks at a queued job's state
+POLL_INTERVAL = 0.1
+
+# errors a job can fail with, by name.  They are raised again in the requests waiting for it
+ERRORS = {
+    'FileNotFoundError': FileNotFoundError,
+    'EncodingError': EncodingError,
+    'LockTimeout': LockTimeout,
+}
+
+job_db = cachedb.PackagingJobDB()
+
+
+def package_rendition(filename: str, baseurl: str) -> None:
+    """ write the media playlist of an input, packaging it if the packaging mode needs that """
+    from vodhls.factory import vodhls_media_playlist_factory
+    manager = vodhls_media_playlist_factory(filename)
+    manager.set_baseurl(baseurl)
+    if not manager.manifest_exists():
+        manager.create()
+
+
+def package_segment(filename: str, baseurl: str, segment: str) -> None:
+    """ make one segment of an input: cut it in 'jit' packaging mode, otherwise package the whole input """
+    from vodhls.factory import vodhls_media_playlist_factory
+    manager = vodhls_media_playlist_factory(filename)
+    if manager.segment_exists(segment):
+        return
+    manager.set_baseurl(baseurl)
+    if manager.jit_packaging:
+        manager.create_segment(segment)
+    else:
+        manager.create()
+
+
+def package_segment_ahead(filename: str, baseurl: str, segment: str) -> None:
+    """ cut a segment the player hasn't asked for yet.  Its bento4 processes give way to requests' """
+    with admission(BACKGROUND, deadline=False):
+        package_segment(filename, baseurl, segment)
+
+
+def package_master(files: t.List[str], output_dir: str, baseurl: str) -> None:
+    """ write a master playlist of some inputs, packaging the renditions it needs """
+    from vodhls.factory import vodhls_master_playlist_factory
+    manager = vodhls_master_playlist_factory(files, output_dir)
+    if manager.manifest_exists():
+        return
+    manager.set_baseurl(baseurl)
+    manager.output_hls()
+
+    db = cachedb.CacheDB(cache_name=cachedb.SEGMENT_FILE_CACHE)
+    for segment_manager in manager.ready_managers:
+        db.touch(filename=segment_manager.filename)
+
+
+# job kind: (what runs it, priority).  A player is waiting on a segment right now, and a master playlist
+# packages its renditions, so segments go first and master playlists last.
+# Nobody is waiting for a 'lookahead' segment (see [output] jit_lookahead) yet.
+KINDS = {
+    'segment': (package_segment, 0),
+    'rendition': (package_rendition, 1),
+    'master': (package_master, 2),
+    'lookahead': (package_segment_ahead, 3),
+}
+
+
+def queued() -> bool:
+    """ :return: True if packaging jobs are run by the packager processes, rather than in the request """
+    return get_config().getboolean('packager', 'queue', fallback=False)
+
+
+def run(kind: str, key: str, **arguments) -> None:
+    """ run a packaging job, or wait for it in the queue
+
+    :param kind: one of KINDS
+    :param key: the output the job makes.  Requests for the same key share one job
+    :param arguments: for the KINDS function, json serializable
+    :raises PackagingPending: the job didn't finish within [packager] wait seconds
+    """
+    function, priority = KINDS[kind]
+    if not queued():
+        function(**arguments)
+        return
+
+    config = get_config()
+    wait = config.getfloat('packager', 'wait', fallback=20.0)
+    retry_after = config.getint('packager', 'retry_after', fallback=5)
+
+    job_id = job_db.enqueue(kind, key, arguments, priority=priority)
+    deadline = time.monotonic() + wait
+    while True:
+        job = job_db.get(job_id)
+        if job is None:
+            # pruned or removed before we saw how it ended: queue it again.  If its output was made,
+            # the new job finds it and finishes straight away
+            logger.debug(f"packaging job {job_id} for {key} is gone, queueing it again")
+            job_id = job_db.enqueue(kind, key, arguments, priority=priority)
+            continue
+        if job['state'] == 'done':
+            return
+        if job['state'] == 'failed':
+            raise ERRORS.get(job['error'], EncodingError)(f"packaging job {job_id} for {key} failed: {job['error']}")
+        if time.monotonic() > deadline:
+            raise PackagingPending(f"packaging job {job_id} for {key} is still {job['state']}", retry_after)
+        time.sleep(POLL_INTERVAL)
+
+
+def submit(kind: str, key: str, **arguments) -> int:
+    """ queue a packaging job and don't wait for it.  Only with [packager] queue on, see run()
+
+    :return: the id of the job
+    """
+    _, priority = KINDS[kind]
+    return job_db.enqueue(kind, key, arguments, priority=priority)
+
+
+def run_job(job: dict) -> t.Optional[str]:
+    """ run a job claimed from the queue
+
+    :return: the name of the error it failed with, None if it succeeded
+    """
+    function, _ = KINDS[job['kind']]
+    start = time.monotonic()
+    try:
+        function(**job['arguments'])
+    except Exception as e:
+        if type(e).__name__ not in ERRORS:
+            logger.exception(f"packaging job {job['id']} for {job['key']} failed")
+        return type(e).__name__
+    logger.info(f"packaging job {job['id']} for {job['key']} done in {time.monotonic() - start:.1f}s")
+    return None
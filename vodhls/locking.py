@@ -0,0 +1,318 @@
+#Copyright (c) 2022, Michael McFadden & Radio Free Asia
+#GNU GENERAL PUBLIC LICENSE Version 2
+#See file LICENCE or visit https://github.com/flipmcf/CasterPak/blob/master/LICENSE
+import os
+import re
+import json
+import math
+import time
+import fcntl
+import logging
+import threading
+import typing as t
+from contextlib import contextmanager
+from hashlib import blake2b
+
+from . import LockTimeout, PackagingPending
+
+logger = logging.getLogger('vodhls')
+
+# lock files live in this hidden directory under the configured segmentParentPath
+LOCK_DIR = '.locks'
+
+# names lock_path() makes.  These are the lock files prune_lock_files() removes
+LOCK_FILE_RE = re.compile(r'^[a-z]+-[0-9a-f]{32}\.lock$')
+
+
+class FileLock(object):
+    """ A cross-process exclusive lock backed by flock(2) on a lock file.
+
+        Every gunicorn worker that wants to do the same piece of work opens the same lock file.
+        The first one in gets the lock and does the work, the others wait for it to finish.
+        The kernel drops the lock if the holder dies, so a crashed worker never wedges a rendition.
+    """
+
+    def __init__(self, path: t.Union[os.PathLike, str], timeout: float = None, poll_interval: float = 0.1):
+        """
+        :param path: full path to the lock file.  It is created if it does not exist.
+        :param timeout: seconds to wait for the lock before raising LockTimeout.  None waits forever,
+         0 doesn't wait at all.
+        :param poll_interval: seconds between attempts while waiting
+        """
+        self.path = path
+        self.timeout = timeout
+        self.poll_interval = poll_interval
+        self.fd = None
+
+    def acquire(self) -> None:
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o660)
+
+        if self._try_lock():
+            return
+        if self.timeout is not None and self.timeout <= 0:
+            os.close(self.fd)
+            self.fd = None
+            raise LockTimeout(f"{self.path} is held by another process")
+        logger.debug(f"{self.path} is held by another process, waiting")
+
+        deadline = None if self.timeout is None else time.monotonic() + self.timeout
+        while True:
+            time.sleep(self.poll_interval)
+            if self._try_lock():
+                return
+            if deadline is not None and time.monotonic() > deadline:
+                os.close(self.fd)
+                self.fd = None
+                raise LockTimeout(f"timed out after {self.timeout}s waiting for {self.path}")
+
+    def _try_lock(self) -> bool:
+        """ :return: True if the lock was taken.  Reopens the lock file if prune_lock_files() removed it """
+        try:
+            fcntl.flock(self.fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return False
+
+        try:
+            current = os.stat(self.path)
+        except FileNotFoundError:
+            current = None
+        held = os.fstat(self.fd)
+        if current is not None and (current.st_ino, current.st_dev) == (held.st_ino, held.st_dev):
+            return True
+
+        # we locked a file that was pruned while we were opening it, start again on the one at self.path
+        os.close(self.fd)
+        self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o660)
+        return self._try_lock()
+
+    def release(self) -> None:
+        if self.fd is None:
+            return
+        fcntl.flock(self.fd, fcntl.LOCK_UN)
+        os.close(self.fd)
+        self.fd = None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+
+
+def lock_path(parent_dir: t.Union[os.PathLike, str], namespace: str, key: str) -> str:
+    """ map an arbitrary key (usually a relative media path) onto a flat lock file name
+
+    :param parent_dir: directory that will hold the LOCK_DIR
+    :param namespace: keeps locks for different kinds of work apart, eg: 'package', 'input'
+    :param key: the thing being locked
+    """
+    h = blake2b(digest_size=16)   # usedforsecurity = False
+    h.update(f"{namespace}:{key}".encode("utf-8"))
+    return os.path.join(parent_dir, LOCK_DIR, f"{namespace}-{h.hexdigest()}.lock")
+
+
+def prune_lock_files(lock_dir: t.Union[os.PathLike, str], age: float) -> int:
+    """ remove the lock_path() files in lock_dir that are older than 'age' seconds and that nobody holds.
+        A lock file is made for every rendition, input and (in 'jit' mode) segment ever locked.
+
+        The file is removed while holding its lock, and FileLock checks that the file it locked is
+        still in place.  So a worker that opened the file just before it was removed never shares
+        the lock with one that opens the new file after.
+
+    :return: number of lock files removed
+    """
+    try:
+        entries = list(os.scandir(lock_dir))
+    except FileNotFoundError:
+        return 0
+
+    then = time.time() - age
+    removed = 0
+    for entry in entries:
+        if not LOCK_FILE_RE.match(entry.name):
+            continue
+        try:
+            if entry.stat().st_mtime >= then:
+                continue
+            fd = os.open(entry.path, os.O_RDWR)
+        except FileNotFoundError:
+            continue
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            os.remove(entry.path)
+            removed += 1
+        except (BlockingIOError, FileNotFoundError):
+            pass
+        finally:
+            os.close(fd)
+    return removed
+
+
+# what a bento4 process is for, see ProcessSlots
+INTERACTIVE = 'interactive'   # a player is waiting for it
+BACKGROUND = 'background'     # work done ahead of time
+
+
+class ProcessSlots(object):
+    """ A machine wide limit on the bento4 processes running at once, shared by every worker process.
+
+        Each slot is a lock file, and a process runs while its worker holds one.  The kernel drops the lock if
+        the worker dies, so a crash never leaks a slot.  INTERACTIVE work can take any slot; BACKGROUND work
+        only one of the first background_slots, and only while no INTERACTIVE work is waiting for one.
+
+        A slot file records when its process started and how long the one before took,
+        which is how the wait for a slot is estimated.
+    """
+
+    def __init__(self, directory: t.Union[os.PathLike, str], slots: int, background_slots: int = None,
+                 poll_interval: float = 0.05):
+        """
+        :param directory: holds the slot files
+        :param slots: how many processes can run at once
+        :param background_slots: how many of them can be BACKGROUND work.  Defaults to all of them
+        """
+        self.directory = directory
+        self.slots = max(1, slots)
+        self.background_slots = self.slots if background_slots is None else max(1, min(background_slots, self.slots))
+        self.poll_interval = poll_interval
+
+    def slot_path(self, slot: int) -> str:
+        return os.path.join(self.directory, f"bento4-slot-{slot}.lock")
+
+    @property
+    def waiting_path(self) -> str:
+        # INTERACTIVE work holds a shared lock on this while it waits for a slot
+        return os.path.join(self.directory, "bento4-waiting.lock")
+
+    def interactive_waiting(self) -> bool:
+        fd = os.open(self.waiting_path, os.O_RDWR | os.O_CREAT, 0o660)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return False
+        except BlockingIOError:
+            return True
+        finally:
+            os.close(fd)
+
+    def _take(self, slot: int) -> t.Optional[int]:
+        """ :return: an fd holding the slot, None if it is taken """
+        fd = os.open(self.slot_path(slot), os.O_RDWR | os.O_CREAT, 0o660)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            return None
+        return fd
+
+    def _read_record(self, slot: int) -> dict:
+        try:
+            with open(self.slot_path(slot)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    @staticmethod
+    def _write_record(fd: int, record: dict) -> None:
+        data = json.dumps(record).encode()
+        os.ftruncate(fd, 0)
+        os.pwrite(fd, data, 0)
+
+    def estimated_wait(self) -> t.Optional[float]:
+        """ :return: seconds until the first slot is expected to be free, None if there is nothing to go by """
+        records = [self._read_record(slot) for slot in range(self.slots)]
+        durations = [record['last'] for record in records if record.get('last')]
+        if not durations:
+            return None
+        typical = sum(durations) / len(durations)
+        now = time.time()
+        return min(max(0.0, typical - (now - record['started'])) if record.get('started') else 0.0
+                   for record in records)
+
+    def acquire(self, priority: str = INTERACTIVE, timeout: float = None, retry_after: int = 5) -> t.Tuple[int, int]:
+        """ wait for a slot
+
+        :param timeout: seconds to wait before giving up, None to wait as long as it takes.
+          It gives up straight away if the estimated wait is longer.
+        :param retry_after: what to tell the player when giving up without an estimate
+        :raises PackagingPending: no slot within 'timeout'
+        :return: the slot and the fd holding it, for release()
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        candidates = range(self.slots if priority == INTERACTIVE else self.background_slots)
+        deadline = None if timeout is None else time.monotonic() + timeout
+        waiting_fd = None
+        try:
+            while True:
+                if priority == INTERACTIVE or not self.interactive_waiting():
+                    for slot in candidates:
+                        fd = self._take(slot)
+                        if fd is not None:
+                            self._write_record(fd, {'started': time.time(), 'pid': os.getpid(), 'priority': priority,
+                                                    'last': self._read_record(slot).get('last')})
+                            return slot, fd
+
+                if priority == INTERACTIVE and waiting_fd is None:
+                    waiting_fd = os.open(self.waiting_path, os.O_RDWR | os.O_CREAT, 0o660)
+                    fcntl.flock(waiting_fd, fcntl.LOCK_SH)
+                    logger.debug(f"all {self.slots} bento4 process slots are busy, waiting")
+
+                if deadline is not None:
+                    left = deadline - time.monotonic()
+                    estimate = self.estimated_wait()
+                    if left <= 0 or (estimate is not None and estimate > left):
+                        raise PackagingPending(f"all {self.slots} bento4 process slots are busy",
+                                               retry_after=math.ceil(estimate) if estimate else retry_after)
+                time.sleep(self.poll_interval)
+        finally:
+            if waiting_fd is not None:
+                os.close(waiting_fd)
+
+    def release(self, slot: int, fd: int) -> None:
+        try:
+            started = self._read_record(slot).get('started')
+            self._write_record(fd, {'started': None, 'last': time.time() - started if started else None})
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+            os.close(fd)
+
+    @contextmanager
+    def slot(self, priority: str = INTERACTIVE, timeout: float = None, retry_after: int = 5):
+        """ hold a slot for the duration of a with block, see acquire() """
+        slot, fd = self.acquire(priority, timeout, retry_after)
+        try:
+            yield slot
+        finally:
+            self.release(slot, fd)
+
+
+# the priority of this thread's bento4 processes, and whether anyone waits for them.  See admission()
+_admission = threading.local()
+# the same, for threads that haven't said
+_default_admission = (INTERACTIVE, True)
+
+
+@contextmanager
+def admission(priority: str = INTERACTIVE, deadline: bool = True):
+    """ bento4 processes run by this thread in a with block are 'priority' work
+
+    :param deadline: True if a request is waiting for the result, and can't wait for a slot for long
+    """
+    previous = getattr(_admission, 'current', None)
+    _admission.current = (priority, deadline)
+    try:
+        yield
+    finally:
+        _admission.current = previous
+
+
+def set_default_admission(priority: str = INTERACTIVE, deadline: bool = True) -> None:
+    """ what bento4 processes are for in threads that don't use admission(), eg: the packager processes """
+    global _default_admission
+    _default_admission = (priority, deadline)
+
+
+def current_admission() -> t.Tuple[str, bool]:
+    """ :return: the priority of this thread's bento4 processes, and whether a request is waiting for them """
+    return getattr(_admission, 'current', None) or _default_admission
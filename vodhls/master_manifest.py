@@ -4,19 +4,23 @@
 import os
 import typing as t
 from hashlib import blake2b
+from urllib.parse import urljoin
 
-from . import ConfigurationError
+from . import ConfigurationError, EncodingError
 
 from config import get_config
 from vodhls.factory import vodhls_media_playlist_factory
-from vodhls.media_manifest_base import OptionsConfig
+from vodhls.media_manifest_base import OptionsConfig, bento4_process_slot
 
 import logging
 logger = logging.getLogger('vodhls')
 
 
 class MultivariantManager(object):
-    config = get_config()
+
+    @property
+    def config(self):
+        return get_config()
 
     def __init__(self, files, output_dir):
         self.__master_playlist_dir = output_dir
@@ -33,6 +37,7 @@ class MultivariantManager(object):
                 manager = dict()
                 manager['segment_manager'] = vodhls_media_playlist_factory(filename)
                 manager['status'] = 'unprocessed'
+                self.set_rendition_baseurl(manager['segment_manager'])
                 self.segment_managers.append(manager)
 
         fail_with_404 = True  # Raise a FileNotFound only if ALL managers fail.
@@ -52,8 +57,17 @@ class MultivariantManager(object):
             raise FileNotFoundError
 
     def set_baseurl(self, url):
-        [manager['segment_manager'].set_baseurl(url) for manager in self.segment_managers]
+        """ :param url: url of the directory of the master playlist.  Each rendition is a subdirectory of it """
         self.baseurl = url
+        for manager in self.segment_managers:
+            self.set_rendition_baseurl(manager['segment_manager'])
+
+    def set_rendition_baseurl(self, segment_manager):
+        if self.baseurl:
+            segment_manager.set_baseurl(urljoin(self.baseurl, os.path.basename(segment_manager.filename) + '/'))
+        elif self.baseurl is not None:
+            # relative to the media playlist, which is in the rendition's directory
+            segment_manager.set_baseurl(self.baseurl)
 
     @property
     def master_playlist_name(self):
@@ -102,10 +116,13 @@ class MultivariantManager(object):
 
         return os.path.join(path, self.__master_playlist_dir)
 
+    @property
+    def ready_managers(self):
+        return [manager['segment_manager'] for manager in self.segment_managers if manager['status'] == 'ready']
+
     @property
     def manifest_files(self):
-        return [manager['segment_manager'].input_file for manager in self.segment_managers
-                if manager['status'] == 'ready']
+        return [segment_manager.input_file for segment_manager in self.ready_managers]
 
     @property
     def segment_duration(self):
@@ -134,34 +151,31 @@ class MultivariantManager(object):
             'min_buffer_time': 0.0,
             'base_url': self.baseurl,
             'segment_duration': str(self.segment_duration),
+            'process_slot': bento4_process_slot,
         }
 
         options = OptionsConfig(options_dict)
 
-        media_sources = [MediaSource(options, source) for source in self.manifest_files]
+        media_sources = [analyzed_media_source(options, segment_manager) for segment_manager in self.ready_managers]
         for media_source in media_sources:
             media_source.has_audio = False
             media_source.has_video = False
 
-        # create output directory from input file path
+        # create output directory from input file path.
+        # Rendition directories are created when they are published, see MediaManager_Base.create()
         try:
             os.makedirs(self.output_dir)
         except FileExistsError:
             pass
 
-        # create output subdirectories for successfully processed media files (renditions):
-        for manager in self.segment_managers:
-            if manager['status'] == 'ready':
-                try:
-                    os.makedirs(manager['segment_manager'].output_dir)
-                except FileExistsError:
-                    pass
-
         create_master_playlist(options, media_sources)
 
 
 import shutil
 import json
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
 
 from bento4.mp4hls import AnalyzeSources
 from bento4.mp4hls import ProcessSource
@@ -173,8 +187,99 @@ from bento4.mp4utils import MediaSource
 from bento4.mp4utils import MakeNewDir
 from bento4.subtitles import SubtitlesFile
 
+import cachedb
+
 bento4logger = logging.getLogger('output_master_playlist')
 
+_packaging_pool = None
+_packaging_pool_lock = threading.Lock()
+
+
+def packaging_pool() -> ThreadPoolExecutor:
+    """ the pool that runs mp42hls for master playlist renditions.
+
+    There is one pool per worker process, shared by every request it handles,
+    so a burst of master playlist requests never runs more than [bento4] packaging_threads mp42hls at a time
+    in one worker.  Across workers, each mp42hls also holds one of the machine wide [bento4] max_processes
+    slots (see bento4_process_slot), which is the limit that counts.
+    Threads are enough: each one just waits on an mp42hls subprocess.
+    """
+    global _packaging_pool
+    if _packaging_pool is None:
+        with _packaging_pool_lock:
+            if _packaging_pool is None:
+                threads = get_config()['bento4'].getint('packaging_threads', fallback=os.cpu_count() or 1)
+                _packaging_pool = ThreadPoolExecutor(max_workers=max(1, threads),
+                                                     thread_name_prefix='rendition-packaging')
+    return _packaging_pool
+
+
+def _after_fork_in_child() -> None:
+    # pool threads don't survive a fork
+    global _packaging_pool, _packaging_pool_lock
+    _packaging_pool = None
+    _packaging_pool_lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_after_fork_in_child)
+
+
+# bump this whenever what Mp4File.analysis() saves changes
+ANALYSIS_VERSION = 1
+
+analysis_db = cachedb.MediaAnalysisDB()
+
+
+def analyzed_media_source(options, segment_manager) -> MediaSource:
+    """ a MediaSource for an input that has been processed.
+
+    If the input has been analyzed before, the saved analysis describes it
+    and neither mp4info nor mp4dump are run.  See save_analyses()
+    """
+    analysis = None
+    try:
+        key = segment_manager.analysis_key()
+        analysis = analysis_db.get(key)
+    except (OSError, sqlite3.Error):
+        logger.exception(f"could not look up the media analysis of {segment_manager.input_file}")
+        key = None
+
+    if analysis is not None and analysis.get('version') != ANALYSIS_VERSION:
+        analysis = None
+
+    media_source = MediaSource(options, segment_manager.input_file, analysis=analysis)
+    media_source.analysis_key = key
+    media_source.segment_manager = segment_manager
+    return media_source
+
+
+def rendition_info(segment_manager) -> dict:
+    """ package a rendition the way its media playlist route does, unless that has been done already.
+
+    :return: the rendition's 'mp42hls --show-info' output
+    """
+    info = segment_manager.rendition_info()
+    if info is None:
+        segment_manager.create()
+        info = segment_manager.rendition_info()
+    if info is None:
+        raise EncodingError(f"no packaging information for {segment_manager.output_dir}")
+    return info
+
+
+def save_analyses(media_sources) -> None:
+    """ save the analysis of every media source that was read from its file, for the next master playlist """
+    for media_source in media_sources:
+        key = getattr(media_source, 'analysis_key', None)
+        if key is None or media_source.analysis is not None or not hasattr(media_source, 'mp4_file'):
+            continue
+        analysis = media_source.mp4_file.analysis()
+        analysis['version'] = ANALYSIS_VERSION
+        try:
+            analysis_db.put(key, analysis)
+        except sqlite3.Error:
+            logger.exception(f"could not save the media analysis of {media_source.filename}")
+
 
 def create_master_playlist(options, media_sources):
     """ Code cut-and-pasted from bento4 mp4hls to create a master playlist
@@ -185,6 +290,7 @@ def create_master_playlist(options, media_sources):
 
     # analyze the media sources
     AnalyzeSources(options, media_sources)
+    save_analyses(mp4_sources)
 
     # select audio tracks
     audio_tracks = SelectAudioTracks(options, [media_source for media_source in mp4_sources if not media_source.spec.get('+audio_fallback')])
@@ -211,9 +317,11 @@ def create_master_playlist(options, media_sources):
     if video_has_muxed_audio and not audio_only and len(audio_tracks) == 1 and len(list(audio_tracks.values())[0]) == 1:
         audio_tracks = {}
 
-    # process main media sources
+    # process main media sources.
+    # Every rendition is packaged on the shared packaging pool, the playlist is written when all are done.
     total_duration = 0
     main_media = []
+    jobs = []
     for media_source in mp4_sources:
         if not audio_only and not media_source.spec.get('+audio_fallback') and not media_source.has_video:
             continue
@@ -239,17 +347,39 @@ def create_master_playlist(options, media_sources):
         if media_source.spec.get('+audio_fallback') == 'yes':
             media_info['video_track_id'] = 0
 
+        main_media.append(media_info)
+
+        # renditions without track selections are the same as what the media playlist route packages.
+        # Reuse those if they exist, their recorded stats are all the master playlist needs.
+        selections = set(media_info) - {'source', 'dir'}
+        if audio_only:
+            selections.discard('video_track_id')
+        segment_manager = getattr(media_source, 'segment_manager', None)
+        if segment_manager is not None and not selections:
+            info = segment_manager.rendition_info()
+            if info is not None:
+                media_info['info'] = info
+            else:
+                jobs.append((media_info, packaging_pool().submit(rendition_info, segment_manager)))
+            continue
+
         out_dir = os.path.join(options.output_dir, media_info['dir'])
         MakeNewDir(out_dir)
-        ProcessSource(options, media_info, out_dir)
+        jobs.append((None, packaging_pool().submit(ProcessSource, options, media_info, out_dir)))
+
+    # wait for all of them, so a failure doesn't leave other renditions half written behind us
+    wait([job for media_info, job in jobs])
+    for media_info, job in jobs:
+        info = job.result()
+        if media_info is not None:
+            media_info['info'] = info
 
+    for media_info in main_media:
         # update the duration
         duration_s = int(media_info['info']['stats']['duration'])
         if duration_s > total_duration:
             total_duration = duration_s
 
-        main_media.append(media_info)
-
     # process audio tracks
     if len(audio_tracks):
         MakeNewDir(os.path.join(options.output_dir, 'audio'))
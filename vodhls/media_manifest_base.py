@@ -3,7 +3,14 @@
 #See file LICENCE or visit https://github.com/flipmcf/CasterPak/blob/master/LICENSE
 import typing as t
 import os
+import json
+import time
+import shutil
+import uuid
+import sqlite3
 import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 from urllib.parse import urljoin
 from bento4.mp4utils import Mp42Hls
@@ -11,10 +18,47 @@ from bento4.mp4utils import Mp42Hls
 import cachedb
 from config import get_config
 
-from . import EncodingError, ConfigurationError
+from . import EncodingError, ConfigurationError, LockTimeout, PackagingPending
+from .locking import FileLock, lock_path, LOCK_DIR, ProcessSlots, BACKGROUND, admission, current_admission
+from . import segmenter
+from . import jobs
 
 logger = logging.getLogger('vodhls')
 
+# hidden directory under segmentParentPath where renditions are packaged before being published
+STAGING_DIR = '.staging'
+
+# written into a rendition directory once all of its files have been published
+COMPLETE_MARKER = '.complete'
+
+# cuts segments ahead of the player in this process, see MediaManager_Base.schedule_segments_ahead()
+_lookahead_pool = None
+# output_dir of the renditions the pool has (or is about to have) a lookahead running for
+_lookahead_renditions = set()
+_lookahead_lock = threading.Lock()
+
+
+def lookahead_pool() -> ThreadPoolExecutor:
+    """ the pool that cuts segments ahead of the player: [output] jit_lookahead_threads per worker process """
+    global _lookahead_pool
+    if _lookahead_pool is None:
+        with _lookahead_lock:
+            if _lookahead_pool is None:
+                threads = get_config()['output'].getint('jit_lookahead_threads', fallback=1)
+                _lookahead_pool = ThreadPoolExecutor(max_workers=max(1, threads), thread_name_prefix='lookahead')
+    return _lookahead_pool
+
+
+def _after_fork_in_child() -> None:
+    # pool threads don't survive a fork
+    global _lookahead_pool, _lookahead_lock
+    _lookahead_pool = None
+    _lookahead_renditions.clear()
+    _lookahead_lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_after_fork_in_child)
+
 
 class OptionsConfig(object):
     """ This is a basic class that turns a dictionary into an object,
@@ -31,14 +75,30 @@ class OptionsConfig(object):
             return None
 
 
+def bento4_process_slot():
+    """ the bento4 'process_slot' option: holds one of the machine wide [bento4] max_processes slots
+        while a bento4 binary runs.  What it waits for depends on locking.current_admission()
+
+    :raises PackagingPending: a request would wait longer than [bento4] admission_wait for a slot
+    """
+    config = get_config()
+    slots = ProcessSlots(os.path.join(config['output']['segmentParentPath'], LOCK_DIR),
+                         config.getint('bento4', 'max_processes', fallback=os.cpu_count() or 1),
+                         config.getint('bento4', 'background_processes', fallback=None))
+    priority, deadline = current_admission()
+    wait = config.getfloat('bento4', 'admission_wait', fallback=10.0)
+    return slots.slot(priority, timeout=wait if deadline else None,
+                      retry_after=config.getint('packager', 'retry_after', fallback=5))
+
+
 class MediaManager_Base(object):
     """
         base class for media manifest segment managers / generators.
         These take a single mp4 file, break it into segments, and create a media manifest index file.
     """
 
-    config = get_config()
     db = cachedb.CacheDB(cache_name=cachedb.INPUT_FILE_CACHE)
+    segment_db = cachedb.CacheDB(cache_name=cachedb.SEGMENT_FILE_CACHE)
 
     def __init__(self, filename):
         self.base_url = ''
@@ -49,7 +109,12 @@ class MediaManager_Base(object):
         self.filename = filename
 
         # make a note to the cache database that the input file has been touched
-        self.db.addrecord(filename=self.filename, timestamp=None)
+        self.db.touch(filename=self.filename)
+
+    @property
+    def config(self):
+        """ the process wide configuration snapshot.  Looked up on every use so a reload_config() is seen """
+        return get_config()
 
     def fetch_and_cache(self):
         """ This is where the input file is moved to the local filesystem if necessary
@@ -70,12 +135,56 @@ class MediaManager_Base(object):
             os.stat(self.input_file)
         except FileNotFoundError:
             logger.debug(f"Input File cache miss for {self.input_file}")
-            self.fetch_and_cache()
+            self.fetch_input_once()
         finally:
-            self.db.addrecord(filename=self.filename, timestamp=None)
+            self.db.touch(filename=self.filename)
+
+    def input_lock(self) -> FileLock:
+        """
+        :return: a cross-process lock that is held while this input is fetched into the input cache.
+        """
+        path = lock_path(self.config['output']['segmentParentPath'], 'input', self.filename)
+        return FileLock(path, timeout=self.lock_timeout)
+
+    def fetch_input_once(self) -> None:
+        """ fetch the input into the input cache, unless another worker does it first.
+            Workers that miss on the same input at the same time wait for the one fetch, and then use its file.
+        """
+        with self.input_lock():
+            if os.path.exists(self.cached_filename):
+                logger.debug(f"{self.cached_filename} fetched by another worker")
+                return
+            self.fetch_and_cache()
+            self.record_input_size()
 
     process_input = manage_input_file
 
+    def manage_input_index(self) -> None:
+        """ make sure enough of the input file is available to build its segment index and cut segments from it.
+            Here that's the whole file.  See MediaManager_http for inputs that are used while they download.
+        """
+        self.manage_input_file()
+
+    def record_input_size(self) -> None:
+        """ put the size of a newly cached input file in the cache ledger """
+        try:
+            self.db.set_size(self.filename, os.path.getsize(self.cached_filename))
+        except (OSError, sqlite3.Error):
+            logger.exception(f"could not record the size of {self.cached_filename}")
+
+    def record_output_size(self, size: int, replace: bool = False) -> None:
+        """ put bytes written into output_dir in the cache ledger
+
+        :param replace: True if 'size' is everything in output_dir, False to add it to what is there
+        """
+        try:
+            if replace:
+                self.segment_db.set_size(self.filename, size)
+            else:
+                self.segment_db.add_size(self.filename, size)
+        except sqlite3.Error:
+            logger.exception(f"could not record the size of {self.output_dir}")
+
     @property
     def segment_duration(self):
         try:
@@ -83,13 +192,53 @@ class MediaManager_Base(object):
         except KeyError:
             return '6'
 
+    @property
+    def lock_timeout(self) -> float:
+        """
+        :return: number of seconds to wait for another worker that is already packaging this rendition
+        """
+        return self.config['output'].getfloat('lock_timeout', fallback=300.0)
+
+    def packaging_lock(self) -> FileLock:
+        """
+        :return: a cross-process lock that is held while this rendition is being packaged.
+        Only one worker runs mp42hls for a given output_dir, the rest wait and then serve its result.
+        """
+        path = lock_path(self.config['output']['segmentParentPath'], 'package', self.filename)
+        return FileLock(path, timeout=self.lock_timeout)
+
     def create(self) -> t.Union[os.PathLike, str]:
         """
-        Create the media HLS manifest file and all segments in the configured location
+        Create the media HLS manifest file and all segments in the configured location.
+        In 'jit' packaging mode only the manifest is written, from the segment index.
 
         :return:
         a path to the output HLS media manifest file (.m3u8)
         """
+        with self.packaging_lock():
+            if self.jit_packaging:
+                if self.manifest_exists():
+                    logger.debug(f"{self.output_manifest_filename} created by another worker")
+                    return self.output_manifest_filename
+
+                # make sure input file is available.
+                self.manage_input_index()
+                try:
+                    index = self.segment_index()
+                except Exception:
+                    logger.exception(f"can not cut segments from {self.input_file}, packaging the whole file")
+                else:
+                    return self._write_manifest(index)
+
+            elif self.rendition_complete():
+                # another worker packaged this rendition while we were waiting for the lock
+                logger.debug(f"{self.output_dir} packaged by another worker")
+                return self.output_manifest_filename
+
+            return self._create()
+
+    def _create(self) -> t.Union[os.PathLike, str]:
+        """ do the actual packaging.  Only call this while holding the packaging_lock """
 
         # make sure input file is available.
         self.manage_input_file()
@@ -98,29 +247,303 @@ class MediaManager_Base(object):
             'exec_dir': self.config['bento4']['binaryPath'],
             'debug': True,
             'verbose': False,
+            'process_slot': bento4_process_slot,
         }
 
+        # mp42hls writes into a private staging directory.
+        # Nothing becomes visible in output_dir until packaging has succeeded.
+        staging_dir = self.make_staging_dir()
+
         kwargs = {
-            'index_filename': self.output_manifest_filename,
-            'segment_filename_template': os.path.join(self.output_dir, 'segment-%d.ts'),
-            'segment_url_template': urljoin(self.base_url, 'segment-%d.ts'),
+            'index_filename': os.path.join(staging_dir, self.manifest_name),
+            'segment_filename_template': os.path.join(staging_dir, segmenter.SEGMENT_FILENAME_TEMPLATE),
+            'segment_url_template': urljoin(self.base_url, segmenter.SEGMENT_FILENAME_TEMPLATE),
             'segment_duration': str(self.segment_duration),
             'allow-cache': True,
+            'show_info': True,
         }
 
         options = OptionsConfig(hls_config)
 
-        if not os.path.isdir(self.output_dir):
-            self.make_segment_dir()
-
         try:
-            Mp42Hls(options, self.input_file, **kwargs)
+            json_info = Mp42Hls(options, self.input_file, **kwargs)
+        except PackagingPending:
+            shutil.rmtree(staging_dir, ignore_errors=True)
+            raise
         except Exception:
             logger.exception("Error creating segment files")
+            shutil.rmtree(staging_dir, ignore_errors=True)
             raise EncodingError
 
+        marker = self.write_complete_marker(staging_dir, json_info)
+        self.publish(staging_dir)
+        self.record_output_size(marker['bytes'], replace=True)
+
+        return self.output_manifest_filename
+
+    @property
+    def jit_packaging(self) -> bool:
+        """
+        :return: True if segments should be cut one at a time on request, instead of packaging the whole file
+        """
+        return self.config['output'].get('packaging_mode', fallback='mp42hls') == 'jit'
+
+    @property
+    def jit_lookahead(self) -> int:
+        """
+        :return: number of segments to cut after a requested segment in jit packaging mode
+        """
+        return self.config['output'].getint('jit_lookahead', fallback=0)
+
+    @property
+    def index_sidecar(self) -> t.Union[os.PathLike, str]:
+        """
+        :return: path of the saved segment index, kept in the input cache next to the input file
+        """
+        return self.cached_filename + segmenter.SIDECAR_SUFFIX
+
+    def analysis_key(self) -> str:
+        """
+        :return: the key of this input's saved media analysis (see cachedb.MediaAnalysisDB):
+        the path, size and modification time of the input file
+        """
+        st = os.stat(self.input_file)
+        return f"{os.path.abspath(self.input_file)}:{st.st_size}:{st.st_mtime_ns}"
+
+    def segment_index(self) -> segmenter.SegmentIndex:
+        return segmenter.load_index(self.input_file, float(self.segment_duration), sidecar=self.index_sidecar)
+
+    def _write_manifest(self, index: segmenter.SegmentIndex) -> t.Union[os.PathLike, str]:
+        """ write the media playlist from the segment index, before any segment exists.
+            Only call this while holding the packaging_lock
+        """
+        playlist = index.render_playlist(urljoin(self.base_url, segmenter.SEGMENT_FILENAME_TEMPLATE))
+
+        staging_dir = self.make_staging_dir()
+        try:
+            with open(os.path.join(staging_dir, self.manifest_name), 'w', newline='') as f:
+                f.write(playlist)
+            self.publish(staging_dir)
+        finally:
+            shutil.rmtree(staging_dir, ignore_errors=True)
+        self.record_output_size(len(playlist))
+
         return self.output_manifest_filename
 
+    def create_segment(self, segment_filename: str, lock_timeout: float = None) -> t.Union[os.PathLike, str]:
+        """
+        Cut a single segment out of the input file, without packaging the rest of it.
+        If the input can't be cut natively (eg: an unsupported codec) the whole rendition is packaged instead.
+
+        :param segment_filename: a filename of a segment, (not a full path).
+           eg: 'segment-169.ts
+        :param lock_timeout: seconds to wait for another worker cutting the same segment,
+           by default [output] lock_timeout
+        :return: a path to the segment file
+        """
+        number = segmenter.segment_number(segment_filename)
+        if number is None:
+            raise FileNotFoundError(segment_filename)
+
+        segment_path = os.path.join(self.output_dir, segment_filename)
+        path = lock_path(self.config['output']['segmentParentPath'], 'segment', segment_path)
+        with FileLock(path, timeout=self.lock_timeout if lock_timeout is None else lock_timeout):
+            if self.segment_exists(segment_filename):
+                return segment_path
+
+            self.manage_input_index()
+
+            try:
+                index = self.segment_index()
+            except Exception:
+                logger.exception(f"can not cut segments from {self.input_file}, packaging the whole file")
+                self.create()
+                if not self.segment_exists(segment_filename):
+                    raise FileNotFoundError(segment_path)
+                return segment_path
+
+            if number >= len(index.segments):
+                raise FileNotFoundError(segment_path)
+
+            self._write_segment(index, number, segment_filename)
+
+        return segment_path
+
+    def _write_segment(self, index: segmenter.SegmentIndex, number: int, segment_filename: str) -> None:
+        """ write one segment to a staging file, then rename it into output_dir """
+        staging_dir = self.make_staging_dir()
+        staging_file = os.path.join(staging_dir, segment_filename)
+        try:
+            with open(staging_file, 'wb') as f:
+                index.write_segment(number, f)
+            size = os.path.getsize(staging_file)
+            os.makedirs(self.output_dir, exist_ok=True)
+            os.replace(staging_file, os.path.join(self.output_dir, segment_filename))
+        except Exception:
+            logger.exception(f"Error cutting segment {number} from {self.input_file}")
+            raise EncodingError
+        finally:
+            shutil.rmtree(staging_dir, ignore_errors=True)
+        self.record_output_size(size)
+
+    def schedule_segments_ahead(self, segment_filename: str) -> None:
+        """ have the jit_lookahead segments that follow segment_filename cut in the background.
+
+            With [packager] queue on they are queued as low priority 'lookahead' jobs for the packager processes.
+            Otherwise they are cut on this process's lookahead_pool(),
+            unless it is already cutting ahead in this rendition.
+        """
+        number = segmenter.segment_number(segment_filename)
+        if number is None or not self.jit_lookahead:
+            return
+
+        if jobs.queued():
+            for n in range(number + 1, number + 1 + self.jit_lookahead):
+                next_filename = segmenter.SEGMENT_FILENAME_TEMPLATE % n
+                if not self.segment_exists(next_filename):
+                    jobs.submit('lookahead', os.path.join(self.output_dir, next_filename),
+                                filename=self.filename, baseurl=self.base_url, segment=next_filename)
+            return
+
+        with _lookahead_lock:
+            if self.output_dir in _lookahead_renditions:
+                return
+            _lookahead_renditions.add(self.output_dir)
+        try:
+            lookahead_pool().submit(self._lookahead_task, segment_filename)
+        except Exception:
+            with _lookahead_lock:
+                _lookahead_renditions.discard(self.output_dir)
+            raise
+
+    def _lookahead_task(self, segment_filename: str) -> None:
+        try:
+            self.create_segments_ahead(segment_filename)
+        finally:
+            with _lookahead_lock:
+                _lookahead_renditions.discard(self.output_dir)
+
+    def create_segments_ahead(self, segment_filename: str) -> None:
+        """ cut the jit_lookahead segments that follow segment_filename, so they are ready when the player asks """
+        number = segmenter.segment_number(segment_filename)
+        if number is None:
+            return
+
+        # nobody is waiting for these: bento4 processes give way to requests'
+        with admission(BACKGROUND, deadline=False):
+            for n in range(number + 1, number + 1 + self.jit_lookahead):
+                next_filename = segmenter.SEGMENT_FILENAME_TEMPLATE % n
+                if self.segment_exists(next_filename):
+                    continue
+                try:
+                    # a segment another thread or worker is cutting is left to it
+                    self.create_segment(next_filename, lock_timeout=0)
+                except LockTimeout:
+                    continue
+                except FileNotFoundError:
+                    # past the last segment
+                    return
+                except PackagingPending:
+                    # no bento4 process slot for background work
+                    return
+                except Exception:
+                    logger.exception(f"could not cut {next_filename} ahead for {self.filename}")
+                    return
+
+    def make_staging_dir(self) -> t.Union[os.PathLike, str]:
+        """
+        :return: a new, empty, uniquely named directory on the same filesystem as output_dir
+        """
+        segment_parent_path = self.config['output']['segmentParentPath']
+        if not os.path.isdir(segment_parent_path):
+            # configuration is wrong.  This path should always exist.
+            logger.error(f"The configured segment directory {segment_parent_path} doesn't exist")
+            raise FileNotFoundError
+
+        staging_parent = os.path.join(segment_parent_path, STAGING_DIR)
+        os.makedirs(staging_parent, exist_ok=True)
+
+        # os.mkdir honors the umask, so published directories get the same permissions as any other
+        staging_dir = os.path.join(staging_parent, uuid.uuid4().hex)
+        os.mkdir(staging_dir)
+        return staging_dir
+
+    def write_complete_marker(self, staging_dir: t.Union[os.PathLike, str], json_info: bytes = None) -> dict:
+        """ record what was packaged, next to the segments.
+            The marker is the last file to be published, so its presence means the rendition is whole.
+
+        :return: the marker
+        """
+        segment_count = 0
+        total_bytes = 0
+        for entry in os.scandir(staging_dir):
+            total_bytes += entry.stat().st_size
+            if entry.name.endswith('.ts'):
+                segment_count += 1
+
+        try:
+            info = json.loads(json_info, strict=False)
+        except (TypeError, ValueError):
+            info = None
+
+        marker = {
+            'created': int(time.time()),
+            'segments': segment_count,
+            'bytes': total_bytes,
+            'info': info,
+        }
+        with open(os.path.join(staging_dir, COMPLETE_MARKER), 'w') as f:
+            json.dump(marker, f)
+        return marker
+
+    def publish(self, staging_dir: t.Union[os.PathLike, str]) -> None:
+        """ atomically move a finished rendition from staging_dir to output_dir
+
+        If output_dir does not exist yet (or is empty), the whole directory is renamed into place.
+        Otherwise each file is renamed over its counterpart: segments first, then the manifest,
+        then the completion marker.  Every individual rename is atomic, so a reader
+        either sees the old file, the new file, or nothing - never a partial one.
+        """
+        os.makedirs(os.path.dirname(self.output_dir), exist_ok=True)
+
+        try:
+            os.rename(staging_dir, self.output_dir)
+            logger.debug(f"published {self.output_dir}")
+            return
+        except OSError:
+            # output_dir exists and is not empty
+            pass
+
+        names = sorted(os.listdir(staging_dir), key=lambda name: (name == COMPLETE_MARKER, name == self.manifest_name))
+        for name in names:
+            os.replace(os.path.join(staging_dir, name), os.path.join(self.output_dir, name))
+        os.rmdir(staging_dir)
+        logger.debug(f"published {len(names)} files into {self.output_dir}")
+
+    def rendition_complete(self) -> bool:
+        """
+        :return: True if the whole rendition (manifest and every segment) has been packaged
+        """
+        return os.path.exists(os.path.join(self.output_dir, COMPLETE_MARKER))
+
+    def rendition_info(self) -> t.Optional[dict]:
+        """
+        :return: what 'mp42hls --show-info' reported for this rendition (bitrates, codecs, resolution),
+        from its completion marker, or in 'jit' mode from the segment index.
+        None if the rendition hasn't been packaged.
+        """
+        try:
+            with open(os.path.join(self.output_dir, COMPLETE_MARKER)) as f:
+                info = json.load(f).get('info')
+            if info:
+                return info
+        except (FileNotFoundError, ValueError):
+            pass
+
+        if self.jit_packaging and self.manifest_exists():
+            return self.segment_index().info
+        return None
+
     def manifest_exists(self) -> bool:
         try:
             os.stat(self.output_manifest_filename)
@@ -143,16 +566,6 @@ class MediaManager_Base(object):
             return False
         return True
 
-    def make_segment_dir(self) -> None:
-
-        if not os.path.isdir(self.config['output']['segmentParentPath']):
-            # configuration is wrong.  This path should always exist.
-            logger.error(f"The configured segment directory {self.config['output']['segmentParentPath']} doesn't exist")
-            raise FileNotFoundError
-
-        logger.debug(f"creating new segment directory {os.path.join(self.output_dir)} ")
-        os.makedirs(os.path.join(self.output_dir))
-
     @property
     def output_dir(self) -> t.Union[os.PathLike, str]:
         """
@@ -169,15 +582,17 @@ class MediaManager_Base(object):
         return os.path.join(path, self.filename)
 
     @property
-    def output_manifest_filename(self) -> t.Union[os.PathLike, str]:
+    def manifest_name(self) -> str:
         try:
-            filename = self.config['output']['childManifestFilename']
+            return self.config['output']['childManifestFilename']
         except KeyError:
             msg = "childManifestFilename not configured in casterpak config.ini"
             logger.error(msg)
             raise ConfigurationError(msg)
 
-        return os.path.join(self.output_dir, filename)
+    @property
+    def output_manifest_filename(self) -> t.Union[os.PathLike, str]:
+        return os.path.join(self.output_dir, self.manifest_name)
 
     @property
     def cached_filename(self) -> t.Union[os.PathLike, str]:
@@ -3,11 +3,12 @@
 #See file LICENCE or visit https://github.com/flipmcf/CasterPak/blob/master/LICENSE
 import typing as t
 import os
-import shutil
+import uuid
 import logging
 
 from vodhls.media_manifest_base import MediaManager_Base
 from vodhls.media_manifest_base import ConfigurationError
+from vodhls.filecopy import copy_file, METHODS
 
 logger = logging.getLogger('vodhls')
 
@@ -36,16 +37,33 @@ class MediaManager_filesystem(MediaManager_Base):
         except FileNotFoundError:
             if self.input_cache_enabled:
                 logger.debug(f"Input File cache miss for {self.input_file}")
-                self.fetch_and_cache()
+                self.fetch_input_once()
             else:
                 raise
         finally:
-            self.db.addrecord(filename=self.filename, timestamp=None)
+            self.db.touch(filename=self.filename)
 
     def fetch_and_cache(self):
         logger.debug(f"copy {self.source_file}, {self.cached_filename}")
         os.makedirs(os.path.dirname(self.cached_filename), exist_ok=True)
-        shutil.copy(self.source_file, self.cached_filename)
+
+        fs_config = self.config['filesystem']
+        methods = fs_config.get('cache_fill_methods', fallback=','.join(METHODS))
+        methods = [method.strip() for method in methods.split(',') if method.strip()]
+
+        # copy to a temporary name, so a reader never sees a partly copied input
+        temp_name = f'{self.cached_filename}.{uuid.uuid4().hex}.tmp'
+        try:
+            copy_file(self.source_file, temp_name, methods=methods,
+                      chunk_size=fs_config.getint('cache_fill_chunk_mb', fallback=8) * 1024 * 1024,
+                      max_bytes_per_second=fs_config.getfloat('cache_fill_max_mbps', fallback=0) * 1e6)
+            os.replace(temp_name, self.cached_filename)
+        except BaseException:
+            try:
+                os.remove(temp_name)
+            except FileNotFoundError:
+                pass
+            raise
 
     @property
     def source_file(self) -> t.Union[os.PathLike, str]:
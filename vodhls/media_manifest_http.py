@@ -3,41 +3,162 @@
 #See file LICENCE or visit https://github.com/flipmcf/CasterPak/blob/master/LICENSE
 import os
 import re
-
-import requests
+import sqlite3
 import urllib
 import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
+from vodhls import EncodingError
 from vodhls.media_manifest_base import MediaManager_Base
+from vodhls.httpfetch import HttpFetcher, PartialDownload, RemoteFileChanged
+from vodhls import segmenter
+
 logger = logging.getLogger('vodhls')
 
+# byte ranges of a segment closer than this are fetched with one request
+SEGMENT_RANGE_GAP = 64 * 1024
+
+# inputs this process is using in 'progressive' mode before they have arrived, by cached_filename.
+# The byte ranges they have fetched are shared with other processes through the '.part' file's progress record.
+_partial_downloads = {}
+_partial_downloads_lock = threading.Lock()
+
+# fetches the rest of those inputs into the input cache.  {cached_filename: Future}
+_background_fetches = {}
+_background_pool = ThreadPoolExecutor(max_workers=2, thread_name_prefix='input-fetch')
+
 
 class MediaManager_http(MediaManager_Base):
     """
     Implements http based VODHLS Manager
     gets the input file from a http:// url and saves it to local input cache.
+
+    In 'progressive' mode (jit packaging only) the manifest is written as soon as the 'moov' box is in,
+    segments are cut from just the byte ranges they need, and the rest of the file is fetched in the background.
     """
 
+    def manage_input_file(self) -> None:
+        background_fetch = _background_fetches.get(self.cached_filename)
+        if background_fetch is not None:
+            # wait for it here, not while holding the input_lock it takes
+            try:
+                background_fetch.result()
+            except Exception:
+                logger.info(f"background fetch of {self.source_url} failed, fetching it again")
+
+        super(MediaManager_http, self).manage_input_file()
+
     def fetch_and_cache(self):
         logger.debug(f"requesting {self.source_url}")
-        os.makedirs(os.path.dirname(self.cached_filename), exist_ok=True)
+        content_hash = self.fetcher().fetch(self.source_url, self.cached_filename)
 
-        with requests.get(self.source_url, timeout=self.fetch_timeout, stream=True) as response:
-            if response.status_code != 200:
-                logger.error(f"error {response.status_code} while requesting {self.source_url}")
-                raise FileNotFoundError
+        try:
+            self.db.set_content_hash(self.filename, content_hash)
+        except sqlite3.Error:
+            logger.exception(f"could not record the content hash of {self.cached_filename}")
 
-            with open(self.cached_filename, "wb") as f:
-                for chunk in response.iter_content(chunk_size=8192):
-                    f.write(chunk)
+    def analysis_key(self) -> str:
+        """
+        :return: the key of this input's saved media analysis: a hash of its content.
+        The cached copy gets a new mtime every time it is fetched, the content stays the same.
+        """
+        content_hash = self.db.content_hash(self.filename)
+        if content_hash is None:
+            # fetched before we kept hashes
+            return super(MediaManager_http, self).analysis_key()
+        return f"blake2b:{content_hash}"
 
+    def fetcher(self) -> HttpFetcher:
+        """
+        :return: a fetcher configured from the [http] section
+        """
+        http_config = self.config['http']
+        return HttpFetcher(connect_timeout=http_config.getfloat('connect_timeout', fallback=3.05),
+                           read_timeout=http_config.getfloat('read_timeout', fallback=30.0),
+                           buffer_size=http_config.getint('buffer_kb', fallback=1024) * 1024,
+                           piece_size=http_config.getint('range_piece_mb', fallback=64) * 1024 * 1024,
+                           connections=http_config.getint('range_connections', fallback=4))
 
     @property
-    def fetch_timeout(self) -> float:
+    def progressive(self) -> bool:
+        """
+        :return: True if segments should be cut while the input file is still downloading
+        """
+        return self.jit_packaging and self.config['http'].getboolean('progressive', fallback=False)
+
+    def manage_input_index(self) -> None:
+        if not self.progressive or os.path.exists(self.cached_filename):
+            return self.manage_input_file()
+
+        try:
+            self.partial_download()
+        except (NotImplementedError, ValueError) as err:
+            logger.info(f"can not use {self.source_url} before it has downloaded: {err}")
+            self.manage_input_file()
+        finally:
+            self.db.touch(filename=self.filename)
+
+    def partial_download(self) -> PartialDownload:
         """
-        :return: number of seconds to wait for a response from remote server when transferring input files
+        :return: the PartialDownload of this input, with its 'moov' box fetched.
+        The first call for an input starts fetching the whole file in the background.
         """
-        return 1.0
+        with _partial_downloads_lock:
+            partial = _partial_downloads.get(self.cached_filename)
+            if partial is None:
+                logger.debug(f"fetching the moov box of {self.source_url}")
+                partial = PartialDownload(self.fetcher(), self.source_url, self.cached_filename)
+                partial.fetch_header()
+                _partial_downloads[self.cached_filename] = partial
+                _background_fetches[self.cached_filename] = _background_pool.submit(self.background_fetch)
+        return partial
+
+    def background_fetch(self) -> None:
+        """ fill in the rest of a partial download """
+        try:
+            self.fetch_input_once()
+        except Exception:
+            logger.exception(f"could not fetch {self.source_url} in the background")
+            raise
+        finally:
+            with _partial_downloads_lock:
+                _partial_downloads.pop(self.cached_filename, None)
+                _background_fetches.pop(self.cached_filename, None)
+
+    def segment_index(self) -> segmenter.SegmentIndex:
+        partial = _partial_downloads.get(self.cached_filename)
+        if partial is None or os.path.exists(self.cached_filename):
+            return super(MediaManager_http, self).segment_index()
+
+        # the '.part' file changes as it fills in, the remote file it is a copy of doesn't
+        return segmenter.load_index(partial.part, float(self.segment_duration), sidecar=self.index_sidecar,
+                                    identity=partial.identity)
+
+    def _write_segment(self, index: segmenter.SegmentIndex, number: int, segment_filename: str) -> None:
+        partial = _partial_downloads.get(self.cached_filename)
+        if partial is not None and index.filename == partial.part and os.path.exists(self.cached_filename):
+            # the download finished since the index was loaded
+            index = self.segment_index()
+        elif partial is not None and index.filename == partial.part:
+            try:
+                partial.ensure(index.byte_ranges(number, gap=SEGMENT_RANGE_GAP))
+            except RemoteFileChanged:
+                logger.error(f"{self.source_url} changed while it was being fetched")
+                with _partial_downloads_lock:
+                    _partial_downloads.pop(self.cached_filename, None)
+                raise EncodingError
+            except Exception:
+                logger.exception(f"could not fetch segment {number} of {self.source_url}")
+                raise EncodingError
+
+        try:
+            super(MediaManager_http, self)._write_segment(index, number, segment_filename)
+        except EncodingError:
+            if index.filename == self.cached_filename or not os.path.exists(self.cached_filename):
+                raise
+            # the download finished and the '.part' file was renamed while we were cutting
+            super(MediaManager_http, self)._write_segment(self.segment_index(), number, segment_filename)
 
     @property
     def source_url(self):
@@ -0,0 +1,386 @@
+#Copyright (c) 2022, Michael McFadden & Radio Free Asia
+#GNU GENERAL PUBLIC LICENSE Version 2
+#See file LICENCE or visit https://github.com/flipmcf/CasterPak/blob/master/LICENSE
+"""
+A minimal MPEG-2 Transport Stream writer for HLS segments.
+
+Supports H.264 and HEVC video with AAC and MP3 audio - what mp42hls would put in a segment.
+Samples are given in mp4 form (length prefixed NAL units, raw AAC frames)
+and converted to the Annex-B / ADTS elementary streams that TS requires.
+"""
+import struct
+import logging
+import operator
+import itertools
+import typing as t
+
+from bento4.mp4boxes import ParseEsds
+
+logger = logging.getLogger('vodhls')
+
+TS_PACKET_SIZE = 188
+TS_PAYLOAD_SIZE = 184
+
+PAT_PID = 0x0000
+PMT_PID = 0x0100
+AUDIO_PID = 0x0101
+VIDEO_PID = 0x0102
+
+STREAM_TYPE_MPEG1_AUDIO = 0x03
+STREAM_TYPE_AAC_ADTS = 0x0F
+STREAM_TYPE_H264 = 0x1B
+STREAM_TYPE_HEVC = 0x24
+
+STREAM_ID_AUDIO = 0xC0
+STREAM_ID_VIDEO = 0xE0
+
+# same default as mp42hls --pcr-offset, in 90kHz units.  PTS/DTS are written this far ahead of the PCR.
+PCR_OFFSET = 10000
+
+TIMESTAMP_MASK = (1 << 33) - 1
+
+H264_CODINGS = {'avc1', 'avc3'}
+HEVC_CODINGS = {'hvc1', 'hev1'}
+AAC_CODINGS = {'mp4a'}
+MP3_CODINGS = {'.mp3'}
+
+
+def _crc32_table():
+    table = []
+    for i in range(256):
+        crc = i << 24
+        for _ in range(8):
+            crc = ((crc << 1) ^ 0x04C11DB7) if crc & 0x80000000 else (crc << 1)
+        table.append(crc & 0xFFFFFFFF)
+    return table
+
+
+CRC32_TABLE = _crc32_table()
+
+
+def crc32_mpeg2(data: bytes) -> int:
+    crc = 0xFFFFFFFF
+    for byte in data:
+        crc = ((crc << 8) & 0xFFFFFFFF) ^ CRC32_TABLE[((crc >> 24) ^ byte) & 0xFF]
+    return crc
+
+
+def encode_timestamp(prefix: int, ts: int) -> bytes:
+    """ 33 bit PES timestamp with marker bits """
+    ts &= TIMESTAMP_MASK
+    return bytes([
+        (prefix << 4) | (((ts >> 30) & 0x07) << 1) | 1,
+        (ts >> 22) & 0xFF,
+        (((ts >> 15) & 0x7F) << 1) | 1,
+        (ts >> 7) & 0xFF,
+        ((ts & 0x7F) << 1) | 1,
+    ])
+
+
+def encode_pcr(pcr_base: int) -> bytes:
+    """ 48 bit adaptation field PCR.  pcr_base is in 90kHz units, the 27MHz extension is left at 0 """
+    pcr_base &= TIMESTAMP_MASK
+    return bytes([
+        (pcr_base >> 25) & 0xFF,
+        (pcr_base >> 17) & 0xFF,
+        (pcr_base >> 9) & 0xFF,
+        (pcr_base >> 1) & 0xFF,
+        ((pcr_base & 0x01) << 7) | 0x7E,
+        0x00,
+    ])
+
+
+class ElementaryStream(object):
+    """ one track in the transport stream: turns mp4 samples into PES payloads """
+
+    stream_type = None
+    stream_id = None
+    pid = None
+
+    def convert(self, sample: bytes, is_sync: bool) -> bytes:
+        raise NotImplementedError
+
+    def converted_size(self, size: int, is_sync: bool) -> int:
+        """ :return: the size of convert()'s output for a 'size' byte sample, without reading the sample """
+        return size
+
+
+class H264Stream(ElementaryStream):
+    stream_type = STREAM_TYPE_H264
+    stream_id = STREAM_ID_VIDEO
+    pid = VIDEO_PID
+    access_unit_delimiter = b'\x00\x00\x00\x01\x09\xf0'
+    aud_nal_type = 9
+
+    def __init__(self, avcc: bytes):
+        if not avcc:
+            raise NotImplementedError('missing avcC decoder configuration')
+        self.nalu_length_size = (avcc[4] & 0x03) + 1
+        self.parameter_sets = []
+        position = 5
+        for count_mask in (0x1F, 0xFF):
+            count = avcc[position] & count_mask
+            position += 1
+            for _ in range(count):
+                length = struct.unpack_from('>H', avcc, position)[0]
+                self.parameter_sets.append(avcc[position + 2:position + 2 + length])
+                position += 2 + length
+
+    def nal_type(self, nal: bytes) -> int:
+        return nal[0] & 0x1F
+
+    def convert(self, sample: bytes, is_sync: bool) -> bytes:
+        out = [self.access_unit_delimiter]
+        if is_sync:
+            for parameter_set in self.parameter_sets:
+                out.append(b'\x00\x00\x00\x01')
+                out.append(parameter_set)
+
+        position = 0
+        size = len(sample)
+        length_size = self.nalu_length_size
+        while position + length_size <= size:
+            length = int.from_bytes(sample[position:position + length_size], 'big')
+            position += length_size
+            nal = sample[position:position + length]
+            position += length
+            if not nal or self.nal_type(nal) == self.aud_nal_type:
+                continue
+            out.append(b'\x00\x00\x00\x01')
+            out.append(nal)
+
+        return b''.join(out)
+
+    def converted_size(self, size: int, is_sync: bool) -> int:
+        # assumes 4 byte NAL unit lengths, which are replaced by 4 byte start codes
+        size += len(self.access_unit_delimiter)
+        if is_sync:
+            size += sum(4 + len(parameter_set) for parameter_set in self.parameter_sets)
+        return size
+
+
+class HevcStream(H264Stream):
+    stream_type = STREAM_TYPE_HEVC
+    access_unit_delimiter = b'\x00\x00\x00\x01\x46\x01\x50'
+    aud_nal_type = 35
+
+    def __init__(self, hvcc: bytes):
+        if not hvcc:
+            raise NotImplementedError('missing hvcC decoder configuration')
+        self.nalu_length_size = (hvcc[21] & 0x03) + 1
+        self.parameter_sets = []
+        array_count = hvcc[22]
+        position = 23
+        for _ in range(array_count):
+            count = struct.unpack_from('>H', hvcc, position + 1)[0]
+            position += 3
+            for _ in range(count):
+                length = struct.unpack_from('>H', hvcc, position)[0]
+                self.parameter_sets.append(hvcc[position + 2:position + 2 + length])
+                position += 2 + length
+
+    def nal_type(self, nal: bytes) -> int:
+        return (nal[0] >> 1) & 0x3F
+
+
+class AacStream(ElementaryStream):
+    stream_type = STREAM_TYPE_AAC_ADTS
+    stream_id = STREAM_ID_AUDIO
+    pid = AUDIO_PID
+
+    def __init__(self, esds: bytes):
+        if not esds:
+            raise NotImplementedError('missing esds decoder configuration')
+        object_type, config = ParseEsds(esds)
+        if object_type != 0x40 or len(config) < 2:
+            raise NotImplementedError(f'unsupported audio object type {object_type:#x}')
+
+        bits = int.from_bytes(config[:4].ljust(4, b'\x00'), 'big')
+        audio_object_type = bits >> 27
+        sampling_frequency_index = (bits >> 23) & 0x0F
+        channel_configuration = (bits >> 19) & 0x0F
+        if audio_object_type == 31 or sampling_frequency_index == 15:
+            raise NotImplementedError('escaped AAC audio specific config is not supported')
+        if audio_object_type in (5, 29):
+            # explicit SBR/PS signalling - ADTS carries the core AAC-LC stream
+            audio_object_type = 2
+        if not 1 <= audio_object_type <= 4:
+            raise NotImplementedError(f'AAC object type {audio_object_type} cannot be carried in ADTS')
+
+        self.profile = audio_object_type - 1
+        self.sampling_frequency_index = sampling_frequency_index
+        self.channel_configuration = channel_configuration
+
+    def convert(self, sample: bytes, is_sync: bool) -> bytes:
+        frame_length = len(sample) + 7
+        header = bytes([
+            0xFF,
+            0xF1,
+            (self.profile << 6) | (self.sampling_frequency_index << 2) | (self.channel_configuration >> 2),
+            ((self.channel_configuration & 0x03) << 6) | (frame_length >> 11),
+            (frame_length >> 3) & 0xFF,
+            ((frame_length & 0x07) << 5) | 0x1F,
+            0xFC,
+        ])
+        return header + sample
+
+    def converted_size(self, size: int, is_sync: bool) -> int:
+        return size + 7
+
+
+class Mp3Stream(ElementaryStream):
+    stream_type = STREAM_TYPE_MPEG1_AUDIO
+    stream_id = STREAM_ID_AUDIO
+    pid = AUDIO_PID
+
+    def convert(self, sample: bytes, is_sync: bool) -> bytes:
+        return sample
+
+
+def elementary_stream_for(track) -> ElementaryStream:
+    """
+    :param track: a bento4.mp4boxes.Mp4TrackInfo
+    :return: an ElementaryStream that can carry the track, or raise NotImplementedError
+    """
+    if track.coding in H264_CODINGS:
+        return H264Stream(track.decoder_config('avcC'))
+    if track.coding in HEVC_CODINGS:
+        return HevcStream(track.decoder_config('hvcC'))
+    if track.coding in AAC_CODINGS:
+        esds = track.decoder_config('esds')
+        if esds and ParseEsds(esds)[0] in (0x69, 0x6B):
+            return Mp3Stream()
+        return AacStream(esds)
+    if track.coding in MP3_CODINGS:
+        return Mp3Stream()
+    raise NotImplementedError(f'{track.coding} can not be packaged into a transport stream')
+
+
+class TsWriter(object):
+    """ writes TS packets for a set of elementary streams to a file object """
+
+    def __init__(self, fileobj, streams, continuity: t.Dict[int, int] = None):
+        """
+        :param fileobj: anything with a write(bytes) method
+        :param streams: list of ElementaryStream.  The video stream (if any) carries the PCR.
+        :param continuity: {pid: continuity counter of its first packet}.  A segment carries on from where
+         the one before it left off, like mp42hls' segments do.  Counters not given start at 0.
+        """
+        self.fileobj = fileobj
+        self.streams = streams
+        self.continuity = dict(continuity or {})
+        video = [stream for stream in streams if stream.stream_id == STREAM_ID_VIDEO]
+        self.pcr_pid = video[0].pid if video else streams[0].pid
+
+    def sample_bytes(self, stream: ElementaryStream, size: int, is_sync: bool) -> int:
+        """ :return: bytes of TS packets write_sample() writes for a 'size' byte sample.
+            Exact, as long as H.264/HEVC samples use 4 byte NAL unit lengths (see converted_size())
+        """
+        pes = self.pes_overhead(stream, is_sync) + size
+        return -(-pes // TS_PAYLOAD_SIZE) * TS_PACKET_SIZE
+
+    def samples_bytes(self, stream: ElementaryStream, sizes: t.Iterable[int], is_sync: bool) -> int:
+        """ :return: the sum of sample_bytes() over samples of these sizes, all sync samples or none of them.
+            Runs over a whole sample size table without a python loop.
+        """
+        rounding = self.pes_overhead(stream, is_sync) + TS_PAYLOAD_SIZE - 1
+        packets = sum(map(operator.floordiv, map(rounding.__add__, sizes), itertools.repeat(TS_PAYLOAD_SIZE)))
+        return packets * TS_PACKET_SIZE
+
+    def pes_overhead(self, stream: ElementaryStream, is_sync: bool) -> int:
+        """ :return: bytes a sample grows by in its PES packet, before it is split into TS packets.
+            converted_size() only ever adds a fixed number of bytes to a sample.
+        """
+        header_data = 10 if stream.stream_id == STREAM_ID_VIDEO else 5
+        pes = 9 + header_data + stream.converted_size(0, is_sync)
+        # adaptation field with the PCR, or just the random access flag
+        if stream.pid == self.pcr_pid:
+            pes += 8
+        elif is_sync and stream.stream_id == STREAM_ID_VIDEO:
+            pes += 2
+        return pes
+
+    def _next_continuity(self, pid: int) -> int:
+        counter = self.continuity.get(pid, 0)
+        self.continuity[pid] = (counter + 1) & 0x0F
+        return counter
+
+    def _write_section(self, pid: int, section: bytes) -> None:
+        section += struct.pack('>I', crc32_mpeg2(section))
+        payload = b'\x00' + section   # pointer field
+        header = struct.pack('>BHB', 0x47, 0x4000 | pid, 0x10 | self._next_continuity(pid))
+        self.fileobj.write(header + payload.ljust(TS_PAYLOAD_SIZE, b'\xff'))
+
+    def write_tables(self) -> None:
+        """ write the PAT and PMT.  Every HLS segment starts with these """
+        program = struct.pack('>HH', 1, 0xE000 | PMT_PID)
+        pat = struct.pack('>BHHBBB', 0x00, 0xB000 | (len(program) + 9), 1, 0xC1, 0, 0) + program
+        self._write_section(PAT_PID, pat)
+
+        elementary = b''.join(struct.pack('>BHH', stream.stream_type, 0xE000 | stream.pid, 0xF000)
+                              for stream in self.streams)
+        body = struct.pack('>HH', 0xE000 | self.pcr_pid, 0xF000) + elementary
+        pmt = struct.pack('>BHHBBB', 0x02, 0xB000 | (len(body) + 9), 1, 0xC1, 0, 0) + body
+        self._write_section(PMT_PID, pmt)
+
+    def write_sample(self, stream: ElementaryStream, sample: bytes, dts: int, pts: int, is_sync: bool) -> None:
+        """
+        :param dts, pts: timestamps in 90kHz units, not including the PCR_OFFSET
+        """
+        data = stream.convert(sample, is_sync)
+
+        if pts == dts and stream.stream_id != STREAM_ID_VIDEO:
+            # video always gets a DTS, so sample_bytes() knows its size without the composition offsets
+            header_data = encode_timestamp(0x2, pts + PCR_OFFSET)
+            flags = 0x80
+        else:
+            header_data = encode_timestamp(0x3, pts + PCR_OFFSET) + encode_timestamp(0x1, dts + PCR_OFFSET)
+            flags = 0xC0
+
+        pes_length = 3 + len(header_data) + len(data)
+        if stream.stream_id == STREAM_ID_VIDEO or pes_length > 0xFFFF:
+            # unbounded, allowed for video
+            pes_length = 0
+        pes = struct.pack('>3sBHBBB', b'\x00\x00\x01', stream.stream_id, pes_length,
+                          0x84, flags, len(header_data)) + header_data + data
+
+        pcr = dts if stream.pid == self.pcr_pid else None
+        self._write_pes(stream.pid, pes, pcr, is_sync and stream.stream_id == STREAM_ID_VIDEO)
+
+    def _write_pes(self, pid: int, pes: bytes, pcr: int, random_access: bool) -> None:
+        position = 0
+        first = True
+        size = len(pes)
+        packets = []
+        while position < size:
+            adaptation = None
+            if first and (pcr is not None or random_access):
+                adaptation = bytes([(0x40 if random_access else 0) | (0x10 if pcr is not None else 0)])
+                if pcr is not None:
+                    adaptation += encode_pcr(pcr)
+
+            adaptation_size = 0 if adaptation is None else 1 + len(adaptation)
+            space = TS_PAYLOAD_SIZE - adaptation_size
+            remaining = size - position
+            if remaining < space:
+                # pad the last packet with adaptation field stuffing
+                stuffing = space - remaining
+                if adaptation is None:
+                    adaptation = b'' if stuffing == 1 else b'\x00' + b'\xff' * (stuffing - 2)
+                else:
+                    adaptation += b'\xff' * stuffing
+                space = remaining
+
+            if adaptation is None:
+                control = 0x10
+                adaptation_bytes = b''
+            else:
+                control = 0x30
+                adaptation_bytes = bytes([len(adaptation)]) + adaptation
+
+            header = struct.pack('>BHB', 0x47, (0x4000 if first else 0) | pid, control | self._next_continuity(pid))
+            packets.append(header + adaptation_bytes + pes[position:position + space])
+            position += space
+            first = False
+
+        self.fileobj.write(b''.join(packets))
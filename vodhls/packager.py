@@ -0,0 +1,117 @@
+#Copyright (c) 2022, Michael McFadden & Radio Free Asia
+#GNU GENERAL PUBLIC LICENSE Version 2
+#See file LICENCE or visit https://github.com/flipmcf/CasterPak/blob/master/LICENSE
+"""
+The packager processes: they run the packaging jobs requests queue with [packager] queue = True (see vodhls.jobs).
+
+    python -m vodhls.packager
+
+gunicorn starts this when it starts (see gunicorn.conf.py), it's the only packager on the machine.
+It runs [packager] processes workers, starts a new one for any that dies (queueing its job again),
+and stops them on SIGTERM.  Jobs aren't held to gunicorn's worker timeout.
+"""
+import os
+import sys
+import time
+import signal
+import logging
+import multiprocessing
+from logging.config import dictConfig
+
+import cachedb
+from config import get_config
+
+from .jobs import job_db, run_job
+from .locking import INTERACTIVE, set_default_admission
+
+logger = logging.getLogger('vodhls')
+
+# seconds an idle worker waits before looking at the queue again
+IDLE_INTERVAL = 0.25
+# seconds between the supervisor's checks on its workers
+SUPERVISE_INTERVAL = 1.0
+# finished jobs are kept this long, so the requests waiting for them can read how they ended
+KEEP_FINISHED_MINUTES = 10
+
+
+def work(name: str, stale_after: int) -> None:
+    """ a worker process: claim jobs and run them, until terminated """
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    logger.info(f"packager {name} started")
+    while True:
+        job = job_db.claim(name, stale_after=stale_after)
+        if job is None:
+            time.sleep(IDLE_INTERVAL)
+            continue
+        logger.debug(f"packager {name} running job {job['id']}: {job['kind']} {job['key']}")
+        job_db.finish(job['id'], run_job(job))
+
+
+class Packager(object):
+    """ starts the worker processes and keeps them running """
+
+    def __init__(self, processes: int, stale_after: int):
+        self.processes = processes
+        self.stale_after = stale_after
+        self.workers = {}
+        self.stopping = False
+        self.context = multiprocessing.get_context('fork')
+
+    def start_worker(self, slot: int) -> None:
+        name = f"packager-{os.getpid()}-{slot}"
+        # a job left running by this slot's last worker died with it
+        requeued = job_db.requeue(worker=name)
+        if requeued:
+            logger.warning(f"{name} died, queued its job again")
+        process = self.context.Process(target=work, args=(name, self.stale_after), name=name, daemon=True)
+        process.start()
+        self.workers[slot] = process
+
+    def stop(self, signum=None, frame=None) -> None:
+        self.stopping = True
+
+    def run(self) -> None:
+        # jobs that were running when the last packager stopped
+        requeued = job_db.requeue()
+        if requeued:
+            logger.info(f"queued {requeued} interrupted packaging jobs again")
+
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        for slot in range(self.processes):
+            self.start_worker(slot)
+
+        last_prune = 0
+        while not self.stopping:
+            for slot, process in list(self.workers.items()):
+                if not process.is_alive():
+                    logger.error(f"{process.name} exited with {process.exitcode}")
+                    self.start_worker(slot)
+            if time.monotonic() - last_prune > 60:
+                job_db.prune(KEEP_FINISHED_MINUTES)
+                last_prune = time.monotonic()
+            time.sleep(SUPERVISE_INTERVAL)
+
+        logger.info("packager stopping")
+        for process in self.workers.values():
+            process.terminate()
+        for process in self.workers.values():
+            process.join()
+        job_db.requeue()
+
+
+def main() -> None:
+    import applogging
+    dictConfig(applogging.CASTERPAK_DEFAULT_LOGGING_CONFIG)
+    logging.getLogger('vodhls').setLevel(logging.getLogger().level)
+
+    config = get_config()
+    cachedb.initialize_cache_db()
+    # requests wait for these jobs, but through the queue: a job waits for a bento4 process slot for as long as it takes
+    set_default_admission(INTERACTIVE, deadline=False)
+    Packager(processes=max(1, config.getint('packager', 'processes', fallback=2)),
+             stale_after=config.getint('packager', 'job_timeout', fallback=3600)).run()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,396 @@
+#Copyright (c) 2022, Michael McFadden & Radio Free Asia
+#GNU GENERAL PUBLIC LICENSE Version 2
+#See file LICENCE or visit https://github.com/flipmcf/CasterPak/blob/master/LICENSE
+"""
+Just-in-time segment packaging.
+
+Instead of running mp42hls over a whole input file to get a single segment,
+we read the mp4 sample tables once, work out where every segment starts and ends,
+and then cut only the segment that was asked for.
+
+The segment boundary table is saved in a small json 'sidecar' file next to the input,
+so the media playlist can be written without touching the mp4 file again.
+The sidecar also keeps the bitrates, codecs and resolution a master playlist lists for the rendition.
+"""
+import os
+import re
+import json
+import math
+import uuid
+import heapq
+import logging
+import typing as t
+from collections import OrderedDict
+
+from bento4.mp4boxes import ReadTracks, CodecsString
+from .mpegts import TsWriter, TS_PACKET_SIZE, PAT_PID, PMT_PID, elementary_stream_for
+
+logger = logging.getLogger('vodhls')
+
+SEGMENT_FILENAME_TEMPLATE = 'segment-%d.ts'
+segmentRE = re.compile(r'^segment-(\d+)\.ts$')
+
+# mp42hls starts a new segment on the first sync sample that is at most this close (in seconds)
+# to the target segment duration.  Keep the same rule so our segments line up with its playlists.
+SEGMENT_DURATION_THRESHOLD = 0.015
+
+# number of parsed inputs to keep in memory per worker process
+INDEX_CACHE_SIZE = 16
+
+# appended to the input file name to get the name of its segment index sidecar
+SIDECAR_SUFFIX = '.segments.json'
+
+# bump this whenever the sidecar layout or the segmenting rule changes
+SIDECAR_VERSION = 3
+
+
+def segment_number(segment_filename: str) -> t.Optional[int]:
+    """
+    :param segment_filename: eg: 'segment-169.ts'
+    :return: 169, or None if this isn't a segment name we create
+    """
+    match = segmentRE.match(segment_filename)
+    if match is None:
+        return None
+    return int(match.group(1))
+
+
+class SegmentIndex(object):
+    """ The segment boundary table of one input file.
+
+        segments is a list of dicts:
+        {'start': seconds, 'duration': seconds, 'samples': {track_id: [first, end]}, 'continuity': {track_id: counter}}
+        'samples' is the half open range of sample numbers of each track that belong to the segment.
+        'continuity' is the TS continuity counter of each track's first packet in the segment,
+        so the counters run on from one segment to the next.
+
+        The mp4 file itself is only parsed when it has to be:
+        to compute the segments, or to cut one of them.
+    """
+
+    def __init__(self, filename: t.Union[os.PathLike, str], segment_duration: float, segments: t.List[dict] = None,
+                 info: dict = None):
+        self.filename = filename
+        self.segment_duration = float(segment_duration)
+        self._tracks = None
+        self._streams = None
+        self._packets = None
+
+        if segments is None:
+            # parse now, so unsupported inputs fail here and not half way through a segment
+            self.streams
+            segments = self.compute_segments()
+        self.segments = segments
+        self._info = info
+        logger.debug(f'{filename}: {len(self.segments)} segments')
+
+    @property
+    def tracks(self) -> t.Dict[int, t.Any]:
+        if self._tracks is None:
+            # like mp42hls, package the first video track and the first audio track
+            tracks = OrderedDict()
+            for track in ReadTracks(self.filename):
+                if track.type in ('video', 'audio') and track.type not in [other.type for other in tracks.values()]:
+                    tracks[track.id] = track
+
+            if not tracks:
+                raise NotImplementedError(f'no audio or video tracks in {self.filename}')
+            self._tracks = tracks
+        return self._tracks
+
+    @property
+    def streams(self):
+        if self._streams is None:
+            # fails for codecs we can't put in a transport stream
+            self._streams = OrderedDict((track_id, elementary_stream_for(track))
+                                        for track_id, track in self.tracks.items())
+        return self._streams
+
+    @property
+    def reference_track(self):
+        """ segments are split on the sync samples of the video track, or the (first) audio track if there is none """
+        for track in self.tracks.values():
+            if track.type == 'video':
+                return track
+        return next(iter(self.tracks.values()))
+
+    def compute_segments(self) -> t.List[dict]:
+        reference = self.reference_track
+        table = reference.sample_table
+        timescale = float(reference.timescale)
+        threshold = self.segment_duration - SEGMENT_DURATION_THRESHOLD
+
+        # sample numbers (in the reference track) where each segment starts
+        boundaries = []
+        segment_start = None
+        for sample, dts in table.sync_sample_times():
+            if segment_start is None:
+                boundaries.append(sample)
+                segment_start = dts
+            elif (dts - segment_start) / timescale >= threshold:
+                boundaries.append(sample)
+                segment_start = dts
+
+        if not boundaries or boundaries[0] != 0:
+            # samples before the first sync sample go into the first segment
+            boundaries.insert(0, 0)
+
+        start_times = [table.dts(sample) / timescale for sample in boundaries]
+        end_time = table.total_duration / timescale
+
+        segments = []
+        for i, sample in enumerate(boundaries):
+            start = start_times[i]
+            end = start_times[i + 1] if i + 1 < len(boundaries) else end_time
+            segments.append({'start': start, 'duration': end - start, 'samples': {}})
+
+        for track in self.tracks.values():
+            track_table = track.sample_table
+            if track is reference:
+                firsts = boundaries
+            else:
+                firsts = [0] + [track_table.sample_at_time(int(round(start * track.timescale)))
+                                for start in start_times[1:]]
+            for i, segment in enumerate(segments):
+                end = firsts[i + 1] if i + 1 < len(firsts) else track_table.sample_count
+                segment['samples'][track.id] = [firsts[i], end]
+
+        # every packet of the segments before a segment moved its tracks' counters on
+        self._packets = self.segment_packets(segments)
+        counters = {track_id: 0 for track_id in self.tracks}
+        for segment, packets in zip(segments, self._packets):
+            segment['continuity'] = dict(counters)
+            for track_id, count in packets.items():
+                counters[track_id] = (counters[track_id] + count) & 0x0F
+
+        return segments
+
+    def segment_packets(self, segments: t.List[dict]) -> t.List[t.Dict[int, int]]:
+        """ :return: [{track_id: number of TS packets}] that write_segment() writes for each segment.
+            Worked out from the sample size tables, the segments don't have to exist.
+        """
+        writer = TsWriter(None, list(self.streams.values()))
+        packets = [{} for _ in segments]
+        for track_id, track in self.tracks.items():
+            stream = self.streams[track_id]
+            table = track.sample_table
+            for number, segment in enumerate(segments):
+                first, end = segment['samples'][track_id]
+                if table.sync_samples is None:
+                    # every sample is a sync sample (eg: audio)
+                    size = writer.samples_bytes(stream, table.sizes_of(first, end), True)
+                else:
+                    # every sample as a non sync sample, then put the few sync samples right
+                    sync_sizes = [table.size(sample) for sample in table.sync_samples_in(first, end)]
+                    size = writer.samples_bytes(stream, table.sizes_of(first, end), False) \
+                        + writer.samples_bytes(stream, sync_sizes, True) \
+                        - writer.samples_bytes(stream, sync_sizes, False)
+                packets[number][track_id] = size // TS_PACKET_SIZE
+        return packets
+
+    def write_segment(self, number: int, fileobj) -> None:
+        """ write segment 'number' as an MPEG-TS to fileobj """
+        segment = self.segments[number]
+
+        streams = self.streams
+        # a PAT and a PMT start every segment
+        continuity = {PAT_PID: number & 0x0F, PMT_PID: number & 0x0F}
+        continuity.update((streams[track_id].pid, counter) for track_id, counter in segment['continuity'].items())
+        writer = TsWriter(fileobj, list(streams.values()), continuity)
+        writer.write_tables()
+
+        def track_samples(track):
+            first, end = segment['samples'][track.id]
+            scale = 90000.0 / track.timescale
+            for offset, size, dts, cts_offset, is_sync in track.sample_table.samples(first, end):
+                # sort key is the decode time in 90kHz units, tie-break on the track id
+                yield int(dts * scale), track.id, offset, size, int((dts + cts_offset) * scale), is_sync
+
+        with open(self.filename, 'rb') as f:
+            merged = heapq.merge(*[track_samples(track) for track in self.tracks.values()])
+            for dts, track_id, offset, size, pts, is_sync in merged:
+                f.seek(offset)
+                data = f.read(size)
+                if len(data) != size:
+                    raise EOFError(f'short read at {offset} in {self.filename}')
+                writer.write_sample(streams[track_id], data, dts, pts, is_sync)
+
+    def byte_ranges(self, number: int, gap: int = 0) -> t.List[t.Tuple[int, int]]:
+        """
+        :param gap: ranges less than this many bytes apart are merged
+        :return: the sorted [start, end) byte ranges of the input file that segment 'number' is cut from
+        """
+        segment = self.segments[number]
+        spans = []
+        for track in self.tracks.values():
+            first, end = segment['samples'][track.id]
+            spans.extend((offset, offset + size) for offset, size, _, _, _ in track.sample_table.samples(first, end))
+        spans.sort()
+
+        ranges = []
+        for start, end in spans:
+            if ranges and start <= ranges[-1][1] + gap:
+                ranges[-1][1] = max(ranges[-1][1], end)
+            else:
+                ranges.append([start, end])
+        return [(start, end) for start, end in ranges]
+
+    @property
+    def info(self) -> dict:
+        """ what 'mp42hls --show-info' would report for these segments: bitrates, codecs and resolution.
+            Segment sizes are worked out from the sample sizes, the segments don't have to exist.
+        """
+        if self._info is None:
+            self._info = self.compute_info()
+        return self._info
+
+    def compute_info(self) -> dict:
+        if self._packets is None:
+            self._packets = self.segment_packets(self.segments)
+        # every segment starts with a PAT and a PMT
+        sizes = [(2 + sum(packets.values())) * TS_PACKET_SIZE for packets in self._packets]
+
+        duration = sum(segment['duration'] for segment in self.segments)
+        bitrates = [8.0 * size / segment['duration'] for size, segment in zip(sizes, self.segments)
+                    if segment['duration'] > 0]
+        info = {
+            'stats': {
+                'duration': duration,
+                'avg_segment_bitrate': 8.0 * sum(sizes) / duration if duration else 0,
+                'max_segment_bitrate': max(bitrates, default=0),
+                'avg_iframe_bitrate': 0,
+                'max_iframe_bitrate': 0,
+            },
+        }
+        for track in self.tracks.values():
+            if track.type == 'video':
+                info['video'] = {'codec': CodecsString(track), 'width': track.width, 'height': track.height}
+            else:
+                info['audio'] = {'codec': CodecsString(track)}
+        return info
+
+    @property
+    def target_duration(self) -> int:
+        """ EXT-X-TARGETDURATION: every EXTINF, rounded to the nearest integer, must fit in it """
+        return max([1] + [int(math.floor(segment['duration'] + 0.5)) for segment in self.segments])
+
+    def render_playlist(self, segment_url_template: str, allow_cache: bool = True) -> str:
+        """
+        :param segment_url_template: eg: 'http://example.com/i/video.mp4/segment-%d.ts'
+        :return: the media playlist (m3u8) for this input
+        """
+        lines = [
+            '#EXTM3U',
+            '#EXT-X-VERSION:3',
+            '#EXT-X-PLAYLIST-TYPE:VOD',
+            '#EXT-X-INDEPENDENT-SEGMENTS',
+            f'#EXT-X-TARGETDURATION:{self.target_duration}',
+            '#EXT-X-MEDIA-SEQUENCE:0',
+        ]
+        if allow_cache:
+            lines.append('#EXT-X-ALLOW-CACHE:YES')
+        for number, segment in enumerate(self.segments):
+            lines.append(f"#EXTINF:{segment['duration']:.6f},")
+            lines.append(segment_url_template % number)
+        lines.append('#EXT-X-ENDLIST')
+        return '\r\n'.join(lines) + '\r\n'
+
+    def to_dict(self) -> dict:
+        return {
+            'version': SIDECAR_VERSION,
+            'segment_duration': self.segment_duration,
+            'segments': self.segments,
+            'info': self.info,
+        }
+
+
+_index_cache = OrderedDict()
+
+
+def _input_identity(filename: t.Union[os.PathLike, str]) -> dict:
+    st = os.stat(filename)
+    return {'size': st.st_size, 'mtime_ns': st.st_mtime_ns}
+
+
+def read_sidecar(filename: t.Union[os.PathLike, str], sidecar: t.Union[os.PathLike, str],
+                 segment_duration: float, identity: dict = None) -> t.Optional[SegmentIndex]:
+    """
+    :param identity: what the input must match, by default its size and modification time
+    :return: the SegmentIndex saved in 'sidecar', or None if it is missing or was made from a different input
+    """
+    try:
+        with open(sidecar) as f:
+            saved = json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+
+    if saved.get('version') != SIDECAR_VERSION \
+            or saved.get('input') != (identity or _input_identity(filename)) \
+            or saved.get('segment_duration') != float(segment_duration):
+        logger.debug(f'{sidecar} is stale')
+        return None
+
+    segments = saved['segments']
+    for segment in segments:
+        # json turns integer keys into strings
+        segment['samples'] = {int(track_id): samples for track_id, samples in segment['samples'].items()}
+        segment['continuity'] = {int(track_id): counter for track_id, counter in segment['continuity'].items()}
+    return SegmentIndex(filename, segment_duration, segments=segments, info=saved.get('info'))
+
+
+def write_sidecar(index: SegmentIndex, sidecar: t.Union[os.PathLike, str], identity: dict = None) -> None:
+    """ save a SegmentIndex next to its input.  Written to a temporary name and renamed into place """
+    saved = index.to_dict()
+    saved['input'] = identity or _input_identity(index.filename)
+
+    os.makedirs(os.path.dirname(sidecar), exist_ok=True)
+    temp_name = f'{sidecar}.{uuid.uuid4().hex}.tmp'
+    try:
+        with open(temp_name, 'w') as f:
+            json.dump(saved, f, separators=(',', ':'))
+        os.replace(temp_name, sidecar)
+    except OSError:
+        # the sidecar is only an optimization
+        logger.exception(f'could not write segment index {sidecar}')
+        try:
+            os.remove(temp_name)
+        except FileNotFoundError:
+            pass
+
+
+def load_index(filename: t.Union[os.PathLike, str], segment_duration: float,
+               sidecar: t.Union[os.PathLike, str] = None, identity: dict = None) -> SegmentIndex:
+    """ get the SegmentIndex for an input file, parsing the file only when it has changed
+
+    Parsed indexes are kept in a small per-process LRU cache
+    keyed by the file's path, size, modification time and the segment duration.
+    Behind that is the json sidecar (if one is given), which is shared by all processes.
+
+    :param sidecar: path of the json file the index is saved in
+    :param identity: identifies the version of the input instead of its size and modification time.
+       For a file that is still being written, eg: {'url': ..., 'validator': ETag}
+    """
+    if identity is None:
+        identity = _input_identity(filename)
+    key = (os.fspath(filename), tuple(sorted(identity.items())), float(segment_duration))
+
+    index = _index_cache.get(key)
+    if index is not None:
+        _index_cache.move_to_end(key)
+        return index
+
+    index = None
+    if sidecar is not None:
+        index = read_sidecar(filename, sidecar, segment_duration, identity=identity)
+
+    if index is None:
+        index = SegmentIndex(filename, segment_duration)
+        if sidecar is not None:
+            write_sidecar(index, sidecar, identity=identity)
+
+    _index_cache[key] = index
+    while len(_index_cache) > INDEX_CACHE_SIZE:
+        _index_cache.popitem(last=False)
+    return index
+
+